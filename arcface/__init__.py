@@ -1,2 +1,2 @@
-from ._arcface import ArcFace, FaceInfo, Gender
-from ._tools import timer, image_regularization, capture_image, Rect
+from ._arcface import ArcFace, Angle3D, FaceInfo, Gender
+from ._tools import timer, image_regularization, capture_image, capture_face_image, Rect
@@ -36,6 +36,13 @@ class FaceInfo(metaclass=ShowMetaclass):#保存单张人脸信息
             values = *values, self.face_id
             str_format += "-%d"
         return str_format % values
+    def scale(self, sx: float, sy: float) -> "FaceInfo":
+        """
+        :param sx: 水平方向的比例
+        :param sy: 垂直方向的比例
+        :return: 位置缩放后的人脸信息，人脸 ID 不变
+        """
+        return FaceInfo(self.rect.scale(sx, sy), self.orient, getattr(self, "face_id", None))
     def to_sdk_face_info(self):
         face_info = arcface_class.SingleFaceInfo()
         rect = self.rect
@@ -63,15 +70,22 @@ class ArcFace:#ArcSoft Face 的封装
     OP_270_ONLY: int = 0x3
     OP_180_ONLY: int = 0x4
     OP_0_HIGHER_EXT: int = 0x5
+    ORIENTS = {"0": OP_0_ONLY, "90": OP_90_ONLY, "180": OP_180_ONLY, "270": OP_270_ONLY, "all": OP_0_HIGHER_EXT}
     # 部分需要用的错误码
     ALREADY_ACTIVATED: int = 90114  # SDK 已激活
     FACE_FEATURE_LOW_CONFIDENCE_LEVEL: int = 81925  # 人脸特征检测结果置信度低
     APP_ID: bytes = b""
     SDK_KEY: bytes = b""
-    def __init__(self, mode: int):
+    def __init__(self, mode: int, orient: int = OP_0_ONLY, scale: int = 30, max_faces: int = 10):
+        """
+        :param mode: image 或者 video 模式
+        :param orient: 人脸检测角度，见 ORIENTS
+        :param scale: 识别的最小人脸比例，人脸的边长至少为图片长边的 1/scale
+        :param max_faces: 最大需要检测的人脸个数
+        """
         self._engine = None
         ArcFace._activate()
-        self._init_engine(mode)
+        self._init_engine(mode, orient, scale, max_faces)
     @staticmethod
     def _activate() -> None:
         """
@@ -83,10 +97,13 @@ class ArcFace:#ArcSoft Face 的封装
         ret = arcface_sdk.online_activation(ArcFace.APP_ID, ArcFace.SDK_KEY)
         if ret != 0 and ret != ArcFace.ALREADY_ACTIVATED:
             raise ArcFace._get_exception("Activate", "激活失败", ret)
-    def _init_engine(self, mode: int) -> None:
+    def _init_engine(self, mode: int, orient: int, scale: int, max_faces: int) -> None:
         """
         初始化引擎
         :param mode: image 或者 video 模式
+        :param orient: 人脸检测角度
+        :param scale: 识别的最小人脸比例
+        :param max_faces: 最大需要检测的人脸个数
         :return: None。直接将引擎赋值给成员变量，失败抛出异常
         """
         assert (mode == ArcFace.VIDEO_MODE or mode == ArcFace.IMAGE_MODE)
@@ -101,9 +118,9 @@ class ArcFace:#ArcSoft Face 的封装
         self._engine = arcface_sdk.c_void_p()
         ret = arcface_sdk.init_engine(
             mode,  # VIDEO 模式 / IMAGE 模式
-            ArcFace.OP_0_ONLY,  # 人脸检测角度
-            30,  # 识别的最小人脸比例
-            10,  # 最大需要检测的人脸个数
+            orient,  # 人脸检测角度
+            scale,  # 识别的最小人脸比例
+            max_faces,  # 最大需要检测的人脸个数
             mask,  # 需要启用的功能组合
             ctypes.byref(self._engine)  # 引擎句柄
         )
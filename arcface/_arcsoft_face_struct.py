@@ -1,6 +1,7 @@
 from ctypes import *
 _uint8_pointer = POINTER(c_uint8)
 _int32_pointer = POINTER(c_int32)
+_float_pointer = POINTER(c_float)
 
 class Rect(Structure):#人脸矩形框
     left: c_int32
@@ -91,16 +92,16 @@ class GenderInfo(Structure):#性别信息
     ]
 
 class Angle3D(Structure):#3D 角度信息
-    roll: c_float  # 横滚角
-    yaw: c_float  # 偏航角
-    pitch: c_float  # 俯仰角
-    state: c_int32  # 0:正常; 非0:异常
+    roll: _float_pointer  # 横滚角
+    yaw: _float_pointer  # 偏航角
+    pitch: _float_pointer  # 俯仰角
+    status: _int32_pointer  # 0:正常; 非0:异常
     size: c_int32  # 检测的人脸个数
     _fields_ = [
-        ('roll', c_float),
-        ('yaw', c_float),
-        ('pitch', c_float),
-        ('state', c_int32),
+        ('roll', _float_pointer),
+        ('yaw', _float_pointer),
+        ('pitch', _float_pointer),
+        ('status', _int32_pointer),
         ('size', c_int32),
     ]
 
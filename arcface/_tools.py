@@ -100,15 +100,32 @@ class Rect:
     def center(self) -> Tuple[int, int]:
         return self._x + self._w // 2, self._y + self._h // 2
 
+    def scale(self, sx: float, sy: float) -> "Rect":
+        """
+        缩放坐标，比如把缩小后的图片中的位置映射回原图
+        :param sx: 水平方向的比例
+        :param sy: 垂直方向的比例
+        :return: 新的 Rect
+        """
+        x, y = int(round(self._x * sx)), int(round(self._y * sy))
+        right, bottom = int(round((self._x + self._w) * sx)), int(round((self._y + self._h) * sy))
+        return Rect(x, y, right - x, bottom - y)
+
     def __str__(self):
         return "Rect(%d,%d %dx%d)" % (self._x, self._y, self._w, self._h)
 
-def image_regularization(image: np.ndarray) -> np.ndarray:
+def image_regularization(image: np.ndarray, max_size: int = 0) -> np.ndarray:
     """
     将图片裁剪至合适的大小
     :param image: 需要裁剪的图像
+    :param max_size: 长边的最大值，超过时等比例缩小，为 0 时不缩小
     :return: 如果需要裁剪，返回裁剪后的图像，否则返回原图像
     """
+    height, width = image.shape[:2]
+    if 0 < max_size < max(width, height):
+        scale = max_size / max(width, height)
+        width, height = max(4, int(width * scale)), max(1, int(height * scale))
+        image = cv.resize(image, (width, height), interpolation=cv.INTER_AREA)
     width, height = image.shape[1] & (~3), image.shape[0]
     if width != image.shape[1]:
         image = cv.resize(image, (width, height))
@@ -127,3 +144,30 @@ def capture_image(image: np.ndarray, rect: Rect) -> np.ndarray:
     x2 = (x2 + 3) & (~3)  # 大于等于当前值的最小的 4 的倍数
     y1 = max(0, y1)
     return image[y1:y2, x1:x2].copy()
+
+
+def capture_face_image(image: np.ndarray, rect: Rect, padding: float = 0.5) -> Tuple[np.ndarray, Rect]:
+    """
+    截取人脸及其周围一定范围的图片，截取图片的宽度为 4 的倍数，是内存连续的拷贝
+    :param image: 原图
+    :param rect: 人脸在原图中的位置
+    :param padding: 人脸四周额外截取的范围，相对人脸宽高的比例
+    :return: 截取到的图片，人脸在截取图片中的位置
+    """
+    height, width = image.shape[:2]
+    (x, y), (w, h) = rect.top_left, rect.size
+    pad_w, pad_h = int(w * padding), int(h * padding)
+    x1 = max(0, x - pad_w) & ~3
+    x2 = min(width, x + w + pad_w)
+    crop_width = (x2 - x1 + 3) & ~3  # 大于等于当前值的最小的 4 的倍数
+    if width < x1 + crop_width:
+        # 超出原图右边时左移左边界，而不是缩小宽度，保证截取的图片包含整个人脸
+        x1 = max(0, width - crop_width)
+    y1, y2 = max(0, y - pad_h), min(height, y + h + pad_h)
+    # 截取的宽度等于原图宽度时切片已经是连续的，ascontiguousarray 不会拷贝；
+    # 原图之后还会被绘制人脸信息，必须拷贝
+    crop = image[y1:y2, x1:x1 + crop_width].copy()
+    if crop.shape[1] < crop_width:
+        # 原图比截取的宽度还窄时在右边补黑边
+        crop = cv.copyMakeBorder(crop, 0, 0, 0, crop_width - crop.shape[1], cv.BORDER_CONSTANT, value=0)
+    return crop, Rect(x - x1, y - y1, w, h)
@@ -0,0 +1,299 @@
+import ctypes
+import math
+import sys
+import threading
+import time
+import types
+import zlib
+from ctypes import POINTER, c_float, c_int32, c_uint8, c_void_p
+from typing import Dict, List, Optional
+
+import numpy as np
+
+FEATURE_HEADER = b"FAKE\x00\x01\x00\x00"  # 与 SDK 特征值一样是 8 字节的头部
+OK = 0
+
+
+class _Engine:
+    def __init__(self, mode: int):
+        self.mode = mode
+        self.frames = 0  # VIDEO 模式下检测过的帧数
+        self.faces = 0  # 最近一次 process 的人脸数
+        # SDK 返回的指针指向引擎持有的内存，在下一次调用前有效
+        self.buffers: Dict[str, object] = {}
+
+
+class FakeArcSoftSDK:
+    """
+    ArcSoft SDK 动态库(_arcsoft_face_func)的确定性替身，用于没有硬件和授权时的回放测试
+    每个接口按设定的耗时 sleep(与真实的 C 调用一样会释放 GIL)，再返回固定规律的结果:
+        检测: 每帧 faces 张人脸，水平均匀分布并轻微移动；每 track_length 帧换一批人脸 ID
+        特征: 由人脸区域的像素决定身份(共 identities 个)，同一身份的特征值相同
+    """
+    VIDEO_MODE = 0x00000000
+    ANGLE = 0x00000020
+
+    def __init__(
+            self,
+            detect_latency: float = 0.005,
+            extract_latency: float = 0.02,
+            process_latency: float = 0.01,
+            angle_latency: float = 0.001,
+            faces: int = 2,
+            identities: int = 100,
+            track_length: int = 200,
+            dim: int = 256,
+            seed: int = 0,
+            detect_pixels: int = 0
+    ):
+        """
+        :param detect_latency: 每次检测的耗时(秒)
+        :param extract_latency: 每次提取特征的耗时(秒)
+        :param process_latency: 每次活体、年龄、性别检测的耗时(秒)
+        :param angle_latency: 只检测 3D 角度时的耗时(秒)
+        :param faces: 每帧的人脸数
+        :param identities: 不同身份的个数
+        :param track_length: 同一批人脸 ID 持续的帧数
+        :param dim: 特征维数
+        :param seed: 生成特征值的随机种子
+        :param detect_pixels: 大于 0 时检测耗时与图片的像素数成正比，detect_latency 为该像素数时的耗时
+        """
+        self.detect_latency = detect_latency
+        self.extract_latency = extract_latency
+        self.process_latency = process_latency
+        self.angle_latency = angle_latency
+        self.faces = faces
+        self.identities = identities
+        self.track_length = track_length
+        self.dim = dim
+        self.seed = seed
+        self.detect_pixels = detect_pixels
+        self.calls: Dict[str, int] = {}
+        self._engines: Dict[int, _Engine] = {}
+        self._vectors: Dict[int, np.ndarray] = {}
+        self._lock = threading.Lock()
+        self._next_handle = 1
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    @staticmethod
+    def _sleep(latency: float) -> None:
+        if 0 < latency:
+            time.sleep(latency)
+
+    def vector(self, identity: int) -> np.ndarray:
+        """
+        :param identity: 身份编号
+        :return: 该身份的归一化特征向量
+        """
+        vector = self._vectors.get(identity)
+        if vector is None:
+            vector = np.random.RandomState(self.seed * 1000003 + identity).standard_normal(self.dim)
+            vector = (vector / np.linalg.norm(vector)).astype(np.float32)
+            self._vectors[identity] = vector
+        return vector
+
+    def feature(self, identity: int) -> bytes:
+        """
+        :param identity: 身份编号
+        :return: 与 extract_feature 输出格式相同的特征值
+        """
+        return FEATURE_HEADER + self.vector(identity).tobytes()
+
+    def gallery_features(self, size: int) -> Dict[str, bytes]:
+        """
+        生成人脸库: 前 identities 个是能被识别出的身份，其余是随机的特征值
+        :param size: 人脸库的大小
+        :return: Dict[姓名, 特征值]
+        """
+        features = {}
+        for i in range(size):
+            if i < self.identities:
+                features["person-%d" % i] = self.feature(i)
+            else:
+                features["other-%d" % i] = self.feature(self.identities + i)
+        return features
+
+    # 以下为与 _arcsoft_face_func 同名的接口
+
+    def get_active_file_info(self, active_file_info) -> int:
+        return OK
+
+    def online_activation(self, app_id: bytes, sdk_key: bytes) -> int:
+        return OK
+
+    def init_engine(self, mode, orient, scale, max_num, mask, engine_ref) -> int:
+        with self._lock:
+            handle = self._next_handle
+            self._next_handle += 1
+            self._engines[handle] = _Engine(mode)
+        engine_ref._obj.value = handle
+        return OK
+
+    def _engine(self, engine) -> _Engine:
+        return self._engines[engine.value if isinstance(engine, c_void_p) else engine]
+
+    def _face_rects(self, engine: _Engine, width: int, height: int) -> List[tuple]:
+        """
+        :return: [(left, top, right, bottom, 人脸 ID)]
+        """
+        if engine.mode != FakeArcSoftSDK.VIDEO_MODE:
+            # IMAGE 模式(入住登记)只返回中间的一张人脸
+            size = max(8, min(width, height) // 2)
+            left, top = (width - size) // 2, (height - size) // 2
+            return [(left, top, left + size - 1, top + size - 1, 0)]
+        engine.frames += 1
+        size = max(8, min(width // (self.faces + 1), height // 2))
+        drift = int(4 * math.sin(engine.frames / 10))
+        batch = engine.frames // self.track_length
+        rects = []
+        for i in range(self.faces):
+            cx = (i + 1) * width // (self.faces + 1) + drift
+            cy = height // 2
+            left = min(max(0, cx - size // 2), width - size)
+            top = min(max(0, cy - size // 2), height - size)
+            rects.append((left, top, left + size - 1, top + size - 1, batch * self.faces + i))
+        return rects
+
+    def detect_faces(self, engine, width, height, format_, image, faces_ref) -> int:
+        self._count("detect_faces")
+        if self.detect_pixels > 0:
+            self._sleep(self.detect_latency * width * height / self.detect_pixels)
+        else:
+            self._sleep(self.detect_latency)
+        engine = self._engine(engine)
+        faces = faces_ref._obj
+        rects = self._face_rects(engine, width, height)
+        rect_type = dict(faces._fields_)["rects"]._type_
+        rect_array = (rect_type * len(rects))()
+        orient_array = (c_int32 * len(rects))()
+        id_array = (c_int32 * len(rects))()
+        for i, (left, top, right, bottom, face_id) in enumerate(rects):
+            rect_array[i].left, rect_array[i].top, rect_array[i].right, rect_array[i].bottom = left, top, right, bottom
+            orient_array[i] = 1
+            id_array[i] = face_id
+        engine.buffers["detect"] = rect_array, orient_array, id_array
+        faces.rects = ctypes.cast(rect_array, POINTER(rect_type))
+        faces.orients = ctypes.cast(orient_array, POINTER(c_int32))
+        faces.id = ctypes.cast(id_array, POINTER(c_int32))
+        faces.size = len(rects)
+        return OK
+
+    def _identity(self, width: int, height: int, image, face_info) -> int:
+        # 按人脸区域的部分像素计算校验和，同样的输入总是得到同样的身份
+        pixels = np.ctypeslib.as_array(ctypes.cast(image, POINTER(c_uint8)), shape=(height, width, 3))
+        rect = face_info.rect
+        region = pixels[max(0, rect.top):rect.bottom + 1:8, max(0, rect.left):rect.right + 1:8]
+        return zlib.crc32(np.ascontiguousarray(region).tobytes()) % self.identities
+
+    def extract_feature(self, engine, width, height, format_, image, face_info, feature_ref) -> int:
+        self._count("extract_feature")
+        self._sleep(self.extract_latency)
+        engine = self._engine(engine)
+        data = self.feature(self._identity(width, height, image, face_info))
+        buffer = ctypes.create_string_buffer(data, len(data))
+        engine.buffers["feature"] = buffer
+        feature = feature_ref._obj
+        feature.feature = ctypes.cast(buffer, POINTER(c_uint8))
+        feature.size = len(data)
+        return OK
+
+    @staticmethod
+    def _read_feature(feature) -> np.ndarray:
+        size = getattr(feature, "featureSize", feature.size)
+        data = ctypes.string_at(feature.feature, size)
+        return np.frombuffer(data, dtype=np.float32, offset=len(FEATURE_HEADER))
+
+    def compare_feature(self, engine, feature1, feature2, confidence) -> int:
+        self._count("compare_feature")
+        score = float(np.dot(self._read_feature(feature1), self._read_feature(feature2)))
+        confidence.value = max(0.0, min(1.0, score))
+        return OK
+
+    def set_liveness_param(self, engine, threshold) -> int:
+        return OK
+
+    def process(self, engine, width, height, format_, image, faces_ref, mask) -> int:
+        if mask == FakeArcSoftSDK.ANGLE:
+            self._count("process_angle")
+            self._sleep(self.angle_latency)
+        else:
+            self._count("process")
+            self._sleep(self.process_latency)
+        self._engine(engine).faces = faces_ref._obj.size
+        return OK
+
+    def process_ir(self, engine, width, height, format_, image, faces_ref, mask) -> int:
+        return self.process(engine, width, height, format_, image, faces_ref, mask)
+
+    def _fill(self, engine, info_ref, field: str, value: int) -> int:
+        engine = self._engine(engine)
+        array = (c_int32 * max(1, engine.faces))(*([value] * max(1, engine.faces)))
+        engine.buffers[field] = array
+        info = info_ref._obj
+        setattr(info, field, ctypes.cast(array, POINTER(c_int32)))
+        info.size = engine.faces
+        return OK
+
+    def get_age(self, engine, age_info_ref) -> int:
+        return self._fill(engine, age_info_ref, "ages", 30)
+
+    def get_gender(self, engine, gender_info_ref) -> int:
+        return self._fill(engine, gender_info_ref, "genders", 0)
+
+    def get_liveness_score(self, engine, liveness_info_ref) -> int:
+        return self._fill(engine, liveness_info_ref, "is_live", 1)
+
+    def get_liveness_score_ir(self, engine, liveness_info_ref) -> int:
+        return self.get_liveness_score(engine, liveness_info_ref)
+
+    def get_angle3d(self, engine, angle_info_ref) -> int:
+        engine = self._engine(engine)
+        count = max(1, engine.faces)
+        # 每次的偏航角不同，覆盖正脸和侧脸
+        angles = [(c_float * count)() for _ in range(3)]
+        angles[1][0] = float(self.calls.get("process", 0) * 17 % 61 - 30)
+        status = (c_int32 * count)()
+        engine.buffers["angle"] = angles, status
+        angle = angle_info_ref._obj
+        angle.roll, angle.yaw, angle.pitch = (ctypes.cast(array, POINTER(c_float)) for array in angles)
+        angle.status = ctypes.cast(status, POINTER(c_int32))
+        angle.size = engine.faces
+        return OK
+
+    def get_version(self, engine) -> int:
+        return 0
+
+    def uninit_engine(self, engine) -> int:
+        with self._lock:
+            self._engines.pop(engine.value if isinstance(engine, c_void_p) else engine, None)
+        return OK
+
+
+_installed: Optional[FakeArcSoftSDK] = None
+
+
+def install(sdk: FakeArcSoftSDK) -> FakeArcSoftSDK:
+    """
+    用替身代替 arcface._arcsoft_face_func，必须在第一次导入 arcface 之前调用
+    :param sdk: SDK 的替身
+    :return: 安装的替身
+    """
+    global _installed
+    if _installed is not None:
+        return _installed
+    assert "arcface" not in sys.modules, "arcface 已经加载了真实的 SDK"
+    module = types.ModuleType("arcface._arcsoft_face_func")
+    module.c_void_p = c_void_p
+    module.c_float = c_float
+    for name in (
+            "get_active_file_info", "online_activation", "init_engine", "detect_faces", "extract_feature",
+            "compare_feature", "set_liveness_param", "process", "process_ir", "get_age", "get_gender",
+            "get_angle3d", "get_liveness_score", "get_liveness_score_ir", "get_version", "uninit_engine",
+    ):
+        setattr(module, name, getattr(sdk, name))
+    sys.modules[module.__name__] = module
+    _installed = sdk
+    return sdk
@@ -0,0 +1,239 @@
+"""
+离线回放测试: 用 LocalImage 不限速地回放录像或者图片目录，
+在 SDK 替身上运行 CameraPipeline(即 recognition 中的 _run_m_n) 和 FaceProcess，
+输出帧率、各阶段耗时的分位数和内存，用于发现 Python 部分的性能回退
+
+    python -m benchmark.replay <视频或者图片目录> --frames 500 --extract-ms 20
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from benchmark import fake_sdk
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class _CountingDispatcher:
+    """
+    代替 EventDispatcher，只统计识别事件，不发送
+    """
+    def __init__(self):
+        self.events = 0
+
+    def dispatch(self, event) -> None:
+        self.events += 1
+
+    def close(self) -> None:
+        pass
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    """
+    :param values: 耗时(秒)
+    :return: 以毫秒为单位的分位数
+    """
+    data = np.asarray(values, dtype=np.float64) * 1000
+    p50, p90, p99 = np.percentile(data, [50, 90, 99])
+    return {"count": int(data.size), "mean": float(data.mean()), "p50": float(p50), "p90": float(p90),
+            "p99": float(p99), "max": float(data.max())}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 的单位是 KB，macOS 是字节
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run(
+        path: str,
+        frames: int = 300,
+        sdk: fake_sdk.FakeArcSoftSDK = None,
+        engines: int = 2,
+        queue_size: int = 16,
+        gallery_size: int = 1000,
+        extract_rate: float = 20.0,
+        quality_gate: bool = True,
+        fuse_shots: int = 1,
+        detect_size: int = 0,
+        draw: bool = False,
+        encode: bool = True,
+        trace_memory: bool = False
+) -> Dict:
+    """
+    回放一段视频或者图片目录
+    :param path: 视频文件、图片文件或者图片目录
+    :param frames: 处理的帧数
+    :param sdk: SDK 替身，None 使用默认的参数
+    :param engines: 特征提取的引擎数
+    :param queue_size: 等待特征提取的任务数上限
+    :param gallery_size: 人脸库的大小
+    :param extract_rate: 每秒最多提交去识别的人脸数，0 表示不限制
+    :param quality_gate: 是否在提交前做质量检查
+    :param fuse_shots: 识别时提取并融合特征的截图数
+    :param detect_size: 检测前把视频帧缩小到的长边，0 表示不缩小
+    :param draw: 是否绘制人脸信息(需要字体文件)
+    :param encode: 是否对每一帧做 JPEG 编码(模拟推流)
+    :param trace_memory: 是否用 tracemalloc 统计 Python 分配的内存峰值(会明显变慢)
+    :return: 测试结果
+    """
+    sdk = fake_sdk.install(sdk or fake_sdk.FakeArcSoftSDK())
+    # 替身安装后才能导入依赖 arcface 的模块
+    from arcface import ArcFace
+    from module import metrics
+    from module.face_process import FaceProcess
+    from module.image_source import LocalImage
+    from module.pipeline import CameraPipeline
+    from module.quality import QualityGate
+    from module.scheduler import ExtractionScheduler
+    draw_face_info = None
+    if draw:
+        from module.overlay import draw_face_info
+
+    ArcFace.APP_ID = ArcFace.SDK_KEY = b"benchmark"
+    metrics.enable()
+    samples: Dict[str, List[float]] = {}
+    lock = threading.Lock()
+
+    def record(value: float, labels: Tuple) -> None:
+        name = dict(labels).get("stage", "")
+        with lock:
+            samples.setdefault(name, []).append(value)
+
+    metrics.STAGE_SECONDS.set_recorder(record)
+    dispatcher = _CountingDispatcher()
+    processed = [0]
+    params = [int(cv.IMWRITE_JPEG_QUALITY), 80]
+
+    def on_frame(pipeline, image, faces_info) -> bool:
+        if draw_face_info is not None:
+            with metrics.stage("draw"):
+                for face_info in faces_info.values():
+                    draw_face_info(image, face_info)
+        if encode:
+            with metrics.stage("jpeg_encode"):
+                cv.imencode(".jpg", image, params)
+        processed[0] += 1
+        return frames <= processed[0]
+
+    if trace_memory:
+        tracemalloc.start()
+    with LocalImage(path, interval=0) as source:
+        face_process = FaceProcess(engines, queue_size=queue_size, dispatcher=dispatcher, fuse_shots=fuse_shots)
+        face_process._set_gallery(sdk.gallery_features(gallery_size))
+        pipeline = CameraPipeline(
+            "replay", source, face_process, on_frame,
+            ExtractionScheduler(extract_rate), QualityGate() if quality_gate else None, detect_size)
+        begin_time = time.perf_counter()
+        with face_process:
+            pipeline.run()
+            elapsed = time.perf_counter() - begin_time
+    traced_peak = None
+    if trace_memory:
+        traced_peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+    metrics.STAGE_SECONDS.set_recorder(None)
+
+    return {
+        "frames": processed[0],
+        "seconds": elapsed,
+        "fps": processed[0] / elapsed if elapsed else 0.0,
+        "sdk_calls": dict(sdk.calls),
+        "recognitions": dispatcher.events,
+        "stages_ms": {name: _percentiles(values) for name, values in sorted(samples.items())},
+        "peak_rss_mb": _peak_rss_mb(),
+        "traced_peak_mb": traced_peak,
+    }
+
+
+def _print_report(result: Dict) -> None:
+    print("帧数 %d, 耗时 %.2f 秒, %.2f fps, 识别事件 %d" % (
+        result["frames"], result["seconds"], result["fps"], result["recognitions"]))
+    print("SDK 调用: %s" % ", ".join("%s=%d" % item for item in sorted(result["sdk_calls"].items())))
+    print("%-16s %8s %8s %8s %8s %8s %8s" % ("阶段(ms)", "次数", "平均", "p50", "p90", "p99", "最大"))
+    for name, stats in result["stages_ms"].items():
+        print("%-16s %8d %8.3f %8.3f %8.3f %8.3f %8.3f" % (
+            name, stats["count"], stats["mean"], stats["p50"], stats["p90"], stats["p99"], stats["max"]))
+    if result["peak_rss_mb"] is not None:
+        print("内存峰值(RSS): %.1f MB" % result["peak_rss_mb"])
+    if result["traced_peak_mb"] is not None:
+        print("Python 分配峰值: %.1f MB" % result["traced_peak_mb"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在 SDK 替身上回放视频，测试识别流程的性能")
+    parser.add_argument("path", help="视频文件、图片文件或者图片目录")
+    parser.add_argument("--frames", type=int, default=300, help="处理的帧数")
+    parser.add_argument("--detect-ms", type=float, default=5.0, help="每次检测的耗时")
+    parser.add_argument("--extract-ms", type=float, default=20.0, help="每次提取特征的耗时")
+    parser.add_argument("--process-ms", type=float, default=10.0, help="每次活体、年龄、性别检测的耗时")
+    parser.add_argument("--detect-pixels", type=int, default=0,
+                        help="大于 0 时检测耗时与像素数成正比，--detect-ms 为该像素数时的耗时")
+    parser.add_argument("--faces", type=int, default=2, help="每帧的人脸数")
+    parser.add_argument("--identities", type=int, default=100, help="能被识别的身份数")
+    parser.add_argument("--track-length", type=int, default=200,
+                        help="同一批人脸 ID 持续的帧数，太短时人脸在截图稳定前就离开画面，不会做活体检测")
+    parser.add_argument("--engines", type=int, default=2, help="特征提取的引擎数")
+    parser.add_argument("--queue-size", type=int, default=16, help="等待特征提取的任务数上限")
+    parser.add_argument("--gallery-size", type=int, default=1000, help="人脸库的大小")
+    parser.add_argument("--extract-rate", type=float, default=20.0, help="每秒最多提交去识别的人脸数")
+    parser.add_argument("--no-quality-gate", action="store_true", help="不做提交前的质量检查")
+    parser.add_argument("--fuse-shots", type=int, default=1, help="识别时提取并融合特征的截图数")
+    parser.add_argument("--detect-size", type=int, default=0, help="检测前把视频帧缩小到的长边，0 表示不缩小")
+    parser.add_argument("--draw", action="store_true", help="绘制人脸信息(需要字体文件)")
+    parser.add_argument("--no-encode", action="store_true", help="不做 JPEG 编码")
+    parser.add_argument("--trace-memory", action="store_true", help="用 tracemalloc 统计 Python 分配的内存")
+    parser.add_argument("--json", help="把结果另外保存为 JSON 文件")
+    args = parser.parse_args()
+    # face_process 的日志级别固定为 DEBUG，在输出端过滤，日志记录本身的开销仍然计入
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.WARNING)
+    logging.basicConfig(handlers=[handler])
+
+    sdk = fake_sdk.FakeArcSoftSDK(
+        detect_latency=args.detect_ms / 1000,
+        extract_latency=args.extract_ms / 1000,
+        process_latency=args.process_ms / 1000,
+        faces=args.faces,
+        identities=args.identities,
+        track_length=args.track_length,
+        detect_pixels=args.detect_pixels,
+    )
+    result = run(
+        args.path,
+        frames=args.frames,
+        sdk=sdk,
+        engines=args.engines,
+        queue_size=args.queue_size,
+        gallery_size=args.gallery_size,
+        extract_rate=args.extract_rate,
+        quality_gate=not args.no_quality_gate,
+        fuse_shots=args.fuse_shots,
+        detect_size=args.detect_size,
+        draw=args.draw,
+        encode=not args.no_encode,
+        trace_memory=args.trace_memory,
+    )
+    _print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import base64
+import logging
+from typing import Dict, List, Optional
+
+from django.db import transaction
+from django.utils import timezone
+
+from face.models import Guest, Feature, Stay
+from module.bulk_enrollment import EnrollmentResult
+from module.config import get_profile
+from module.feature_store import FeatureStore
+
+_logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500  # bulk_create 每条 SQL 插入的行数
+
+
+def feature_store() -> Optional[FeatureStore]:
+    """
+    :return: 配置中的二进制特征库，没有配置时返回 None
+    """
+    directory = get_profile().feature_store
+    return FeatureStore(directory) if directory else None
+
+
+def save_enrollments(
+        results: List[EnrollmentResult],
+        rooms: Dict[str, str],
+        default_room: str = None
+) -> Dict[str, str]:
+    """
+    把批量提取的特征值和入住记录在一个事务中写入数据库，再一次写入二进制特征库
+    已经有记录的客人先删除旧记录再插入，事务提交前其他连接看不到中间状态
+    :param results: module.bulk_enrollment.extract 的结果
+    :param rooms: Dict[客人的 ID, 房间号]
+    :param default_room: rooms 中没有的客人使用的房间号
+    :return: Dict[客人的 ID, 失败原因]，没有出现的 ID 为登记成功
+    """
+    failures = {}
+    registered = set(Guest.objects.filter(id__in=[r.id for r in results]).values_list("id", flat=True))
+    accepted = {}
+    for result in results:
+        room = rooms.get(result.id, default_room)
+        if result.id not in registered:
+            failures[result.id] = "no reg"
+        elif not room:
+            failures[result.id] = "no room"
+        elif result.feature is None:
+            failures[result.id] = "; ".join(result.errors) or "no face"
+        else:
+            accepted[result.id] = (result.feature, room)
+
+    if accepted:
+        now = timezone.now()
+        ids = list(accepted.keys())
+        with transaction.atomic():
+            Feature.objects.filter(id__in=ids).delete()
+            Feature.objects.bulk_create([
+                Feature(id=id_, Value=base64.b64encode(feature).decode(), updated=now, removed=False)
+                for id_, (feature, _) in accepted.items()
+            ], batch_size=BATCH_SIZE)
+            Stay.objects.filter(id__in=ids).delete()
+            Stay.objects.bulk_create([
+                Stay(id=id_, intime=now, outtime=now, status=True, room=room)
+                for id_, (_, room) in accepted.items()
+            ], batch_size=BATCH_SIZE)
+        store = feature_store()
+        if store is not None:
+            store.add_many({id_: feature for id_, (feature, _) in accepted.items()})
+    _logger.info("批量登记 %d 人，失败 %d 人" % (len(accepted), len(failures)))
+    return failures
@@ -0,0 +1,50 @@
+import csv
+import json
+import os
+import zipfile
+from typing import Dict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from face.bulk import save_enrollments
+from module import bulk_enrollment
+from module.enrollment import get_face_process
+
+
+def _load_rooms(filename: str) -> Dict[str, str]:
+    """
+    :param filename: {"<ID>": "<房间号>"} 的 JSON 文件，或者每行 "<ID>,<房间号>" 的 CSV 文件
+    :return: Dict[客人的 ID, 房间号]
+    """
+    with open(filename, encoding="utf-8") as file:
+        if filename.lower().endswith(".json"):
+            return {str(k): str(v) for k, v in json.load(file).items()}
+        return {row[0].strip(): row[1].strip() for row in csv.reader(file) if len(row) >= 2}
+
+
+class Command(BaseCommand):
+    help = "批量入住登记: 从图片目录或者 zip 压缩包(结构与 fa 目录相同)导入客人的特征值"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="图片目录或者 zip 压缩包")
+        parser.add_argument("--rooms", help="房间号的 JSON 或者 CSV 文件")
+        parser.add_argument("--room", help="--rooms 中没有的客人的房间号")
+        parser.add_argument("--workers", type=int, help="解码图片的线程数，默认为 CPU 核数")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        rooms = _load_rooms(options["rooms"]) if options["rooms"] else {}
+        if not os.path.exists(path):
+            raise CommandError("不存在的路径 \"%s\"" % path)
+        face_process = get_face_process()
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                results = bulk_enrollment.extract(
+                    face_process, bulk_enrollment.from_zip(archive), options["workers"])
+        else:
+            results = bulk_enrollment.extract(
+                face_process, bulk_enrollment.from_directory(path), options["workers"])
+        failures = save_enrollments(results, rooms, options["room"])
+        for id_, reason in failures.items():
+            self.stderr.write("%s: %s" % (id_, reason))
+        self.stdout.write("登记成功 %d 人，失败 %d 人" % (len(results) - len(failures), len(failures)))
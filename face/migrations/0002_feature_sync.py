@@ -0,0 +1,23 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('face', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feature',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='feature',
+            name='removed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
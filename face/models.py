@@ -12,6 +12,8 @@ class Guest(models.Model):
 class Feature(models.Model):
     id = models.CharField(primary_key=True, max_length=40)
     Value = models.TextField(max_length=5000)
+    updated = models.DateTimeField(auto_now=True, db_index=True)  # 人脸库增量同步的水位线
+    removed = models.BooleanField(default=False)  # 退房后只做标记，让同步方能感知到删除
 
 
 class User(models.Model):
@@ -1,17 +1,21 @@
 from django.shortcuts import render
 from django.http import HttpResponse, JsonResponse
+from face.bulk import feature_store, save_enrollments
 from face.models import User, Guest, Feature, Stay
-from typing import Dict
-import yaml
-from arcface import ArcFace
-from module.face_process import FaceProcess
+from module import bulk_enrollment
+from module.config import get_profile
+from module.enrollment import archive, enroll_image, get_face_process
+import base64
+import json
 import os
+import zipfile
 from django.conf import settings
 from datetime import datetime
 import recognition
 
 ONE_UNDEAD_THREAD_FLAG = False
 
+
 def showrtsp(request):
     return render(request, "face/index.html")
 
@@ -64,8 +68,12 @@ def check_out(request):
         id = request.POST.get('id')
         if id:
             try:
-                user = Feature.objects.get(id=id)
-                user.delete()
+                user = Feature.objects.get(id=id, removed=False)
+                user.removed = True
+                user.save()
+                store = feature_store()
+                if store is not None:
+                    store.remove(id)
                 filename = os.path.join(settings.STATICFILES_DIRS[1], id)
                 if os.path.exists(filename):
                     os.remove(filename)
@@ -85,19 +93,17 @@ def check_in(request):
         if len(fil) == 0:
             return JsonResponse({"status": "BS.500", "msg": "no reg"})
         if pic and room:
-            filename = os.path.join(settings.STATICFILES_DIRS[1], id)
-            with open(filename, 'wb') as f:
-                for c in pic.chunks():
-                    f.write(c)
-            with open("profile.yml", "r", encoding="utf-8") as file:
-                profile: Dict[str, str] = yaml.load(file, yaml.Loader)
-                ArcFace.APP_ID = profile["app-id"].encode()
-                ArcFace.SDK_KEY = profile["sdk-key"].encode()
-            face_process = FaceProcess()
-            res = face_process.add_person(filename)
+            data = pic.read()
+            # 复用常驻的引擎，在内存中解码，不再先写文件再读回
+            res = enroll_image(id, data)
             if res[0] == 1 and res[1]:
+                if get_profile().archive_uploads:
+                    archive(os.path.join(settings.STATICFILES_DIRS[1], id), data)
                 add_user = Feature(id=id, Value=res[1])
                 add_user.save()
+                store = feature_store()
+                if store is not None:
+                    store.add(id, base64.b64decode(res[1]))
                 add_user = Stay(id=id, intime=datetime.now(), outtime=datetime.now(), status=True, room=room)
                 add_user.save()
 
@@ -105,6 +111,36 @@ def check_in(request):
             else:
                 return JsonResponse({"status": "BS.400", "msg": "please check pic"})
         return JsonResponse({"status": "BS.400", "msg": "please check pic"})
+def check_in_batch(request):
+    """
+    批量入住登记: 上传多个 face 文件(<ID>.jpg)和/或一个 archive 压缩包(结构与 fa 目录相同)
+    rooms 为 {"<ID>": "<房间号>"} 的 JSON，room 为其中没有的客人的房间号
+    """
+    if request.method == "POST":
+        try:
+            rooms = json.loads(request.POST.get('rooms') or "{}")
+        except ValueError:
+            rooms = None
+        if not isinstance(rooms, dict):
+            return JsonResponse({"status": "BS.400", "msg": "please check rooms."})
+        archive = request.FILES.get('archive')
+        sources = bulk_enrollment.from_files((f.name, f.read()) for f in request.FILES.getlist('face'))
+        try:
+            if archive:
+                archive = zipfile.ZipFile(archive)
+                sources += bulk_enrollment.from_zip(archive)
+            if not sources:
+                return JsonResponse({"status": "BS.400", "msg": "please check pic"})
+            results = bulk_enrollment.extract(get_face_process(), sources)
+        except zipfile.BadZipFile:
+            return JsonResponse({"status": "BS.400", "msg": "please check archive."})
+        finally:
+            if archive:
+                archive.close()
+        failures = save_enrollments(results, rooms, request.POST.get('room'))
+        return JsonResponse({"status": "BS.200", "msg": "check in sucess.",
+                             "count": len(results) - len(failures), "failures": failures})
+    return JsonResponse({"status": "BS.400", "msg": "please check pic"})
 def checked_face(request):
     if request.method == "POST":
         id = request.POST.get('id')
@@ -114,6 +150,33 @@ def checked_face(request):
         return JsonResponse({"status": "BS.200", "msg": "checked face sucess."})
 
 
+def _valid_event(event) -> bool:
+    """
+    :return: 识别事件是否是带有字符串或者整数 id 的对象，否则 id 无法用于查询
+    """
+    return isinstance(event, dict) and isinstance(event.get("id"), (str, int)) \
+        and not isinstance(event.get("id"), bool)
+
+
+def checked_faces(request):
+    """
+    批量接收识别事件: {"events": [{"id": ..., "face_id": ..., "score": ..., "camera": ..., "time": ...}]}
+    """
+    if request.method == "POST":
+        try:
+            events = json.loads(request.body.decode("utf-8"))["events"]
+        except (ValueError, KeyError, TypeError):
+            events = None
+        if not isinstance(events, list) or not all(map(_valid_event, events)):
+            return JsonResponse({"status": "BS.400", "msg": "please check events."}, status=400)
+        ids = set(event["id"] for event in events)
+        rooms = dict(Stay.objects.filter(id__in=ids).values_list("id", "room"))
+        for event in events:
+            print("id: ", event["id"], " room:", rooms.get(event["id"]), " camera:", event.get("camera"))
+        return JsonResponse({"status": "BS.200", "msg": "checked faces sucess.", "count": len(events)})
+    return JsonResponse({"status": "BS.400", "msg": "please check events."})
+
+
 def undeadthread():
     global ONE_UNDEAD_THREAD_FLAG
     if not ONE_UNDEAD_THREAD_FLAG:
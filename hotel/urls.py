@@ -15,7 +15,7 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from face.views import reg, log, check_out, check_in, enable_undeadthread, checked_face, showrtsp
+from face.views import reg, log, check_out, check_in, check_in_batch, enable_undeadthread, checked_face, checked_faces, showrtsp
 from django.views.generic import TemplateView
 from django.conf import settings
 
@@ -27,7 +27,9 @@ urlpatterns = [
     path('log/', log),
     path('checkout/', check_out),
     path('checkin/', check_in),
+    path('checkinbatch/', check_in_batch),
     path('checkedface/', checked_face),
+    path('checkedfaces/', checked_faces),
     path('', showrtsp)
 ]
 urlpatterns += [
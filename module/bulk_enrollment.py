@@ -0,0 +1,187 @@
+"""
+批量入住登记: 从图片目录、zip 压缩包或者上传的多个文件中提取客人的特征值
+文件按以下规则对应到客人的 ID(与 fa/ 目录的结构相同):
+    <ID>.jpg            一张照片
+    <ID>/<任意名字>.jpg  同一个客人的多张照片，特征值融合为一个
+解码在线程池中并行，特征提取分散到 FaceProcess 引擎池的所有引擎
+"""
+import logging
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from module.face_process import FaceProcess
+from module.gallery import fuse_features
+from module.image_source import decode_image, get_regular_file
+
+_logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+class ImageSource(NamedTuple):
+    id: str  # 客人的 ID
+    name: str  # 文件名，用于报告错误
+    load: Callable[[], bytes]  # 读取文件内容
+
+
+class EnrollmentResult(NamedTuple):
+    id: str  # 客人的 ID
+    feature: Optional[bytes]  # 所有可用照片融合后的特征值，失败时为 None
+    images: int  # 照片数
+    errors: List[str]  # 不可用的照片及原因
+
+
+def guest_id(relative_path: str) -> Optional[str]:
+    """
+    由文件在目录或者压缩包中的相对路径得到客人的 ID
+    :param relative_path: 相对路径，"/" 或者 os.sep 分隔
+    :return: 不是图片文件时返回 None
+    """
+    parts = [part for part in relative_path.replace(os.sep, "/").split("/") if part]
+    if not parts or not parts[-1].lower().endswith(IMAGE_EXTENSIONS) or parts[-1].startswith("."):
+        return None
+    if len(parts) == 1:
+        return os.path.splitext(parts[0])[0]
+    return parts[-2]
+
+
+def _read_file(filename: str) -> Callable[[], bytes]:
+    def load() -> bytes:
+        with open(filename, "rb") as file:
+            return file.read()
+    return load
+
+
+def from_directory(path: str) -> List[ImageSource]:
+    """
+    :param path: 图片目录
+    :return: 目录中所有的图片
+    """
+    sources = []
+    for filename in get_regular_file(path):
+        id_ = guest_id(os.path.relpath(filename, path))
+        if id_:
+            sources.append(ImageSource(id_, filename, _read_file(filename)))
+    return sources
+
+
+def from_zip(archive: zipfile.ZipFile) -> List[ImageSource]:
+    """
+    压缩包中所有的文件都在同一个顶层目录下时(比如直接压缩 fa 目录)，忽略该顶层目录
+    :param archive: 打开的压缩包，读取完成前不能关闭
+    :return: 压缩包中所有的图片
+    """
+    names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    prefix = ""
+    tops = set(name.split("/", 1)[0] for name in names)
+    if len(tops) == 1 and all("/" in name for name in names):
+        prefix = tops.pop() + "/"
+    sources = []
+    for name in names:
+        id_ = guest_id(name[len(prefix):])
+        if id_:
+            sources.append(ImageSource(id_, name, lambda name=name: archive.read(name)))
+    return sources
+
+
+def from_files(files: Iterable[Tuple[str, bytes]]) -> List[ImageSource]:
+    """
+    :param files: (文件名, 文件内容)，比如上传的文件
+    :return: 所有的图片
+    """
+    sources = []
+    for name, data in files:
+        id_ = guest_id(name)
+        if id_:
+            sources.append(ImageSource(id_, name, lambda data=data: data))
+    return sources
+
+
+def _decode(source: ImageSource) -> np.ndarray:
+    try:
+        return decode_image(source.load())
+    except Exception as e:
+        _logger.warning("读取 \"%s\" 失败: %s" % (source.name, e))
+        return np.array([])
+
+
+def _bounded_map(
+        executor: Executor,
+        fn: Callable,
+        items: List,
+        window: int
+) -> Iterator[Tuple[object, object]]:
+    """
+    与 executor.map 相同，但最多同时提交 window 个任务，避免所有解码后的图片同时占用内存
+    :return: 按顺序的 (item, 结果)
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(fn, item)))
+        if len(pending) >= window:
+            item_, future = pending.popleft()
+            yield item_, future.result()
+    while pending:
+        item_, future = pending.popleft()
+        yield item_, future.result()
+
+
+def extract(
+        face_process: FaceProcess,
+        sources: List[ImageSource],
+        decode_workers: int = None,
+        window: int = 32
+) -> List[EnrollmentResult]:
+    """
+    并行解码所有图片，并在引擎池中提取特征值
+    每张照片只能有一张人脸；同一个客人的多张照片融合为一个特征值
+    :param face_process: 提供引擎池的 FaceProcess
+    :param sources: 所有的图片
+    :param decode_workers: 解码的线程数，默认为 CPU 核数
+    :param window: 同时解码或者等待提取的图片数上限
+    :return: 每个客人的结果，顺序与第一次出现的顺序相同
+    """
+    features: Dict[str, List[bytes]] = {}
+    images: Dict[str, int] = {}
+    errors: Dict[str, List[str]] = {}
+    for source in sources:
+        features.setdefault(source.id, [])
+        images[source.id] = images.get(source.id, 0) + 1
+        errors.setdefault(source.id, [])
+
+    pending = deque()
+
+    def collect() -> None:
+        source, future = pending.popleft()
+        try:
+            faces_number, features_ = future.result()
+        except Exception as e:
+            errors[source.id].append("%s: %s" % (source.name, e))
+            return
+        if faces_number == 1 and features_:
+            features[source.id].extend(features_.values())
+        else:
+            errors[source.id].append("%s: %d faces" % (source.name, faces_number))
+
+    workers = decode_workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(workers, thread_name_prefix="decode") as decoder:
+        for source, image in _bounded_map(decoder, _decode, sources, window):
+            if image.size == 0:
+                errors[source.id].append("%s: bad image" % source.name)
+                continue
+            # 引擎池的队列满时 submit 会阻塞，解码不会远远跑在提取前面
+            pending.append((source, face_process.submit_enrollment(source.id, image)))
+            if len(pending) >= window:
+                collect()
+        while pending:
+            collect()
+
+    return [
+        EnrollmentResult(id_, fuse_features(features_) if features_ else None, images[id_], errors[id_])
+        for id_, features_ in features.items()
+    ]
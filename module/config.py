@@ -0,0 +1,206 @@
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional, Tuple
+
+import yaml
+
+_logger = logging.getLogger(__name__)
+
+PROFILE_FILE = "profile.yml"
+
+
+class DatabaseProfile(NamedTuple):
+    host: str
+    user: str
+    password: str
+    base: str
+
+
+class QualityProfile(NamedTuple):
+    max_yaw: float
+    max_pitch: float
+    min_sharpness: float
+
+
+class DetectionProfile(NamedTuple):
+    size: int
+    scale: int
+    max_faces: int
+    orient: str
+
+
+class GalleryIndexProfile(NamedTuple):
+    type: str
+    nlist: int
+    nprobe: int
+    min_size: int
+    rerank: int
+
+
+class RecentProbesProfile(NamedTuple):
+    size: int
+    window: float
+
+
+class Profile(NamedTuple):
+    """
+    profile.yml 解析后的只读快照
+    """
+    app_id: bytes
+    sdk_key: bytes
+    lan_url: str
+    lan_on: bool
+    camera_default: str
+    cameras: Mapping[str, str]
+    server_on: bool
+    database: DatabaseProfile
+    engine_pool_size: int
+    queue_size: int
+    multi_camera: bool
+    threaded_capture: bool
+    event_url: str
+    gallery_source: str
+    feature_store: str
+    metrics_port: int
+    extract_rate: float
+    quality: QualityProfile
+    fuse_shots: int
+    archive_uploads: bool
+    detection: DetectionProfile
+    gallery_index: GalleryIndexProfile
+    match_cache_ttl: float
+    recent_probes: RecentProbesProfile
+
+
+def _to_bool(value) -> bool:
+    return str(value).strip() not in ("0", "", "false", "False")
+
+
+def parse_profile(profile: dict) -> Profile:
+    """
+    将 yaml 解析出的字典转换为 Profile
+    :param profile: yaml 解析出的字典
+    :return: Profile
+    """
+    database = profile.get("database") or {}
+    quality = profile.get("quality") or {}
+    detection = profile.get("detection") or {}
+    gallery_index = profile.get("gallery-index") or {}
+    recent_probes = profile.get("recent-probes") or {}
+    return Profile(
+        app_id=str(profile.get("app-id", "")).encode(),
+        sdk_key=str(profile.get("sdk-key", "")).encode(),
+        lan_url=str(profile.get("lan-url", "")),
+        lan_on=_to_bool(profile.get("lan-on", "0")),
+        camera_default=str(profile.get("camera-default", "0")),
+        cameras=MappingProxyType({str(k): str(v) for k, v in (profile.get("camera") or {}).items()}),
+        server_on=_to_bool(profile.get("server-on", "1")),
+        database=DatabaseProfile(
+            host=str(database.get("host", "localhost")),
+            user=str(database.get("user", "")),
+            password=str(database.get("password", "")),
+            base=str(database.get("base", "")),
+        ),
+        engine_pool_size=max(1, int(profile.get("engine-pool-size", 2))),
+        queue_size=max(0, int(profile.get("queue-size", 16))),
+        multi_camera=_to_bool(profile.get("multi-camera", "0")),
+        threaded_capture=_to_bool(profile.get("threaded-capture", "1")),
+        event_url=str(profile.get("event-url", "http://127.0.0.1:8000/checkedfaces/")),
+        gallery_source=str(profile.get("gallery-source", "database")),
+        feature_store=str(profile.get("feature-store", "")),
+        metrics_port=max(0, int(profile.get("metrics-port", 0))),
+        extract_rate=max(0.0, float(profile.get("extract-rate", 20))),
+        quality=QualityProfile(
+            max_yaw=float(quality.get("max-yaw", 30)),
+            max_pitch=float(quality.get("max-pitch", 25)),
+            min_sharpness=float(quality.get("min-sharpness", 30)),
+        ),
+        fuse_shots=max(1, int(profile.get("fuse-shots", 1))),
+        archive_uploads=_to_bool(profile.get("archive-uploads", "1")),
+        detection=DetectionProfile(
+            size=max(0, int(detection.get("size", 0))),
+            scale=min(32, max(2, int(detection.get("scale", 30)))),
+            max_faces=max(1, int(detection.get("max-faces", 10))),
+            orient=str(detection.get("orient", "0")),
+        ),
+        gallery_index=GalleryIndexProfile(
+            type=str(gallery_index.get("type", "exact")),
+            nlist=max(0, int(gallery_index.get("nlist", 0))),
+            nprobe=max(1, int(gallery_index.get("nprobe", 32))),
+            min_size=max(1, int(gallery_index.get("min-size", 10000))),
+            rerank=max(0, int(gallery_index.get("rerank", 32))),
+        ),
+        match_cache_ttl=max(0.0, float(profile.get("match-cache-ttl", 30))),
+        recent_probes=RecentProbesProfile(
+            size=max(0, int(recent_probes.get("size", 256))),
+            window=max(0.0, float(recent_probes.get("window", 120))),
+        ),
+    )
+
+
+class ProfileWatcher:
+    """
+    缓存 profile.yml 的解析结果
+    最多每 CHECK_INTERVAL 秒检查一次文件状态，只有修改时间或者大小变化时才重新解析
+    """
+    CHECK_INTERVAL = 0.5  # 秒
+
+    def __init__(self, filename: str = PROFILE_FILE):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._profile: Optional[Profile] = None
+        self._stat: Optional[Tuple[int, int]] = None
+        self._next_check_time = 0.0
+
+    def _file_stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._filename)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self) -> Profile:
+        """
+        获取最新的配置
+        :return: 配置的快照
+        """
+        now = time.monotonic()
+        if self._profile is not None and now < self._next_check_time:
+            return self._profile
+        with self._lock:
+            if self._profile is not None and now < self._next_check_time:
+                return self._profile
+            stat = self._file_stat()
+            if self._profile is None or stat != self._stat:
+                self._reload(stat)
+            self._next_check_time = now + ProfileWatcher.CHECK_INTERVAL
+            return self._profile
+
+    def _reload(self, stat: Optional[Tuple[int, int]]) -> None:
+        try:
+            with open(self._filename, "r", encoding="utf-8") as file:
+                profile = parse_profile(yaml.load(file, yaml.Loader) or {})
+        except (OSError, yaml.YAMLError) as e:
+            if self._profile is None:
+                raise
+            # 文件正在被写入等情况，继续使用上一次的配置
+            _logger.warning("重新加载 %s 失败: %s" % (self._filename, e))
+            return
+        if self._profile is not None:
+            _logger.info("重新加载了 %s" % self._filename)
+        self._profile = profile
+        self._stat = stat
+
+
+_watcher = ProfileWatcher()
+
+
+def get_profile() -> Profile:
+    """
+    获取 profile.yml 的配置
+    :return: 配置的快照
+    """
+    return _watcher.get()
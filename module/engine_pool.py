@@ -0,0 +1,112 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+
+from arcface import ArcFace
+
+_logger = logging.getLogger(__name__)
+
+
+def _image_engine() -> ArcFace:
+    return ArcFace(ArcFace.IMAGE_MODE)
+
+
+class EnginePool:
+    """
+    ArcFace 引擎池
+    SDK 的一个引擎不能并行调用，所以每个引擎绑定一个独立的工作线程，
+    任务放在共享的队列中，由空闲的线程使用自己的引擎执行
+    """
+    def __init__(self, size: int, engine_factory: Callable[[], Any] = None, max_pending: int = 0):
+        """
+        :param size: 引擎(工作线程)的个数
+        :param engine_factory: 创建引擎的函数，默认创建 IMAGE 模式的 ArcFace，可以替换为假的 SDK 实现
+        :param max_pending: 队列中最多等待的任务数，0 表示不限制
+        """
+        assert 0 < size, "引擎个数必须大于 0"
+        engine_factory = engine_factory if engine_factory is not None else _image_engine
+        self._tasks: queue.Queue = queue.Queue(max_pending)
+        # 在当前线程创建引擎，初始化失败时可以直接抛出异常
+        self._engines: List[Any] = []
+        try:
+            for _ in range(size):
+                self._engines.append(engine_factory())
+        except Exception:
+            self._release_engines()
+            raise
+        self._threads = [
+            threading.Thread(target=self._work, args=(engine,), name="arcface-engine-%d" % i, daemon=True)
+            for i, engine in enumerate(self._engines)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def size(self) -> int:
+        return len(self._engines)
+
+    @property
+    def pending(self) -> int:
+        """
+        :return: 队列中等待执行的任务数
+        """
+        return self._tasks.qsize()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        提交任务，任务执行时第一个参数为工作线程的引擎: fn(engine, *args, **kwargs)
+        :return: 任务的 Future
+        """
+        future = Future()
+        self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def try_submit(self, fn: Callable, *args, **kwargs) -> Optional[Future]:
+        """
+        与 submit 相同，但队列已满时不等待
+        :return: 任务的 Future，队列已满返回 None
+        """
+        future = Future()
+        try:
+            self._tasks.put_nowait((future, fn, args, kwargs))
+        except queue.Full:
+            return None
+        return future
+
+    def _work(self, engine) -> None:
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(engine, *args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _release_engines(self) -> None:
+        for engine in self._engines:
+            engine.release()
+        self._engines = []
+
+    def release(self) -> None:
+        """
+        等待已提交的任务执行完，然后释放所有的引擎
+        :return: None
+        """
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._release_engines()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
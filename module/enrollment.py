@@ -0,0 +1,88 @@
+import atexit
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from arcface import ArcFace
+from module.config import get_profile
+from module.face_process import FaceProcess
+from module.image_source import decode_image
+
+_logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_face_process: Optional[FaceProcess] = None
+_archiver: Optional[ThreadPoolExecutor] = None
+
+
+def get_face_process() -> FaceProcess:
+    """
+    获取用于入住登记的 FaceProcess
+    第一次调用时激活 SDK 并初始化引擎池，之后一直复用，进程退出时释放
+    :return: 共享的 FaceProcess
+    """
+    global _face_process
+    if _face_process is not None:
+        return _face_process
+    with _lock:
+        if _face_process is None:
+            profile = get_profile()
+            ArcFace.APP_ID = profile.app_id
+            ArcFace.SDK_KEY = profile.sdk_key
+            _logger.info("初始化入住登记的引擎")
+            _face_process = FaceProcess(recognition=False)
+            atexit.register(release)
+    return _face_process
+
+
+def enroll_image(name: str, data: bytes) -> Tuple[int, str]:
+    """
+    在内存中解码上传的照片并提取特征值，不经过文件
+    :param name: 客人的 ID
+    :param data: 照片文件的内容
+    :return: 人脸数, base64 编码的特征值(人脸数不为 1 时为 "None")
+    """
+    return get_face_process().add_person_image(name, decode_image(data))
+
+
+def _write_file(filename: str, data: bytes) -> None:
+    # 先写临时文件再替换，读取方不会看到写了一半的文件
+    temp = filename + ".tmp"
+    try:
+        with open(temp, "wb") as file:
+            file.write(data)
+        os.replace(temp, filename)
+    except OSError as e:
+        _logger.warning("保存 \"%s\" 失败: %s" % (filename, e))
+
+
+def archive(filename: str, data: bytes) -> Future:
+    """
+    在后台线程中保存上传的照片，不阻塞请求
+    :param filename: 文件名
+    :param data: 文件内容
+    :return: 保存完成的 Future
+    """
+    global _archiver
+    with _lock:
+        if _archiver is None:
+            _archiver = ThreadPoolExecutor(1, thread_name_prefix="archive")
+            atexit.register(release)
+        return _archiver.submit(_write_file, filename, data)
+
+
+def release() -> None:
+    """
+    释放共享的 FaceProcess，等待还没有保存的照片
+    :return: None
+    """
+    global _face_process, _archiver
+    with _lock:
+        if _face_process is not None:
+            _face_process.release()
+            _face_process = None
+        if _archiver is not None:
+            _archiver.shutdown()
+            _archiver = None
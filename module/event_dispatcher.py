@@ -0,0 +1,186 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Sequence, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_logger = logging.getLogger(__name__)
+
+
+class RecognitionEvent(NamedTuple):
+    id: str  # 识别出的人
+    face_id: int  # 跟踪的人脸 ID
+    score: float  # 相似度
+    camera: str  # 摄像头的名字
+    time: float  # 识别的时间
+
+    def to_dict(self) -> Dict:
+        return self._asdict()
+
+
+class EventDispatcher:
+    """
+    在后台线程中批量发送识别事件
+    复用 keep-alive 连接，同一个摄像头的同一人脸识别为同一个人时，在时间窗口内只发送一次
+    """
+    def __init__(
+            self,
+            url: str,
+            batch_size: int = 32,
+            flush_interval: float = 0.2,
+            dedupe_window: float = 10.0,
+            timeout: float = 2.0,
+            queue_size: int = 1024,
+            listeners: Sequence[Callable[[RecognitionEvent], None]] = ()
+    ):
+        """
+        :param url: 接收批量事件的地址
+        :param batch_size: 每批最多的事件数
+        :param flush_interval: 凑一批事件最多等待的时间(秒)
+        :param dedupe_window: 去重的时间窗口(秒)
+        :param timeout: 请求超时(秒)
+        :param queue_size: 等待发送的事件数上限，超过后丢弃新的事件
+        :param listeners: 每个事件提交时都会调用(不去重)，比如推送给看板，不能阻塞
+        """
+        self._url = url
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._dedupe_window = dedupe_window
+        self._timeout = timeout
+        self._events: queue.Queue = queue.Queue(queue_size)
+        self._last_sent: Dict[Tuple[str, int, str], float] = {}
+        self._last_pruned = 0.0
+        self._stop = threading.Event()
+        self._session = None
+        self._thread = None
+        self._listeners = list(listeners)
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def dispatch(self, event: RecognitionEvent) -> None:
+        """
+        提交识别事件，不会阻塞
+        :param event: 识别事件
+        :return: None
+        """
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception:
+                _logger.exception("识别事件的 listener 出错")
+        # 入队之前去重，重复的事件不占用队列
+        key = event.camera, event.face_id, event.id
+        if not self._record(key):
+            return
+        self._start()
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self._last_sent.pop(key, None)
+            self.dropped += 1
+            _logger.warning("识别事件队列已满，丢弃 %s" % (event,))
+
+    def _record(self, key: Tuple[str, int, str]) -> bool:
+        """
+        :param key: 摄像头, 人脸 ID, 识别出的人
+        :return: 时间窗口内没有发送过时返回 True 并记录
+        """
+        now = time.time()
+        with self._lock:
+            # 每个时间窗口清理一次过期的记录
+            if now - self._last_pruned >= self._dedupe_window:
+                self._last_sent = {k: v for k, v in self._last_sent.items() if now - v < self._dedupe_window}
+                self._last_pruned = now
+            last = self._last_sent.get(key)
+            if last is not None and now - last < self._dedupe_window:
+                return False
+            self._last_sent[key] = now
+            return True
+
+    def _start(self) -> None:
+        # 第一次提交事件时才创建连接池和线程
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=1)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="event-dispatcher", daemon=True)
+            self._thread.start()
+
+    def _next_batch(self) -> Tuple[List[RecognitionEvent], bool]:
+        """
+        :return: 一批事件, 是否需要停止
+        """
+        batch = []
+        while True:
+            # close 时队列可能已满放不下 None，所以空闲时检查停止标志
+            try:
+                event = self._events.get(timeout=self._flush_interval)
+                break
+            except queue.Empty:
+                if self._stop.is_set():
+                    return batch, True
+        if event is None:
+            return batch, True
+        batch.append(event)
+        deadline = time.time() + self._flush_interval
+        while len(batch) < self._batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                event = self._events.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if event is None:
+                return batch, True
+            batch.append(event)
+        return batch, False
+
+    def _post(self, events: List[RecognitionEvent]) -> None:
+        try:
+            response = self._session.post(
+                self._url,
+                json={"events": [event.to_dict() for event in events]},
+                timeout=self._timeout
+            )
+            response.raise_for_status()
+            self.sent += len(events)
+        except requests.RequestException as e:
+            self.failed += len(events)
+            _logger.warning("发送 %d 个识别事件失败: %s" % (len(events), e))
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if batch:
+                self._post(batch)
+
+    def close(self) -> None:
+        """
+        发送完队列中的事件后停止
+        :return: None
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        try:
+            self._events.put_nowait(None)
+        except queue.Full:
+            # 工作线程发送完队列中的事件后检查停止标志
+            pass
+        self._thread.join()
+        self._session.close()
+        self._thread = None
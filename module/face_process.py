@@ -1,54 +1,158 @@
 import base64
+import datetime
 import logging
-import os
-from concurrent.futures import Future, ThreadPoolExecutor
-from typing import Dict, Tuple, Generator, Optional
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple, Generator, Optional
 import numpy as np
-from arcface import ArcFace, image_regularization, Rect
+from arcface import ArcFace, image_regularization, capture_face_image, Rect
 from arcface import FaceInfo as ArcFaceInfo
-from arcface import Gender
-from module.image_source import get_regular_file, read_image
+from arcface import Angle3D, Gender
+from module import metrics
+from module.config import get_profile
+from module.engine_pool import EnginePool
+from module.event_dispatcher import EventDispatcher, RecognitionEvent
+from module.feature_store import FeatureStore
+from module.gallery import FeatureGallery, decode_feature, fuse_features
+from module.gallery_index import ExactIndex, create_index
+from module.image_source import get_regular_file
+from module.match_cache import Match, MatchCache
+from module.recent_probes import RecentProbes
 import pymysql
-import yaml
 import time
-import requests
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 class FaceInfo:
-    def __init__(self, arc_face_info: ArcFaceInfo):
+    CROP_PADDING = 0.5  # 截取人脸时四周额外保留的范围，相对人脸宽高的比例
+    MAX_ATTEMPTS = 8  # 每个人脸最多提交的次数
+    BACKOFF_BASE = 0.25  # 第一次失败后等待的时间(秒)，之后每次失败翻倍
+    BACKOFF_MAX = 4.0  # 失败后最长的等待时间(秒)
+    GOOD_FACE_SIZE = 160  # 边长达到该值的人脸在大小上得满分
+    GOOD_SHARPNESS = 100.0  # 清晰度达到该值的人脸在清晰度上得满分
+    SHOT_BUFFER_SIZE = 3  # 每个人脸缓存的质量最好的截图数
+    SHOT_SETTLE_TIME = 0.4  # 这段时间(秒)内没有出现更好的截图就开始识别
+    SHOT_MAX_WAIT = 1.5  # 从第一张截图开始最多等待的时间(秒)
+
+    def __init__(self, arc_face_info: ArcFaceInfo, camera: str = ""):
         self.stop_flags = [True, True]
         self.arc_face_info: ArcFaceInfo = arc_face_info
-        self._image = np.array([])
+        self.camera = camera  # 人脸所在的摄像头
+        # 截取的人脸图片以及人脸在其中的位置，两者一起替换，保证工作线程读到的是一致的
+        self._capture: Tuple[np.ndarray, Optional[ArcFaceInfo]] = (np.array([]), None)
         self.name = ""
         self.threshold: float = 0.0
         self.liveness = None
         self.age = None
         self.gender = None
+        self.angle: Optional[Angle3D] = None  # 最近一次质量检查得到的 3D 角度
+        self.sharpness: Optional[float] = None  # 最近一次质量检查得到的清晰度
+        self.best_quality = 0.0  # 提交过的帧中最好的质量分
+        self.attempts = 0  # 已经提交的次数
+        self.failures = 0  # 连续失败的次数
+        self.retry_time = 0.0  # 失败后下一次可以提交的时间
+        self.lost = False  # 人脸已经离开画面，只需要识别姓名
+        # 质量最好的几张截图 [(质量分, 截图, 人脸在截图中的位置)]，按质量从高到低
+        self._shots: List[Tuple[float, np.ndarray, ArcFaceInfo]] = []
+        self._first_shot_time = 0.0
+        self._best_shot_time = 0.0
+        # 需要提取并融合特征的截图，为空时只使用 _capture
+        self._fusion: List[Tuple[np.ndarray, ArcFaceInfo]] = []
+    def _crop(self, image: np.ndarray) -> Tuple[np.ndarray, ArcFaceInfo]:
+        """
+        只截取人脸附近的区域，不拷贝整帧图片
+        :return: 截图, 人脸在截图中的位置
+        """
+        arc_face_info = self.arc_face_info
+        crop, rect = capture_face_image(image, arc_face_info.rect, FaceInfo.CROP_PADDING)
+        return crop, ArcFaceInfo(rect, arc_face_info.orient, getattr(arc_face_info, "face_id", None))
     @property
     def image(self):
-        return self._image
+        return self._capture[0]
     @image.setter
     def image(self, image: np.ndarray):
-        self._image = image.copy()
-        # self._image = capture_image(image, self.rect)
+        self._capture = self._crop(image)
+        self._fusion = []
+    @property
+    def capture(self) -> Tuple[np.ndarray, ArcFaceInfo]:
+        """
+        :return: 截取的人脸图片, 人脸在截取图片中的位置
+        """
+        return self._capture
+    @property
+    def captures(self) -> List[Tuple[np.ndarray, ArcFaceInfo]]:
+        """
+        :return: 需要提取特征的所有截图，多于一张时融合它们的特征
+        """
+        return self._fusion or [self._capture]
+    @property
+    def has_shots(self) -> bool:
+        return bool(self._shots)
+    def offer_shot(self, image: np.ndarray, quality: float, now: float = None) -> bool:
+        """
+        把这一帧的人脸放入缓存，只保留质量最好的 SHOT_BUFFER_SIZE 张截图
+        :param image: 视频帧
+        :param quality: 这一帧人脸的质量分
+        :param now: 当前时间，默认为 time.time()
+        :return: 是否被缓存
+        """
+        now = time.time() if now is None else now
+        shots = self._shots
+        if len(shots) == FaceInfo.SHOT_BUFFER_SIZE and quality <= shots[-1][0]:
+            return False
+        if not shots:
+            self._first_shot_time = now
+        if not shots or shots[0][0] < quality:
+            self._best_shot_time = now
+        crop, arc_face_info = self._crop(image)
+        shots.append((quality, crop, arc_face_info))
+        shots.sort(key=lambda x: x[0], reverse=True)
+        del shots[FaceInfo.SHOT_BUFFER_SIZE:]
+        return True
+    def shots_ready(self, now: float = None) -> bool:
+        """
+        :param now: 当前时间，默认为 time.time()
+        :return: 缓存的截图是否稳定下来，可以开始识别
+        """
+        if not self._shots:
+            return False
+        now = time.time() if now is None else now
+        return FaceInfo.SHOT_SETTLE_TIME <= now - self._best_shot_time or \
+            FaceInfo.SHOT_MAX_WAIT <= now - self._first_shot_time
+    def use_shots(self, count: int = 1) -> None:
+        """
+        用缓存中最好的截图作为这一次获取信息的图片，并清空缓存
+        :param count: 提取并融合特征的截图数
+        :return: None
+        """
+        shots, self._shots = self._shots, []
+        self._capture = shots[0][1], shots[0][2]
+        self._fusion = [(crop, arc_face_info) for _, crop, arc_face_info in shots[:count]] if 1 < count else []
     @property
     def rect(self):
         return self.arc_face_info.rect
-    def need_update(self) -> bool:
+    def need_update(self, now: float = None) -> bool:
         """
-        :return:
+        :param now: 当前时间，默认为 time.time()
+        :return: 是否可以提交去获取信息
         """
-        # id = self.arc_face_info.face_id
-        # busy = self._busy()
-        # fs = self.futures
-        # flags = fs[0].done() if fs[0] is not None else None, fs[1].done() if fs[1] is not None else None
-        # _logger.debug("%s busy %s %s" % (self.arc_face_info.face_id, self._busy(), flags))
+        now = time.time() if now is None else now
         return not any((
             self.rect.size < (50, 50),
             self._busy(),
             self.complete(),
+            FaceInfo.MAX_ATTEMPTS <= self.attempts,
+            now < self.retry_time,
         ))
+    def record_failure(self, now: float = None) -> None:
+        """
+        记录一次失败，按指数退避推迟下一次提交
+        :param now: 当前时间，默认为 time.time()
+        :return: None
+        """
+        now = time.time() if now is None else now
+        self.failures += 1
+        self.retry_time = now + min(FaceInfo.BACKOFF_MAX, FaceInfo.BACKOFF_BASE * 2 ** (self.failures - 1))
     def cancel(self) -> None:
         """
         取消获取当前的信息
@@ -90,66 +194,173 @@ class FaceInfo:
             return v1 if condition else v2
 
 class FaceProcess:
-    def __init__(self):
-        self._arcface = ArcFace(ArcFace.IMAGE_MODE)
-        self._features: Dict[str, bytes] = {}  # 人脸数据库
-        # max_workers 必须为 1，因为 SDK 对并行的支持有限
-        self._executors = (ThreadPoolExecutor(max_workers=1), ThreadPoolExecutor(max_workers=1))
+    SYNC_INTERVAL = 0.5  # 人脸库同步的间隔(秒)
+    SYNC_OVERLAP = datetime.timedelta(seconds=2)  # 每次同步往前多查询的时间
+    ENROLL_IMAGE_SIZE = 1920  # 登记照片的长边超过该值时先缩小再检测
+    MATCH_THRESHOLD = 0.6  # 与人脸库中最相似的人的相似度超过该值才算识别成功
+    RECENT_MARGIN = 0.1  # 最近见过的人的相似度至少超过 MATCH_THRESHOLD 这么多才不检索整个人脸库
+    CALIBRATION_SAMPLES = 200  # 第一次发布人脸库时，用 SDK 校准相似度抽取的特征值对数
+
+    def __init__(
+            self,
+            engines: int = None,
+            engine_factory: Callable[[], ArcFace] = None,
+            queue_size: int = None,
+            dispatcher: EventDispatcher = None,
+            fuse_shots: int = None,
+            match_cache_ttl: float = None,
+            recognition: bool = True
+    ):
+        """
+        :param engines: 引擎池中 IMAGE 模式引擎的个数，默认使用配置文件中的 engine-pool-size
+        :param engine_factory: 创建引擎的函数，默认创建 IMAGE 模式的 ArcFace
+        :param queue_size: 等待特征提取的任务数上限，默认使用配置文件中的 queue-size
+        :param dispatcher: 发送识别事件，默认发送到配置文件中的 event-url
+        :param fuse_shots: 使用缓存的截图识别时，提取并融合特征的截图数，默认使用配置文件中的 fuse-shots
+        :param match_cache_ttl: 跟踪中的人脸识别结果的缓存时间，默认使用配置文件中的 match-cache-ttl
+        :param recognition: 为 False 时只用于入住登记(submit_enrollment、add_person_image)，
+            不创建识别事件的发送和识别结果的缓存
+        """
+        profile = get_profile()
+        engines = engines if engines is not None else profile.engine_pool_size
+        queue_size = queue_size if queue_size is not None else profile.queue_size
+        # SDK 的单个引擎不能并行，每个引擎绑定一个工作线程；队列有上限，多路摄像头时不会无限堆积
+        self._pool = EnginePool(engines, engine_factory, queue_size)
+        self._gallery = FeatureGallery()  # 人脸数据库
+        self._dispatcher: Optional[EventDispatcher] = None
+        self._matches: Optional[MatchCache] = None
+        self._recent: Optional[RecentProbes] = None
+        if recognition:
+            self._dispatcher = dispatcher if dispatcher is not None else EventDispatcher(profile.event_url)
+            self._matches = MatchCache(match_cache_ttl if match_cache_ttl is not None else profile.match_cache_ttl)
+            self._recent = RecentProbes(profile.recent_probes.size, profile.recent_probes.window)
+        self._fuse_shots = fuse_shots if fuse_shots is not None else profile.fuse_shots
+        self._calibrated = False  # 人脸库的相似度是否已经校准到 SDK 的尺度
         self.close_update_feature = True
         self.count = 0
-    def async_update_face_info(self, image: np.ndarray, face_info: FaceInfo) -> None:
+    @property
+    def pending(self) -> int:
         """
-        更新单个人脸的信息。
-        :param image: 包含人脸的图片
+        :return: 等待特征提取的任务数
+        """
+        return self._pool.pending
+
+    def recall(self, face_info: FaceInfo) -> bool:
+        """
+        使用缓存的识别结果，命中时不需要再提取特征和检索人脸库
         :param face_info: 人脸信息
+        :return: 是否命中
+        """
+        if face_info.name or self._matches.ttl <= 0:
+            return False
+        match = self._matches.get(face_info.camera, face_info.arc_face_info.face_id)
+        if match is None or match.version != self._gallery.version:
+            metrics.MATCH_CACHE.inc(result="miss" if match is None else "stale")
+            return False
+        metrics.MATCH_CACHE.inc(result="hit")
+        face_info.name, face_info.threshold = match.name, match.score
+        face_info.failures = 0
+        return True
+
+    def forget(self, camera: str, face_id: int = None) -> None:
+        """
+        跟踪丢失或者重新创建 VIDEO 引擎后，清除缓存的识别结果
+        :param camera: 摄像头
+        :param face_id: 人脸 ID，None 表示该摄像头的所有人脸
         :return: None
         """
+        if face_id is None:
+            self._matches.clear(camera)
+        else:
+            self._matches.invalidate(camera, face_id)
+
+    def async_update_face_info(self, image: Optional[np.ndarray], face_info: FaceInfo) -> bool:
+        """
+        更新单个人脸还缺少的信息。任务队列已满时跳过，等下一帧再提交
+        :param image: 包含人脸的图片，None 表示使用人脸缓存的最好的截图
+        :param face_info: 人脸信息
+        :return: 是否提交了任务
+        """
+        update_name = face_info.stop_flags[0] and not face_info.name and not self.recall(face_info)
+        update_other = face_info.stop_flags[1] and not face_info.lost and \
+            None in (face_info.liveness, face_info.age, face_info.gender)
+        if not (update_name or update_other):
+            return False
         _logger.info("人脸 %d: 开始获取信息" % face_info.arc_face_info.face_id)
-        face_info.image = image
-        if face_info.stop_flags[0]:
+        if image is not None:
+            face_info.image = image
+        else:
+            face_info.use_shots(self._fuse_shots)
+        submitted = False
+        if update_name:
             _logger.debug("人脸 %d: 获取姓名" % face_info.arc_face_info.face_id)
             face_info.stop_flags[0] = False
-            future: Future = self._executors[0].submit(self._update_name, face_info)
-            future.add_done_callback(lambda x: FaceProcess._update_name_done(face_info, x))
+            future: Future = self._pool.try_submit(self._update_name, face_info)
+            if future is None:
+                _logger.debug("人脸 %d: 队列已满" % face_info.arc_face_info.face_id)
+                metrics.DROPPED_FRAMES.inc(source="extract_queue")
+                face_info.stop_flags[0] = True
+            else:
+                submitted = True
+                future.add_done_callback(lambda x: FaceProcess._update_name_done(face_info, x))
 
-        if face_info.stop_flags[1]:
+        if update_other:
             _logger.debug("人脸 %d: 活体检测、性别、年龄" % face_info.arc_face_info.face_id)
             face_info.stop_flags[1] = False
-            future: Future = self._executors[1].submit(self._update_other, face_info)
-            future.add_done_callback(lambda x: FaceProcess._update_other_done(face_info, x))
-    def _update_other(self, face_info: FaceInfo) -> Tuple[Optional[bool], Optional[int], Optional[Gender]]:
+            future: Future = self._pool.try_submit(self._update_other, face_info)
+            if future is None:
+                _logger.debug("人脸 %d: 队列已满" % face_info.arc_face_info.face_id)
+                metrics.DROPPED_FRAMES.inc(source="extract_queue")
+                face_info.stop_flags[1] = True
+            else:
+                submitted = True
+                future.add_done_callback(lambda x: FaceProcess._update_other_done(face_info, x))
+        if submitted:
+            face_info.attempts += 1
+        return submitted
+    def _update_other(self, arcface: ArcFace, face_info: FaceInfo) -> Tuple[Optional[bool], Optional[int], Optional[Gender]]:
         """
         更新其它信息，比如 活体、性别、年龄
+        :param arcface: 工作线程的引擎
         :param face_info:
         :return: 识别成功的信息数
         """
-        image, orient = face_info.image, face_info.arc_face_info.orient
+        image, arc_face_info = face_info.capture
         face_id = face_info.arc_face_info.face_id
-        arc_face_info = face_info.arc_face_info
         if face_info.stop_flags[1]:
             return None, None, None
-        if not self._arcface.process_face(
-                image,
-                arc_face_info,
-                ArcFace.LIVENESS | ArcFace.AGE | ArcFace.GENDER
-        ):
+        with metrics.stage("process_face"):
+            succeed = arcface.process_face(image, arc_face_info, ArcFace.LIVENESS | ArcFace.AGE | ArcFace.GENDER)
+        if not succeed:
             _logger.debug("人脸 %d: 处理失败" % face_id)
             return None, None, None
-        arcface = self._arcface
         return arcface.is_liveness(), arcface.get_age(), arcface.get_gender()
     @staticmethod
     def _update_other_done(face_info: FaceInfo, future: Future):
-        face_info.liveness, face_info.age, face_info.gender = future.result()
+        liveness, age, gender = future.result()
+        # 只补充缺少的信息，之前得到的不会被覆盖为 None
+        face_info.liveness = liveness if liveness is not None else face_info.liveness
+        face_info.age = age if age is not None else face_info.age
+        face_info.gender = gender if gender is not None else face_info.gender
         face_info.stop_flags[1] = True
-    def _update_name(self, face_info: FaceInfo) -> Tuple[str, float]:
+    def _update_name(self, arcface: ArcFace, face_info: FaceInfo) -> Tuple[str, float]:
         """
         提取特征，再在人脸数据库查找符合条件的特征
+        :param arcface: 工作线程的引擎
         :return: 成功返回 True，失败返回 False
         """
-        image, orient = face_info.image, face_info.arc_face_info.orient
         face_id = face_info.arc_face_info.face_id
-        arc_face_info = face_info.arc_face_info
-        feature = self._arcface.extract_feature(image, arc_face_info)
+        gallery = self._gallery
+        match = None if face_info.lost else self._matches.get(face_info.camera, face_id)
+        if match is not None:
+            # 人脸库变化了，用缓存的特征值重新检索，不需要再提取特征
+            feature = match.feature
+        else:
+            with metrics.stage("extract_feature"):
+                features = [arcface.extract_feature(image, arc_face_info) for image, arc_face_info in face_info.captures]
+            features = [feature for feature in features if feature]
+            # 多张截图时融合它们的特征
+            feature = fuse_features(features) if features else b""
         if not feature:
             _logger.debug("人脸 %d: 提取特征值失败(%s)" % (face_id, "%dx%d" % face_info.rect.size))
             return "", 0.0
@@ -158,95 +369,250 @@ class FaceProcess:
             _logger.debug("人脸 %d: 取消识别人脸" % face_id)
             return "", 0.0
 
-        max_threshold = 0.0
-        opt_name = ""
-        for name, feature_ in self._features.items():
-            threshold = self._arcface.compare_feature(feature, feature_)
-            if max_threshold < threshold:
-                max_threshold = threshold
-                opt_name = name
+        with metrics.stage("gallery_match"):
+            vector = decode_feature(feature)
+            matches = self._match_recent(gallery, vector, face_info)
+            if matches is None:
+                # 与整个人脸库一次性对比
+                matches = gallery.search(feature, k=1)
+        opt_name, max_threshold = matches[0] if matches else ("", 0.0)
         #相似度阈值
-        if 0.6 < max_threshold:
+        if FaceProcess.MATCH_THRESHOLD < max_threshold:
             _logger.debug("人脸 %d: 识别成功，与 %s 相似度 %.2f" % (face_id, opt_name, max_threshold))
-            url = "http://127.0.0.1:8000/checkedface/"
-            info = {'id': opt_name}
-            r = requests.post(url, data=info)
-
+            self._recent.add(vector, opt_name, face_info.camera)
+            if not face_info.lost:
+                self._matches.put(face_info.camera, face_id,
+                                  Match(opt_name, max_threshold, feature, gallery.version, time.time()))
+            # 识别事件在后台批量发送，不阻塞识别线程
+            self._dispatcher.dispatch(RecognitionEvent(opt_name, face_id, max_threshold, face_info.camera, time.time()))
             return opt_name, max_threshold
         _logger.debug("人脸 %d: 识别失败，与最像的 %s 的相似度 %.2f" % (face_id, opt_name, max_threshold))
+        if match is not None:
+            self._matches.invalidate(face_info.camera, face_id)
         return "", 0.0
+    def _match_recent(
+            self,
+            gallery: FeatureGallery,
+            vector: np.ndarray,
+            face_info: FaceInfo
+    ) -> Optional[List[Tuple[str, float]]]:
+        """
+        先与最近识别成功的人比较，再与人脸库中这个人的特征核对
+        只核对了一个人，可能有另一个人更像；只有明显超过识别阈值时才采用，否则检索整个人脸库
+        :return: 与 FeatureGallery.search 的结果相同，没有命中时返回 None
+        """
+        recent = self._recent.match(vector)
+        if recent is None:
+            metrics.RECENT_PROBES.inc(result="miss")
+            return None
+        name, _, camera = recent
+        score = gallery.similarity(name, vector)
+        if score is None:
+            self._recent.remove(name)
+        if score is None or score <= FaceProcess.MATCH_THRESHOLD + FaceProcess.RECENT_MARGIN:
+            # 已经退房、只是与最近的探针相像，或者不够确定
+            metrics.RECENT_PROBES.inc(result="rejected")
+            return None
+        metrics.RECENT_PROBES.inc(result="hit")
+        _logger.debug("人脸 %d: 摄像头 %s 最近见过 %s" % (face_info.arc_face_info.face_id, camera, name))
+        return [(name, score)]
     @staticmethod
     def _update_name_done(face_info: FaceInfo, future: Future):
         face_info.name, face_info.threshold = future.result()
+        if face_info.name:
+            face_info.failures = 0
+        else:
+            # 提取失败或者没有匹配的人，推迟下一次提交
+            face_info.record_failure()
         face_info.stop_flags[0] = True
 
 
-    def load_features(self) -> int:
+    def load_features(self, stop_event: threading.Event = None) -> int:
         """
-        从数据库加载数据
-        :param filename: 保存人脸数据库的文件名
+        从数据库同步人脸特征
+        第一次全量加载，之后只查询水位线(updated)之后新增、修改或者删除的记录，
+        再以整体替换的方式发布新的人脸库
+        配置 gallery-source 为 store 时改为从二进制特征库文件同步
+        :param stop_event: 设置后停止同步，None 时只在配置的 server-on 为 0 时停止
         :return: 加载的人脸数
         """
-        while True:
-            with open("profile.yml", "r", encoding="utf-8") as file:
-                profile: Dict[str, str] = yaml.load(file, yaml.Loader)
-                server_on = profile["server-on"].encode()
-                host = profile["database"]["host"].encode()
-                user = profile["database"]["user"].encode()
-                password = profile["database"]["password"].encode()
-                base = profile["database"]["base"].encode()
+        stop_event = stop_event or threading.Event()
+        if get_profile().gallery_source == "store":
+            return self._load_features_from_store(stop_event)
+        conn = None
+        watermark = None
+        try:
+            while not stop_event.is_set():
+                profile = get_profile()
+                if not profile.server_on:
+                    break
+                try:
+                    if conn is None:
+                        database = profile.database
+                        conn = pymysql.connect(
+                            host=database.host, user=database.user, password=database.password,
+                            database=database.base, charset='utf8', autocommit=True
+                        )
+                    else:
+                        conn.ping(reconnect=True)
+                    watermark = self._sync_features(conn, watermark)
+                except pymysql.MySQLError as e:
+                    _logger.warning("同步人脸特征失败: %s" % e)
+                    if conn is not None:
+                        conn.close()
+                    conn = None
+                stop_event.wait(FaceProcess.SYNC_INTERVAL)
+        finally:
+            if conn is not None:
+                conn.close()
+        return self.count
 
-            if server_on == 0:
-                break
-            conn = pymysql.connect(host, user, password, base, charset='utf8')
-            cursor = conn.cursor()
-            sql = "SELECT * FROM FACE_FEATURE"
-            self.count = 0
-            try:
-                cursor.execute(sql)
-                # 获取所有记录列表
-                results = cursor.fetchall()
-                for row in results:
-                    id = row[0]
-                    feature = base64.b64decode(row[1])
-                    self._features[id] = feature
-                    self.count += 1
-            except:
-                print("Error: unable to fecth data")
-            conn.close()
-            _logger.info("从数据库中加载了 %d 个特征值" % (self.count))
-            time.sleep(30)
+    def _sync_features(self, conn, watermark: Optional[datetime.datetime]) -> datetime.datetime:
+        """
+        同步一次人脸特征
+        :param conn: 数据库连接
+        :param watermark: 上一次同步到的修改时间，None 表示全量加载
+        :return: 新的水位线
+        """
+        with conn.cursor() as cursor:
+            if watermark is None:
+                cursor.execute("SELECT id, Value, updated FROM FACE_FEATURE WHERE removed = 0")
+                rows = cursor.fetchall()
+                self._set_gallery({row[0]: base64.b64decode(row[1]) for row in rows})
+                self.count = len(self._gallery)
+                _logger.info("从数据库中加载了 %d 个特征值" % self.count)
+                return max((row[2] for row in rows), default=datetime.datetime(1970, 1, 1))
+            # 往前多查询一段时间，防止漏掉提交较晚的事务，重复的记录不会引起修改
+            cursor.execute(
+                "SELECT id, Value, updated, removed FROM FACE_FEATURE WHERE updated >= %s",
+                (watermark - FaceProcess.SYNC_OVERLAP,)
+            )
+            rows = cursor.fetchall()
+        upserts = {row[0]: base64.b64decode(row[1]) for row in rows if not row[3]}
+        removals = [row[0] for row in rows if row[3]]
+        gallery = self._gallery.apply(upserts, removals)
+        if gallery is not self._gallery:
+            self._publish_gallery(gallery)
+            _logger.info("人脸库已更新，共 %d 个特征值" % self.count)
+        return max((row[2] for row in rows), default=watermark)
 
+    def _load_features_from_store(self, stop_event: threading.Event) -> int:
+        """
+        从二进制特征库文件同步人脸特征
+        特征矩阵以内存映射的方式加载，之后只读取追加日志中新增的记录
+        :param stop_event: 设置后停止同步
+        :return: 加载的人脸数
+        """
+        store = FeatureStore(get_profile().feature_store)
+        generation, offset = None, 0
+        while get_profile().server_on and not stop_event.is_set():
+            if store.generation() != generation:
+                gallery, generation, offset = store.load()
+                self._publish_gallery(gallery)
+                _logger.info("从特征库文件中加载了 %d 个特征值" % self.count)
+            else:
+                upserts, removals, offset = store.changes(generation, offset)
+                gallery = self._gallery.apply(upserts, removals)
+                if gallery is not self._gallery:
+                    self._publish_gallery(gallery)
+                    _logger.info("人脸库已更新，共 %d 个特征值" % self.count)
+            if FeatureStore.COMPACT_THRESHOLD < store.log_records():
+                store.compact()
+            stop_event.wait(FaceProcess.SYNC_INTERVAL)
+        return self.count
 
-    def add_person(self, filename: str):
-        features = {}
-        name: str = os.path.basename(filename)
-        name: str = name.split(".")[0]
-        faces_number, features_ = self._load_features_from_image(name, read_image(filename))
+    def _publish_gallery(self, gallery: FeatureGallery) -> None:
+        """
+        用新的人脸库整体替换当前的人脸库，保留原有的校准参数
+        人脸库的相似度是余弦相似度，MATCH_THRESHOLD 是 SDK compare_feature 的尺度，还没有校准时先校准
+        配置了近似检索时，在替换之前建立索引；增量修改的人脸库沿用并更新原来的索引
+        :param gallery: 新的人脸库
+        :return: None
+        """
+        config = get_profile().gallery_index
+        if isinstance(gallery.index, ExactIndex) and config.type != "exact" and config.min_size <= len(gallery):
+            # 索引按行号建立，先去掉删除的行
+            gallery = gallery.compact()
+            gallery.set_index(create_index(
+                config.type, gallery.matrix, config.nlist, config.nprobe, config.min_size, config.rerank))
+        if self._calibrated:
+            gallery.scale, gallery.bias = self._gallery.scale, self._gallery.bias
+        else:
+            self._calibrated = self._calibrate(gallery, FaceProcess.CALIBRATION_SAMPLES)
+        self._gallery = gallery
+        self.count = len(gallery)
+
+    def _set_gallery(self, features: Dict[str, bytes]) -> None:
+        """
+        用新的特征值替换人脸库，保留原有的校准参数
+        :param features: Dict[姓名, 特征值]
+        :return: None
+        """
+        self._publish_gallery(FeatureGallery(features))
+
+    def _calibrate(self, gallery: FeatureGallery, samples: int) -> bool:
+        """
+        在发布之前使用 SDK 的 compare_feature 校准人脸库的相似度，失败时使用未校准的相似度，下一次发布时再校准
+        :param gallery: 新的人脸库
+        :param samples: 抽取的特征值对数
+        :return: 是否校准成功
+        """
+        if len(gallery) < 2:
+            return False
+        try:
+            result = self._pool.submit(lambda arcface: gallery.calibrate(arcface, samples)).result()
+        except Exception as e:
+            _logger.warning("校准人脸库的相似度失败: %s" % e)
+            return False
+        return 0 < result["samples"]
+
+    def submit_enrollment(self, name: str, image: np.ndarray) -> Future:
+        """
+        在引擎池中提取一张登记照片中的所有人脸特征，引擎池的队列满时阻塞
+        :param name: 图片中人的名字
+        :param image: 登记的照片
+        :return: 结果为 (总的人脸数, Dict[姓名, 特征值]) 的 Future
+        """
+        return self._pool.submit(self._load_features_from_image, name, image)
+
+    def add_person_image(self, name: str, image: np.ndarray) -> Tuple[int, str]:
+        """
+        从已经解码的登记照片中提取特征值，不经过文件
+        人脸库不在这里修改，登记的特征值保存到数据库后由同步线程加入人脸库
+        :param name: 客人的 ID
+        :param image: 登记的照片
+        :return: 人脸数, base64 编码的特征值(人脸数不为 1 时为 "None")
+        """
+        faces_number, features = self.submit_enrollment(name, image).result()
         if faces_number == 1:
-            features.update(features_)
-            for name, feature in features_.items():
+            for feature in features.values():
                 return faces_number, base64.b64encode(feature).decode()
-        self._features.update(features)
         return faces_number, "None"
 
-    def _load_features_from_image(self, name: str, image: np.ndarray) -> Tuple[int, Dict[str, bytes]]:
+    @staticmethod
+    def _load_features_from_image(
+            arcface: ArcFace,
+            name: str,
+            image: np.ndarray
+    ) -> Tuple[int, Dict[str, bytes]]:
         """
         从图片中加载特征值
         如果 name 为空，名字按数字编号来
         否则，如果只有一个特征，使用 name 的值作为名称
         否则，使用 <name-数字编号> 来命名
+        :param arcface: 工作线程的引擎
         :param name: 图片中人的名字
         :param image: 需要提取特征的图片
         :return: 总的人脸数（包含不清晰无法提取特征值的人脸）, Dict[姓名, 特征值]
         """
         if image.size == 0:
             return 0, {}
-        image = image_regularization(image)
+        # 手机拍摄的大图缩小后再检测，登记照片中的人脸足够大
+        image = image_regularization(image, FaceProcess.ENROLL_IMAGE_SIZE)
         # 检测人脸位置
-        faces = self._arcface.detect_faces(image)
+        faces = arcface.detect_faces(image)
         # 提取所有人脸特征
-        features = map(lambda x: self._arcface.extract_feature(image, x), faces)
+        features = map(lambda x: arcface.extract_feature(image, x), faces)
         # 删除空的人脸特征
         features = list(filter(lambda feature: feature, features))
 
@@ -269,9 +635,9 @@ class FaceProcess:
 
         return len(faces), assemble()
     def release(self):
-        for executor in self._executors:
-            executor.shutdown()
-        self._arcface.release()
+        self._pool.release()
+        if self._dispatcher is not None:
+            self._dispatcher.close()
     def __enter__(self):
         return self
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -0,0 +1,318 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from module.gallery import FEATURE_HEADER_SIZE, FeatureGallery, _random_features, decode_feature, sort_names
+
+_logger = logging.getLogger(__name__)
+
+
+class _FileLock:
+    """
+    基于独占创建文件的跨进程锁，Windows 和 Linux 通用
+    """
+    def __init__(self, path: str, timeout: float = 10.0, stale: float = 30.0):
+        self._path = path
+        self._timeout = timeout
+        self._stale = stale
+
+    def __enter__(self):
+        deadline = time.time() + self._timeout
+        while True:
+            try:
+                os.close(os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if self._stale < time.time() - os.path.getmtime(self._path):
+                        # 持有锁的进程异常退出了
+                        os.remove(self._path)
+                        continue
+                except OSError:
+                    continue
+            if deadline < time.time():
+                raise TimeoutError("等待文件锁超时 \"%s\"" % self._path)
+            time.sleep(0.01)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        os.remove(self._path)
+
+
+class FeatureStore:
+    """
+    二进制的人脸特征库文件
+    目录中包含:
+        CURRENT             当前的版本号
+        meta.json           特征维数和 SDK 特征值的头部
+        features-<版本>.npy  定长的 float32 特征矩阵(已归一化)，以只读内存映射的方式加载
+        ids-<版本>.npy       与矩阵每一行对应的姓名(定长的字符串数组)，同样以内存映射的方式加载
+        order-<版本>.npy     按姓名排序的行号，回放日志时二分查找姓名，不需要遍历 ids
+        log-<版本>.bin       定长记录的追加日志，记录入住(新增)和退房(删除)
+    合并日志时写入新版本的文件再切换 CURRENT，不会覆盖其它进程正在映射的文件
+    """
+    ID_SIZE = 40  # 与 Feature.id 的 max_length 一致
+    COMPACT_THRESHOLD = 1024  # 日志记录数超过后需要合并
+    _ADD = b"A"
+    _REMOVE = b"R"
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._meta: Optional[Dict] = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._directory, name)
+
+    def _lock(self) -> _FileLock:
+        return _FileLock(self._path(".lock"))
+
+    def generation(self) -> int:
+        """
+        :return: 当前的版本号
+        """
+        try:
+            with open(self._path("CURRENT"), "r") as file:
+                return int(file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _load_meta(self) -> Optional[Dict]:
+        if self._meta is None and os.path.exists(self._path("meta.json")):
+            with open(self._path("meta.json"), "r") as file:
+                self._meta = json.load(file)
+        return self._meta
+
+    def _ensure_meta(self, feature: bytes) -> Dict:
+        meta = self._load_meta()
+        if meta is None:
+            dim = (len(feature) - FEATURE_HEADER_SIZE) // 4
+            meta = {"dim": dim, "header": feature[:FEATURE_HEADER_SIZE].hex()}
+            with open(self._path("meta.json.tmp"), "w") as file:
+                json.dump(meta, file)
+            os.replace(self._path("meta.json.tmp"), self._path("meta.json"))
+            self._meta = meta
+        return meta
+
+    def _record_size(self, dim: int) -> int:
+        return 1 + FeatureStore.ID_SIZE + dim * 4
+
+    @staticmethod
+    def _record(op: bytes, name: str, vector: np.ndarray) -> bytes:
+        encoded = name.encode("utf-8")
+        assert len(encoded) <= FeatureStore.ID_SIZE, "姓名过长 \"%s\"" % name
+        return op + encoded.ljust(FeatureStore.ID_SIZE, b"\0") + vector.astype(np.float32).tobytes()
+
+    def _append(self, records: bytes) -> None:
+        with self._lock():
+            with open(self._path("log-%d.bin" % self.generation()), "ab") as file:
+                file.write(records)
+
+    def add(self, name: str, feature: bytes) -> None:
+        """
+        新增或者修改一个人的特征值(入住)
+        :param name: 姓名
+        :param feature: SDK 的特征值
+        :return: None
+        """
+        self.add_many({name: feature})
+
+    def add_many(self, features: Dict[str, bytes]) -> None:
+        """
+        批量新增或者修改特征值，所有记录一次写入日志
+        :param features: Dict[姓名, SDK 的特征值]
+        :return: None
+        """
+        if not features:
+            return
+        meta = self._ensure_meta(next(iter(features.values())))
+        records = []
+        for name, feature in features.items():
+            vector = decode_feature(feature)
+            assert vector.size == meta["dim"], "特征维数(%d)与特征库(%d)不一致" % (vector.size, meta["dim"])
+            records.append(FeatureStore._record(FeatureStore._ADD, name, vector))
+        self._append(b"".join(records))
+
+    def remove(self, name: str) -> None:
+        """
+        删除一个人的特征值(退房)
+        :param name: 姓名
+        :return: None
+        """
+        meta = self._load_meta()
+        if meta is None:
+            return
+        self._append(FeatureStore._record(FeatureStore._REMOVE, name, np.zeros(meta["dim"], dtype=np.float32)))
+
+    def _read_log(self, generation: int, offset: int) -> Tuple[Dict[str, bytes], List[str], int]:
+        """
+        读取日志中 offset 之后的完整记录
+        :return: 新增的特征值, 删除的姓名, 新的 offset
+        """
+        meta = self._load_meta()
+        upserts, removals = {}, []
+        if meta is None:
+            return upserts, removals, offset
+        header = bytes.fromhex(meta["header"])
+        size = self._record_size(meta["dim"])
+        try:
+            with open(self._path("log-%d.bin" % generation), "rb") as file:
+                file.seek(offset)
+                data = file.read()
+        except FileNotFoundError:
+            return upserts, removals, offset
+        # 忽略最后一条还没写完的记录
+        count = len(data) // size
+        for i in range(count):
+            record = data[i * size:(i + 1) * size]
+            op, name = record[:1], record[1:1 + FeatureStore.ID_SIZE].rstrip(b"\0").decode("utf-8")
+            if op == FeatureStore._ADD:
+                upserts[name] = header + record[1 + FeatureStore.ID_SIZE:]
+                if name in removals:
+                    removals.remove(name)
+            else:
+                upserts.pop(name, None)
+                removals.append(name)
+        return upserts, removals, offset + count * size
+
+    def load(self) -> Tuple[FeatureGallery, int, int]:
+        """
+        加载特征库。特征矩阵以只读内存映射的方式加载，日志为空时不会拷贝矩阵
+        :return: 特征库, 版本号, 已读取的日志长度
+        """
+        generation = self.generation()
+        meta = self._load_meta()
+        if meta is None:
+            return FeatureGallery(), generation, 0
+        header = bytes.fromhex(meta["header"])
+        matrix_file = self._path("features-%d.npy" % generation)
+        if os.path.exists(matrix_file):
+            matrix = np.load(matrix_file, mmap_mode="r")
+            names = np.load(self._path("ids-%d.npy" % generation), mmap_mode="r")
+            # 旧版本的文件没有排序索引
+            order_file = self._path("order-%d.npy" % generation)
+            order = np.load(order_file, mmap_mode="r") if os.path.exists(order_file) else None
+        else:
+            matrix, names, order = np.zeros((0, meta["dim"]), dtype=np.float32), [], None
+        gallery = FeatureGallery.from_matrix(names, matrix, header, order)
+        upserts, removals, offset = self._read_log(generation, 0)
+        return gallery.apply(upserts, removals), generation, offset
+
+    def changes(self, generation: int, offset: int) -> Tuple[Dict[str, bytes], List[str], int]:
+        """
+        读取某个版本的日志中 offset 之后的修改
+        :param generation: 版本号
+        :param offset: 已读取的日志长度
+        :return: 新增的特征值, 删除的姓名, 新的 offset
+        """
+        return self._read_log(generation, offset)
+
+    def log_records(self) -> int:
+        """
+        :return: 当前版本的日志记录数
+        """
+        meta = self._load_meta()
+        if meta is None:
+            return 0
+        try:
+            size = os.path.getsize(self._path("log-%d.bin" % self.generation()))
+        except FileNotFoundError:
+            return 0
+        return size // self._record_size(meta["dim"])
+
+    def _write_generation(self, generation: int, names: Sequence[str], matrix: np.ndarray) -> None:
+        """
+        写入新版本的特征矩阵和空的日志，再切换 CURRENT
+        :param generation: 新的版本号
+        :param names: 与矩阵每一行对应的姓名
+        :param matrix: 归一化的特征矩阵
+        :return: None
+        """
+        np.save(self._path("features-%d.npy" % generation), matrix)
+        names = np.array([str(name) for name in names], dtype="<U%d" % FeatureStore.ID_SIZE)
+        np.save(self._path("ids-%d.npy" % generation), names)
+        np.save(self._path("order-%d.npy" % generation), sort_names(names))
+        open(self._path("log-%d.bin" % generation), "wb").close()
+        with open(self._path("CURRENT.tmp"), "w") as file:
+            file.write("%d" % generation)
+        os.replace(self._path("CURRENT.tmp"), self._path("CURRENT"))
+
+    def compact(self) -> int:
+        """
+        将日志合并到新版本的特征矩阵中
+        :return: 新的版本号
+        """
+        with self._lock():
+            gallery, generation, _ = self.load()
+            new_generation = generation + 1
+            matrix = np.asarray(gallery.matrix, dtype=np.float32)
+            if matrix.size == 0:
+                matrix = np.zeros((0, self._load_meta()["dim"]), dtype=np.float32)
+            self._write_generation(new_generation, gallery.names, matrix)
+        # 旧版本的文件可能还被其它进程映射着，删除失败就留到下次
+        for name in ("features-%d.npy", "ids-%d.npy", "order-%d.npy", "log-%d.bin"):
+            try:
+                os.remove(self._path(name % generation))
+            except OSError:
+                pass
+        _logger.info("特征库合并到版本 %d，共 %d 个特征值" % (new_generation, len(gallery)))
+        return new_generation
+
+
+def benchmark(sizes: List[int], dim: int = 256, log_records: int = 100, repeat: int = 3,
+              output=print) -> Dict[int, float]:
+    """
+    测试启动时加载特征库的耗时: 内存映射的特征矩阵加上一段非空的日志
+    日志中一半是修改已有的人，一半是新增的人，另外删除几个已有的人
+    :param sizes: 特征矩阵的行数
+    :param dim: 特征维数
+    :param log_records: 日志的记录数
+    :param repeat: 每种规模加载的次数，取最快的一次
+    :param output: 输出方式
+    :return: Dict[规模, 加载的耗时(秒)]
+    """
+    results = {}
+    header = np.zeros(FEATURE_HEADER_SIZE, dtype=np.uint8).tobytes()
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            store = FeatureStore(directory)
+            matrix = _random_features(size + log_records, dim)
+            store._ensure_meta(header + matrix[0].tobytes())
+            store._write_generation(1, ["guest-%d" % i for i in range(size)], matrix[:size])
+            rng = np.random.RandomState(0)
+            changed = rng.choice(size, min(size, log_records // 2), replace=False)
+            upserts = {"guest-%d" % i: header + matrix[size + j].tobytes() for j, i in enumerate(changed)}
+            upserts.update(("new-%d" % i, header + matrix[size + i].tobytes())
+                           for i in range(len(changed), log_records))
+            store.add_many(upserts)
+            for i in rng.choice(size, min(size, 10), replace=False):
+                store.remove("guest-%d" % i)
+            costs = []
+            for _ in range(repeat):
+                begin_time = time.perf_counter()
+                gallery, _, _ = store.load()
+                costs.append(time.perf_counter() - begin_time)
+                del gallery
+            results[size] = min(costs)
+            output("%8d 人 + %d 条日志: 加载 %.1f ms" % (size, store.log_records(), results[size] * 1000))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="特征库文件的加载测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--log-records", type=int, default=100, help="日志的记录数")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    benchmark(args.sizes, args.dim, args.log_records, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+WebSocket(RFC 6455) 的握手和封帧
+只实现视频推送需要的部分: 服务端发送的帧不分片、不加掩码；客户端发送的帧必须有掩码
+"""
+import base64
+import hashlib
+import struct
+from typing import Optional, Tuple
+
+_FIN = 0x80
+_MASK = 0x80
+_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+
+def accept_key(key: str) -> str:
+    """
+    :param key: 客户端握手请求中的 Sec-WebSocket-Key
+    :return: 握手响应中的 Sec-WebSocket-Accept
+    """
+    return base64.b64encode(hashlib.sha1(key.strip().encode() + _GUID).digest()).decode()
+
+
+def encode_frame(opcode: int, payload: bytes) -> bytes:
+    """
+    生成 WebSocket 帧(服务端发送的帧不需要掩码)
+    :param opcode: 帧的类型
+    :param payload: 帧的数据
+    :return: 包含帧头的完整数据
+    """
+    length = len(payload)
+    if length <= 125:
+        header = struct.pack(">BB", _FIN | opcode, length)
+    elif length <= 0xFFFF:
+        header = struct.pack(">BBH", _FIN | opcode, 126, length)
+    else:
+        header = struct.pack(">BBQ", _FIN | opcode, 127, length)
+    return header + payload
+
+
+def binary_frame(payload: bytes) -> bytes:
+    return encode_frame(OPCODE_BINARY, payload)
+
+
+def text_frame(text: str) -> bytes:
+    return encode_frame(OPCODE_TEXT, text.encode("utf-8"))
+
+
+def close_frame(code: int = CLOSE_NORMAL, reason: str = "") -> bytes:
+    return encode_frame(OPCODE_CLOSE, struct.pack(">H", code) + reason.encode("utf-8")[:123])
+
+
+def parse_header(head: bytes) -> Tuple[bool, int, bool, int]:
+    """
+    :param head: 帧的前两个字节
+    :return: (是否是最后一个分片, 帧的类型, 是否有掩码, 长度字段: 0~125 为长度，126/127 表示后面还有 2/8 个字节的长度)
+    """
+    first, second = head[0], head[1]
+    return bool(first & _FIN), first & 0x0F, bool(second & _MASK), second & 0x7F
+
+
+def unmask(payload: bytes, mask: bytes) -> bytes:
+    """
+    :param payload: 客户端发送的数据
+    :param mask: 4 个字节的掩码
+    :return: 原始数据
+    """
+    if not payload:
+        return payload
+    repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")).to_bytes(len(payload), "big")
+
+
+def close_code(payload: bytes) -> Optional[int]:
+    """
+    :param payload: 关闭帧的数据
+    :return: 关闭的状态码，没有时返回 None
+    """
+    return struct.unpack(">H", payload[:2])[0] if len(payload) >= 2 else None
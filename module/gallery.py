@@ -0,0 +1,507 @@
+import argparse
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from module.gallery_index import EXACT_INDEX, GalleryIndex, IVFIndex, Int8Index, RowBuffer, recall_at_k, quantize_int8
+
+_logger = logging.getLogger(__name__)
+
+# ArcFace 特征值的格式: 8 字节的头部 + float32 的特征向量
+FEATURE_HEADER_SIZE = 8
+
+_versions = itertools.count(1)  # 每个新的特征库的版本号
+
+
+def decode_feature(feature: bytes) -> np.ndarray:
+    """
+    将 SDK 输出的特征值解码为归一化的 float32 向量
+    :param feature: SDK 提取到的特征值
+    :return: 归一化后的特征向量
+    """
+    vector = np.frombuffer(feature, dtype=np.float32, offset=FEATURE_HEADER_SIZE)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector.copy()
+    return vector / norm
+
+
+def fuse_features(features: List[bytes]) -> bytes:
+    """
+    融合同一个人的多个特征值: 归一化后取平均再归一化
+    :param features: SDK 提取到的特征值，至少一个
+    :return: 与 SDK 格式相同的特征值，头部使用第一个特征值的
+    """
+    if len(features) == 1:
+        return features[0]
+    vector = np.mean([decode_feature(feature) for feature in features], axis=0)
+    norm = np.linalg.norm(vector)
+    if norm != 0:
+        vector = vector / norm
+    return features[0][:FEATURE_HEADER_SIZE] + vector.astype(np.float32).tobytes()
+
+
+class _Names:
+    """
+    特征库之间共享的姓名表: 行号到姓名，以及姓名到最新的行号
+    base 是创建时的姓名，可以是内存映射的字符串数组，不会被修改；之后追加的姓名保存在 extra 中
+    base 是字符串数组时不在 Python 中遍历整个数组，只查找用到的姓名并缓存行号:
+    有排序索引(order)时二分查找，否则在 C 中一次比较整个数组
+    与 RowBuffer 一样，只有最新的特征库(行数等于姓名数)可以原地追加，否则先拷贝 extra
+    """
+    _MISSING = -1
+
+    def __init__(
+            self,
+            base: Sequence[str],
+            extra: List[str] = None,
+            base_rows: Dict[str, int] = None,
+            order: np.ndarray = None
+    ):
+        """
+        :param base: 行号到姓名，可以是内存映射的字符串数组
+        :param extra: 追加在 base 之后的姓名
+        :param base_rows: 已经查找过的 base 中的行号，base 相同的姓名表之间共享
+        :param order: 按姓名排序 base 的行号(稳定排序)，可以是内存映射的数组
+        """
+        self.base = base
+        self.extra = extra if extra is not None else []
+        self._order = order
+        self._extra_rows = {name: len(base) + i for i, name in enumerate(self.extra)}
+        self._base_rows = base_rows
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.extra)
+
+    def __getitem__(self, row: int) -> str:
+        return str(self.base[row]) if row < len(self.base) else self.extra[row - len(self.base)]
+
+    def head(self, size: int) -> Sequence[str]:
+        """
+        :return: 前 size 行的姓名
+        """
+        if size <= len(self.base):
+            return self.base[:size]
+        return [str(name) for name in self.base] + self.extra[:size - len(self.base)]
+
+    def row(self, name: str) -> Optional[int]:
+        """
+        :return: 姓名最新的行号，同一个人的新行在后面，覆盖旧的行号
+        """
+        row = self._extra_rows.get(name)
+        if row is not None:
+            return row
+        if self._base_rows is None or (not isinstance(self.base, list) and name not in self._base_rows):
+            self.lookup([name])
+        row = self._base_rows.get(name, _Names._MISSING)
+        return None if row == _Names._MISSING else row
+
+    def lookup(self, names: Iterable[str]) -> None:
+        """
+        预先查找一批姓名在 base 中的行号
+        base 是列表时第一次就建立所有姓名的字典，检索时不需要；字符串数组只查找这一批姓名
+        :param names: 姓名
+        :return: None
+        """
+        with self._lock:
+            if isinstance(self.base, list):
+                if self._base_rows is None:
+                    self._base_rows = {str(name): i for i, name in enumerate(self.base)}
+                return
+            base_rows = self._base_rows if self._base_rows is not None else {}
+            names = [name for name in set(names) if name not in base_rows and name not in self._extra_rows]
+            if self._order is not None:
+                for name in names:
+                    base_rows[name] = self._search(name)
+            elif names:
+                for name in names:
+                    base_rows[name] = _Names._MISSING
+                # 行号从小到大，同一个人后面的行覆盖前面的
+                for row in np.flatnonzero(np.isin(self.base, names)):
+                    base_rows[str(self.base[row])] = int(row)
+            self._base_rows = base_rows
+
+    def _search(self, name: str) -> int:
+        """
+        在排序索引中二分查找
+        :return: 姓名在 base 中最后的行号，没有时返回 _MISSING
+        """
+        base, order = self.base, self._order
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if str(base[order[middle]]) <= name:
+                low = middle + 1
+            else:
+                high = middle
+        # 稳定排序，同名的行中最后一个行号最大
+        if low == 0 or str(base[order[low - 1]]) != name:
+            return _Names._MISSING
+        return int(order[low - 1])
+
+    def append(self, size: int, names: List[str]) -> "_Names":
+        """
+        :param size: 调用方特征库的行数
+        :param names: 新增的行的姓名
+        :return: 包含新增的行的姓名表，可能是自身
+        """
+        with self._lock:
+            if len(self) == size:
+                self._extra_rows.update((name, size + i) for i, name in enumerate(names))
+                self.extra.extend(names)
+                return self
+            base_rows = self._base_rows
+        return _Names(self.base, self.extra[:size - len(self.base)] + names, base_rows, self._order)
+
+
+def sort_names(names: np.ndarray) -> np.ndarray:
+    """
+    :param names: 字符串数组
+    :return: 按姓名稳定排序的行号，用于 FeatureGallery.from_matrix
+    """
+    return np.argsort(names, kind="stable").astype(np.int64)
+
+
+class FeatureGallery:
+    """
+    人脸特征库，所有特征值解码后保存在一个连续的 float32 矩阵中
+    一次矩阵乘法就可以得到探针与整个特征库的相似度，代替逐个调用 compare_feature
+    矩阵也可以是只读的内存映射文件，见 module.feature_store
+    检索方式由 index 决定(暴力检索或者近似检索)，见 module.gallery_index
+    特征库不会被修改，每个新的特征库有不同的 version，用于判断缓存的识别结果是否失效
+    增量修改只在共享的缓冲区末尾追加新的行，删除和被替换的行用 live 掩码屏蔽，
+    删除的行超过 COMPACT_RATIO 时才压缩一次。旧的特征库只读取自己的前 size 行，不受追加的影响，
+    但是查询旧的特征库中之后被替换的人时会当作不存在
+    """
+    COMPACT_RATIO = 0.25
+
+    def __init__(self, features: Dict[str, bytes] = None):
+        features = features if features is not None else {}
+        matrix = FeatureGallery._build_matrix(features.values())
+        self._set(RowBuffer(matrix), len(matrix), _Names(list(features.keys())))
+        self._header = next(iter(features.values()), b"")[:FEATURE_HEADER_SIZE]
+        # 与 SDK 的相似度之间的线性校准: sdk_score ≈ scale * score + bias
+        self.scale = 1.0
+        self.bias = 0.0
+
+    @staticmethod
+    def from_matrix(
+            names: Sequence[str],
+            matrix: np.ndarray,
+            header: bytes = b"",
+            order: np.ndarray = None
+    ) -> "FeatureGallery":
+        """
+        直接使用已经解码、归一化的特征矩阵，不会拷贝矩阵
+        :param names: 与矩阵每一行对应的姓名，可以是内存映射的字符串数组
+        :param matrix: 特征矩阵，可以是内存映射的数组
+        :param header: SDK 特征值的头部，用于还原特征值
+        :param order: 按姓名稳定排序的行号(见 sort_names)，有时按姓名查找不需要遍历 names
+        :return: 特征库
+        """
+        assert len(names) == len(matrix), "姓名数与特征数不一致"
+        return FeatureGallery._snapshot(RowBuffer(matrix), len(matrix), _Names(names, order=order), None, header)
+
+    @staticmethod
+    def _snapshot(
+            buffer: RowBuffer,
+            size: int,
+            names: _Names,
+            live: Optional[np.ndarray],
+            header: bytes,
+            index: GalleryIndex = EXACT_INDEX
+    ) -> "FeatureGallery":
+        gallery = FeatureGallery()
+        gallery._set(buffer, size, names, live, index)
+        gallery._header = header
+        return gallery
+
+    def _set(
+            self,
+            buffer: RowBuffer,
+            size: int,
+            names: _Names,
+            live: np.ndarray = None,
+            index: GalleryIndex = EXACT_INDEX
+    ) -> None:
+        self._buffer = buffer
+        self._size = size
+        self._names = names
+        self._live = live  # 每一行是否有效，None 表示没有删除的行
+        self._removed = 0 if live is None else size - int(np.count_nonzero(live))
+        self._search_index = index
+        self.version = next(_versions)
+
+    @property
+    def _matrix(self) -> np.ndarray:
+        # 包括删除的行
+        return self._buffer.view(self._size)
+
+    def _row(self, name: str) -> Optional[int]:
+        row = self._names.row(name)
+        if row is None or self._size <= row or (self._live is not None and not self._live[row]):
+            return None
+        return row
+
+    @staticmethod
+    def _build_matrix(features: Iterable[bytes]) -> np.ndarray:
+        vectors = [decode_feature(feature) for feature in features]
+        if len(vectors) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.ascontiguousarray(np.stack(vectors), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self._size - self._removed
+
+    def __contains__(self, name: str) -> bool:
+        return self._row(name) is not None
+
+    @property
+    def names(self) -> Sequence[str]:
+        """
+        :return: 有效的行的姓名，与 matrix 一一对应
+        """
+        if self._live is None:
+            return self._names.head(self._size)
+        return [self._names[i] for i in np.flatnonzero(self._live)]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """
+        :return: 有效的行组成的特征矩阵，有删除的行时是拷贝
+        """
+        return self._matrix if self._live is None else self._matrix[self._live]
+
+    @property
+    def header(self) -> bytes:
+        return self._header
+
+    @property
+    def index(self) -> GalleryIndex:
+        return self._search_index
+
+    def set_index(self, index: GalleryIndex) -> None:
+        """
+        替换检索方式，索引必须是用当前的矩阵建立的(没有删除的行时，与 matrix 相同)
+        :param index: 新的索引
+        :return: None
+        """
+        self._search_index = index
+
+    def feature(self, name: str) -> bytes:
+        """
+        还原 SDK 格式的特征值(归一化后的)
+        :param name: 姓名
+        :return: 特征值
+        """
+        row = self._row(name)
+        if row is None:
+            raise KeyError(name)
+        header = self._header if self._header else bytes(FEATURE_HEADER_SIZE)
+        return header + np.asarray(self._matrix[row], dtype=np.float32).tobytes()
+
+    def similarity(self, name: str, vector: np.ndarray) -> Optional[float]:
+        """
+        只与特征库中的一个人比较
+        :param name: 姓名
+        :param vector: 归一化的探针向量
+        :return: 校准后的相似度，特征库中没有这个人时返回 None
+        """
+        row = self._row(name)
+        if row is None:
+            return None
+        return float(np.asarray(self._matrix[row], dtype=np.float32) @ vector) * self.scale + self.bias
+
+    def _unchanged(self, name: str, feature: bytes) -> bool:
+        row = self._row(name)
+        return row is not None and np.array_equal(self._matrix[row], decode_feature(feature))
+
+    def apply(self, upserts: Dict[str, bytes], removals: Iterable[str] = ()) -> "FeatureGallery":
+        """
+        生成应用了增量修改的新特征库，原特征库不会被修改，读取者不会看到构建了一半的特征库
+        新增和修改的特征值追加到末尾，删除和被替换的行只在新特征库的 live 掩码中屏蔽
+        :param upserts: 新增或者修改的特征值 Dict[姓名, 特征值]
+        :param removals: 需要删除的姓名
+        :return: 新的特征库，没有实际修改时返回自身
+        """
+        removals = list(removals)
+        # 一次查找所有修改的姓名的行号
+        self._names.lookup(itertools.chain(upserts.keys(), removals))
+        upserts = {name: feature for name, feature in upserts.items() if not self._unchanged(name, feature)}
+        removals = set(filter(lambda x: x in self, removals)) - upserts.keys()
+        if not upserts and not removals:
+            return self
+        rows = [self._row(name) for name in itertools.chain(removals, upserts.keys())]
+        size = self._size + len(upserts)
+        live = np.ones(size, dtype=bool)
+        if self._live is not None:
+            live[:self._size] = self._live
+        live[[row for row in rows if row is not None]] = False
+        buffer, names = self._buffer, self._names
+        if upserts:
+            buffer = buffer.append(self._size, FeatureGallery._build_matrix(upserts.values()))
+            names = names.append(self._size, list(upserts.keys()))
+        header = self._header or next(iter(upserts.values()), b"")[:FEATURE_HEADER_SIZE]
+        gallery = FeatureGallery._snapshot(buffer, size, names, None if live.all() else live, header,
+                                           self._search_index)
+        gallery.scale, gallery.bias = self.scale, self.bias
+        if FeatureGallery.COMPACT_RATIO * size < gallery._removed:
+            return gallery.compact()
+        if upserts:
+            # 只有新增的行需要加入索引
+            gallery.set_index(self._search_index.append(gallery._matrix, self._size))
+        return gallery
+
+    def compact(self) -> "FeatureGallery":
+        """
+        去掉删除的行，行号会改变，索引用 GalleryIndex.rebuild 重新建立
+        :return: 新的特征库，没有删除的行时返回自身
+        """
+        if self._live is None:
+            return self
+        rows = np.flatnonzero(self._live)
+        matrix = np.asarray(self._matrix[rows], dtype=np.float32)
+        # 预留追加的容量，压缩后的第一次追加不需要再拷贝
+        buffer = RowBuffer(np.zeros((0,) + matrix.shape[1:], dtype=np.float32)).append(0, matrix)
+        names = _Names([self._names[i] for i in rows])
+        gallery = FeatureGallery._snapshot(buffer, len(rows), names, None, self._header,
+                                           self._search_index.rebuild(matrix))
+        gallery.scale, gallery.bias = self.scale, self.bias
+        _logger.info("特征库压缩: %d 行 -> %d 行" % (self._size, len(rows)))
+        return gallery
+
+    def search(self, feature: bytes, k: int = 1) -> List[Tuple[str, float]]:
+        """
+        在特征库中查找最相似的 k 个人
+        :param feature: 探针的特征值
+        :param k: 返回的结果数
+        :return: [(姓名, 相似度)]，按相似度从大到小排列
+        """
+        if len(self) == 0 or k <= 0:
+            return []
+        indexes, scores = self._search_index.search(self._matrix, decode_feature(feature), k, self._live)
+        scores = scores * self.scale + self.bias
+        return [(self._names[i], float(score)) for i, score in zip(indexes, scores)]
+
+    def calibrate(self, arcface, samples: int = 200, seed: int = 0) -> Dict[str, float]:
+        """
+        使用 SDK 的 compare_feature 对相似度进行校准
+        随机抽取特征值对，用最小二乘拟合 SDK 相似度与矩阵相似度之间的线性关系
+        随机的两个人几乎都不相似，其中四分之一的对取同一个人，拟合的直线两端都有样本；
+        SDK 截断为 0 的相似度不参与拟合
+        :param arcface: 用于对比的 ArcFace 引擎
+        :param samples: 抽取的特征值对数
+        :param seed: 随机种子
+        :return: 校准结果，包括拟合参数以及校准前后的最大误差
+        """
+        if len(self) == 0:
+            return {"samples": 0, "scale": self.scale, "bias": self.bias}
+        rng = np.random.RandomState(seed)
+        rows = np.flatnonzero(self._live) if self._live is not None else np.arange(self._size)
+        firsts = rows[rng.randint(0, len(rows), samples)]
+        seconds = rows[rng.randint(0, len(rows), samples)]
+        seconds[:samples // 4] = firsts[:samples // 4]
+        ours, theirs = [], []
+        for i, j in zip(firsts, seconds):
+            feature1 = self.feature(self._names[i])
+            feature2 = self.feature(self._names[j])
+            ours.append(float(self._matrix[i] @ self._matrix[j]))
+            theirs.append(arcface.compare_feature(feature1, feature2))
+        ours, theirs = np.array(ours), np.array(theirs)
+        fitted = 0 < theirs
+        ours, theirs = ours[fitted], theirs[fitted]
+        if len(ours) == 0 or np.ptp(ours) <= 1e-6:
+            # 只有一个人等情况，无法拟合
+            return {"samples": 0, "scale": self.scale, "bias": self.bias}
+        raw_error = float(np.max(np.abs(ours - theirs)))
+        self.scale, self.bias = (float(x) for x in np.polyfit(ours, theirs, 1))
+        error = float(np.max(np.abs(ours * self.scale + self.bias - theirs)))
+        _logger.info("特征库校准: scale=%.4f bias=%.4f 最大误差 %.4f -> %.4f" % (
+            self.scale, self.bias, raw_error, error))
+        return {"samples": len(ours), "scale": self.scale, "bias": self.bias, "raw_error": raw_error, "error": error}
+
+
+def _random_features(number: int, dim: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.RandomState(seed)
+    matrix = rng.standard_normal((number, dim)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix
+
+
+def _probes(matrix: np.ndarray, number: int, noise: float = 0.05, seed: int = 1) -> np.ndarray:
+    """
+    模拟已登记的人的探针: 随机选择特征库中的特征值加上噪声(相似度约为 0.6~0.8)
+    """
+    rng = np.random.RandomState(seed)
+    rows = np.asarray(matrix[np.sort(rng.choice(len(matrix), number, replace=False))], dtype=np.float32)
+    probes = rows + rng.standard_normal(rows.shape).astype(np.float32) * noise
+    return probes / np.linalg.norm(probes, axis=1, keepdims=True)
+
+
+def benchmark(sizes: Iterable[int], dim: int = 256, k: int = 5, repeat: int = 20, index: str = "exact",
+              nlist: int = 0, nprobe: int = 8, rerank: int = 32, output=print) -> Dict[int, float]:
+    """
+    测试不同规模特征库的检索耗时，使用近似检索时同时输出相对于暴力检索的召回率和索引占用的内存
+    :param sizes: 特征库的规模
+    :param dim: 特征维数
+    :param k: 每次检索返回的结果数
+    :param repeat: 每种规模检索的次数
+    :param index: exact、ivf 或者 int8
+    :param nlist: 倒排索引的聚类数，0 表示 sqrt(人数)
+    :param nprobe: 倒排索引检索的聚类数
+    :param rerank: int8 检索精确重排的候选数
+    :param output: 输出方式
+    :return: Dict[规模, 单次检索的平均耗时(秒)]
+    """
+    results = {}
+    header = np.zeros(FEATURE_HEADER_SIZE, dtype=np.uint8).tobytes()
+    for size in sizes:
+        matrix = _random_features(size, dim)
+        gallery = FeatureGallery.from_matrix(["%d" % i for i in range(size)], matrix, header)
+        if index == "ivf":
+            gallery.set_index(IVFIndex.train(matrix, nlist, nprobe))
+        elif index == "int8":
+            gallery.set_index(Int8Index.build(matrix, rerank))
+        vectors = _probes(matrix, min(repeat, size))
+        probes = [header + vector.tobytes() for vector in vectors]
+        gallery.search(probes[0], k)  # 预热
+        begin_time = time.time()
+        for probe in probes:
+            gallery.search(probe, k)
+        cost = (time.time() - begin_time) / len(probes)
+        results[size] = cost
+        if index == "exact":
+            output("%8d 人: %.3f ms/次, 特征矩阵 %.1f MB" % (size, cost * 1000, matrix.nbytes / 2 ** 20))
+            continue
+        recall_1, recall_k = recall_at_k(matrix, gallery.index, vectors, k)
+        output("%8d 人: %.3f ms/次, recall@1 %.3f, recall@%d %.3f, 索引 %.1f MB(特征矩阵 %.1f MB)" % (
+            size, cost * 1000, recall_1, k, recall_k, gallery.index.nbytes / 2 ** 20, matrix.nbytes / 2 ** 20))
+        if index == "int8" and rerank:
+            # 同样的量化不做重排时的精度
+            recall_1, recall_k = recall_at_k(matrix, Int8Index(*quantize_int8(matrix), 0), vectors, k)
+            output("%8s 不重排: recall@1 %.3f, recall@%d %.3f" % ("", recall_1, k, recall_k))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="人脸特征库检索测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--index", choices=["exact", "ivf", "int8"], default="exact")
+    parser.add_argument("--nlist", type=int, default=0, help="倒排索引的聚类数，0 表示 sqrt(人数)")
+    parser.add_argument("--nprobe", type=int, default=8, help="倒排索引检索的聚类数")
+    parser.add_argument("--rerank", type=int, default=32, help="int8 检索精确重排的候选数")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    benchmark(args.sizes, args.dim, args.k, args.repeat, args.index, args.nlist, args.nprobe, args.rerank)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+import logging
+import math
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    :return: 相似度最大的 k 个的下标，按相似度从大到小排列
+    """
+    k = min(k, scores.size)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    indexes = np.argpartition(-scores, k - 1)[:k] if k < scores.size else np.arange(scores.size)
+    return indexes[np.argsort(-scores[indexes])]
+
+
+class RowBuffer:
+    """
+    可以原地追加的行数组，多个快照共享同一个缓冲区
+    每个快照只读取自己的前 size 行，追加只写入 size 之后的行，所以已经发布的快照不会看到修改
+    只有最新的快照(size 等于已写入的行数)可以原地追加；容量不够或者不是最新的快照时，拷贝到按 GROWTH 倍扩容的新缓冲区
+    """
+    GROWTH = 1.5
+
+    def __init__(self, data: np.ndarray, size: int = None):
+        """
+        :param data: 初始的数据，可以是只读的内存映射数组(追加时会先拷贝)
+        :param size: 已写入的行数，默认为 len(data)
+        """
+        self.data = data
+        self.size = len(data) if size is None else size
+        self._lock = threading.Lock()
+
+    def view(self, size: int) -> np.ndarray:
+        return self.data[:size]
+
+    def append(self, size: int, rows: np.ndarray) -> "RowBuffer":
+        """
+        :param size: 调用方快照的行数
+        :param rows: 追加的行
+        :return: 包含追加的行的缓冲区，可能是自身
+        """
+        end = size + len(rows)
+        with self._lock:
+            if size == self.size and end <= len(self.data) and self.data.flags.writeable and \
+                    self.data.shape[1:] == rows.shape[1:]:
+                self.data[size:end] = rows
+                self.size = end
+                return self
+        data = np.empty((max(end, int(end * RowBuffer.GROWTH)),) + rows.shape[1:], dtype=rows.dtype)
+        if size:
+            data[:size] = self.data[:size]
+        data[size:end] = rows
+        return RowBuffer(data, end)
+
+
+def _live_rows(indexes: np.ndarray, live: Optional[np.ndarray]) -> np.ndarray:
+    return indexes if live is None else indexes[live[indexes]]
+
+
+class GalleryIndex:
+    """
+    特征库的检索方式。索引只保存检索需要的结构，特征矩阵由 FeatureGallery 持有并在检索时传入
+    索引与特征库一样，已经发布的对象不会被修改: 新增的行由 append 生成新的索引(共享追加的缓冲区)，
+    删除的行由特征库的 live 掩码屏蔽，特征库压缩后由 rebuild 重新建立
+    """
+    def search(
+            self,
+            matrix: np.ndarray,
+            vector: np.ndarray,
+            k: int,
+            live: np.ndarray = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        查找与探针最相似的 k 行
+        :param matrix: 特征矩阵
+        :param vector: 归一化的探针向量
+        :param k: 返回的结果数
+        :param live: 每一行是否有效(没有被删除)，None 表示全部有效
+        :return: 行号, 相似度(未校准)，按相似度从大到小排列
+        """
+        raise NotImplementedError
+
+    def append(self, matrix: np.ndarray, begin: int) -> "GalleryIndex":
+        """
+        生成追加了新的行的索引
+        :param matrix: 新的特征矩阵，前 begin 行与原矩阵相同
+        :param begin: 新增的第一行
+        :return: 新的索引
+        """
+        raise NotImplementedError
+
+    def rebuild(self, matrix: np.ndarray) -> "GalleryIndex":
+        """
+        特征库压缩(行号改变)后重新建立索引，沿用已经训练的参数
+        :param matrix: 压缩后的特征矩阵
+        :return: 新的索引
+        """
+        raise NotImplementedError
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: 索引本身占用的内存(不包括特征矩阵)
+        """
+        return 0
+
+
+class ExactIndex(GalleryIndex):
+    """
+    暴力检索: 一次矩阵乘法计算与所有人的相似度，结果是精确的
+    """
+    def search(self, matrix: np.ndarray, vector: np.ndarray, k: int,
+               live: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        if len(matrix) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        scores = matrix @ vector
+        if live is not None:
+            scores[~live] = -np.inf
+        indexes = _live_rows(_top_k(scores, k), live)
+        return indexes, scores[indexes]
+
+    def append(self, matrix: np.ndarray, begin: int) -> GalleryIndex:
+        return self
+
+    def rebuild(self, matrix: np.ndarray) -> GalleryIndex:
+        return self
+
+
+EXACT_INDEX = ExactIndex()
+
+
+def _assign(centroids: np.ndarray, matrix: np.ndarray, chunk: int = 65536) -> np.ndarray:
+    """
+    :return: 每一行最近(内积最大)的聚类中心
+    """
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for begin in range(0, len(matrix), chunk):
+        block = np.asarray(matrix[begin:begin + chunk], dtype=np.float32)
+        assignments[begin:begin + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def kmeans(matrix: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    球面 k-means: 按内积分配，中心归一化，适用于归一化的特征向量
+    :param matrix: 训练数据，每行一个向量
+    :param clusters: 聚类数
+    :param iterations: 迭代次数
+    :param seed: 随机种子
+    :return: 归一化的聚类中心
+    """
+    rng = np.random.RandomState(seed)
+    data = np.asarray(matrix, dtype=np.float32)
+    centroids = data[rng.choice(len(data), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(centroids, data)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=clusters)
+        used = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[used]
+        centroids[used] = np.add.reduceat(data[order], starts, axis=0)
+        # 空的聚类重新随机选择中心
+        empty = np.flatnonzero(counts == 0)
+        if empty.size:
+            centroids[empty] = data[rng.choice(len(data), empty.size, replace=False)]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids /= np.maximum(norms, 1e-12)
+    return centroids
+
+
+class IVFIndex(GalleryIndex):
+    """
+    倒排索引(IVF): 用 k-means 把特征库分成 nlist 个聚类，
+    检索时只在与探针最接近的 nprobe 个聚类中计算精确的相似度，结果是近似的
+    每个聚类的行号和特征向量连续存放在自己的 RowBuffer 中，检索时顺序读取，代价是多一倍的内存
+    新增的行分配到最近的聚类并追加到该聚类的缓冲区，不会重新生成其它聚类；
+    规模比训练时增长了 RETRAIN_GROWTH 倍后按 sqrt(人数) 个聚类重新训练
+    """
+    SAMPLES_PER_LIST = 32  # 训练时每个聚类的采样数
+    RETRAIN_GROWTH = 2.0
+
+    def __init__(
+            self,
+            centroids: np.ndarray,
+            lists: List[Tuple[RowBuffer, RowBuffer]],
+            sizes: np.ndarray,
+            nprobe: int,
+            trained_size: int
+    ):
+        """
+        :param centroids: 归一化的聚类中心
+        :param lists: 每个聚类的 (行号, 特征向量) 缓冲区
+        :param sizes: 本索引中每个聚类的行数
+        :param nprobe: 检索的聚类数
+        :param trained_size: 训练时的特征库规模
+        """
+        self._centroids = centroids
+        self._lists = lists
+        self._sizes = sizes
+        self.nprobe = nprobe
+        self._trained_size = trained_size
+
+    @staticmethod
+    def build(matrix: np.ndarray, centroids: np.ndarray, nprobe: int, trained_size: int) -> "IVFIndex":
+        """
+        用已有的聚类中心建立索引
+        :param matrix: 特征矩阵
+        :param centroids: 归一化的聚类中心
+        :param nprobe: 检索的聚类数
+        :param trained_size: 训练时的特征库规模
+        :return: 索引
+        """
+        assignments = _assign(centroids, matrix)
+        order = np.argsort(assignments, kind="stable").astype(np.int32)
+        sizes = np.bincount(assignments, minlength=len(centroids))
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        vectors = np.ascontiguousarray(matrix[order], dtype=np.float32)
+        # 每个聚类先使用大数组的一段，第一次追加时才拷贝到自己的缓冲区
+        lists = [(RowBuffer(order[begin:end]), RowBuffer(vectors[begin:end]))
+                 for begin, end in zip(offsets[:-1], offsets[1:])]
+        return IVFIndex(centroids, lists, sizes, nprobe, trained_size)
+
+    @property
+    def nlist(self) -> int:
+        return len(self._centroids)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(rows.data.nbytes + vectors.data.nbytes for rows, vectors in self._lists) + self._centroids.nbytes
+
+    @staticmethod
+    def train(matrix: np.ndarray, nlist: int = 0, nprobe: int = 8, iterations: int = 10,
+              seed: int = 0) -> "IVFIndex":
+        """
+        训练聚类中心并建立索引
+        :param matrix: 特征矩阵
+        :param nlist: 聚类数，0 表示 sqrt(人数)
+        :param nprobe: 检索的聚类数
+        :param iterations: k-means 的迭代次数
+        :param seed: 随机种子
+        :return: 索引
+        """
+        begin_time = time.time()
+        size = len(matrix)
+        nlist = max(1, min(size, nlist or int(math.sqrt(size))))
+        rng = np.random.RandomState(seed)
+        samples = min(size, nlist * IVFIndex.SAMPLES_PER_LIST)
+        # 排序后的行号读取内存映射的矩阵时更快
+        sample = np.asarray(matrix[np.sort(rng.choice(size, samples, replace=False))], dtype=np.float32)
+        centroids = kmeans(sample, nlist, iterations, seed)
+        index = IVFIndex.build(matrix, centroids, nprobe, size)
+        _logger.info("训练了 %d 个聚类的倒排索引(%d 人)，耗时 %.2f 秒" % (nlist, size, time.time() - begin_time))
+        return index
+
+    def search(self, matrix: np.ndarray, vector: np.ndarray, k: int,
+               live: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        if len(matrix) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        probes = [i for i in _top_k(self._centroids @ vector, self.nprobe) if self._sizes[i]]
+        if not probes:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        rows = np.concatenate([self._lists[i][0].view(self._sizes[i]) for i in probes])
+        scores = np.concatenate([self._lists[i][1].view(self._sizes[i]) @ vector for i in probes])
+        if live is not None:
+            alive = live[rows]
+            rows, scores = rows[alive], scores[alive]
+        indexes = _top_k(scores, k)
+        return rows[indexes].astype(np.int64), scores[indexes]
+
+    def append(self, matrix: np.ndarray, begin: int) -> GalleryIndex:
+        if IVFIndex.RETRAIN_GROWTH * self._trained_size < len(matrix):
+            return IVFIndex.train(matrix, 0, self.nprobe)
+        added = np.asarray(matrix[begin:], dtype=np.float32)
+        assignments = _assign(self._centroids, added)
+        lists = list(self._lists)
+        sizes = self._sizes.copy()
+        for cluster in np.unique(assignments):
+            members = np.flatnonzero(assignments == cluster)
+            rows, vectors = lists[cluster]
+            size = sizes[cluster]
+            lists[cluster] = (rows.append(size, (members + begin).astype(np.int32)),
+                              vectors.append(size, added[members]))
+            sizes[cluster] += len(members)
+        return IVFIndex(self._centroids, lists, sizes, self.nprobe, self._trained_size)
+
+    def rebuild(self, matrix: np.ndarray) -> GalleryIndex:
+        if IVFIndex.RETRAIN_GROWTH * self._trained_size < len(matrix):
+            return IVFIndex.train(matrix, 0, self.nprobe)
+        return IVFIndex.build(matrix, self._centroids, self.nprobe, self._trained_size)
+
+
+def quantize_int8(matrix: np.ndarray, chunk: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    每一行按自己的最大绝对值对称量化为 int8
+    :param matrix: 特征矩阵
+    :param chunk: 每次处理的行数
+    :return: int8 矩阵, 每一行的比例(原值 ≈ int8 值 * 比例)
+    """
+    codes = np.empty(matrix.shape, dtype=np.int8)
+    scales = np.empty(len(matrix), dtype=np.float32)
+    for begin in range(0, len(matrix), chunk):
+        block = np.asarray(matrix[begin:begin + chunk], dtype=np.float32)
+        scale = np.abs(block).max(axis=1) / 127 if block.size else np.zeros(0, dtype=np.float32)
+        scale[scale == 0] = 1.0
+        codes[begin:begin + len(block)] = np.rint(block / scale[:, None])
+        scales[begin:begin + len(block)] = scale
+    return codes, scales
+
+
+class Int8Index(GalleryIndex):
+    """
+    int8 量化检索: 扫描 int8 矩阵得到近似的相似度，只有前 rerank 个候选用原始的 float32 特征精确重排
+    扫描的数据量只有 float32 矩阵的 1/4，特征矩阵是内存映射文件时只有重排的行会被读取
+    量化结果保存在 RowBuffer 中，新增的行只量化新的行并原地追加
+    """
+    CHUNK = 1024  # 每次转换为 float32 的行数，转换后的块(1 MB)留在 CPU 缓存中
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray, rerank: int = 32, size: int = None):
+        """
+        :param codes: 量化后的 int8 矩阵，或者共享的 RowBuffer
+        :param scales: 每一行的比例，或者共享的 RowBuffer
+        :param rerank: 精确重排的候选数，0 表示不重排(直接返回近似的相似度)
+        :param size: 本索引的行数，默认为 codes 的行数
+        """
+        self._codes = codes if isinstance(codes, RowBuffer) else RowBuffer(codes)
+        self._scales = scales if isinstance(scales, RowBuffer) else RowBuffer(scales)
+        self._size = self._codes.size if size is None else size
+        self.rerank = rerank
+
+    @staticmethod
+    def build(matrix: np.ndarray, rerank: int = 32) -> "Int8Index":
+        """
+        :param matrix: 特征矩阵
+        :param rerank: 见 __init__
+        :return: 索引
+        """
+        return Int8Index(*quantize_int8(matrix), rerank)
+
+    @property
+    def nbytes(self) -> int:
+        return self._codes.data.nbytes + self._scales.data.nbytes
+
+    def approximate(self, vector: np.ndarray) -> np.ndarray:
+        """
+        :param vector: 归一化的探针向量
+        :return: 与所有行的近似相似度
+        """
+        size = self._size
+        codes = self._codes.view(size)
+        scores = np.empty(size, dtype=np.float32)
+        buffer = np.empty((min(size, Int8Index.CHUNK), codes.shape[1]), dtype=np.float32)
+        for begin in range(0, size, Int8Index.CHUNK):
+            block = codes[begin:begin + Int8Index.CHUNK]
+            converted = buffer[:len(block)]
+            np.copyto(converted, block, casting="unsafe")
+            np.matmul(converted, vector, out=scores[begin:begin + len(block)])
+        scores *= self._scales.view(size)
+        return scores
+
+    def search(self, matrix: np.ndarray, vector: np.ndarray, k: int,
+               live: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        if len(matrix) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        scores = self.approximate(np.asarray(vector, dtype=np.float32))
+        if live is not None:
+            scores[~live] = -np.inf
+        if self.rerank <= 0:
+            indexes = _live_rows(_top_k(scores, k), live)
+            return indexes, scores[indexes]
+        rows = np.sort(_live_rows(_top_k(scores, max(k, self.rerank)), live))
+        exact = np.asarray(matrix[rows], dtype=np.float32) @ vector
+        indexes = _top_k(exact, k)
+        return rows[indexes], exact[indexes]
+
+    def append(self, matrix: np.ndarray, begin: int) -> GalleryIndex:
+        codes, scales = quantize_int8(matrix[begin:])
+        return Int8Index(
+            self._codes.append(begin, codes), self._scales.append(begin, scales), self.rerank, len(matrix))
+
+    def rebuild(self, matrix: np.ndarray) -> GalleryIndex:
+        return Int8Index.build(matrix, self.rerank)
+
+
+def create_index(kind: str, matrix: np.ndarray, nlist: int = 0, nprobe: int = 8,
+                 min_size: int = 10000, rerank: int = 32) -> GalleryIndex:
+    """
+    按配置创建索引
+    :param kind: exact、ivf 或者 int8
+    :param matrix: 特征矩阵
+    :param nlist: 见 IVFIndex.train
+    :param nprobe: 见 IVFIndex.train
+    :param min_size: 人数少于该值时近似检索没有意义，使用暴力检索
+    :param rerank: 见 Int8Index
+    :return: 索引
+    """
+    if kind == "ivf" and min_size <= len(matrix):
+        return IVFIndex.train(matrix, nlist, nprobe)
+    if kind == "int8" and min_size <= len(matrix):
+        return Int8Index.build(matrix, rerank)
+    if kind not in ("exact", "ivf", "int8"):
+        _logger.warning("未知的索引类型 \"%s\"，使用暴力检索" % kind)
+    return EXACT_INDEX
+
+
+def recall_at_k(
+        matrix: np.ndarray,
+        index: GalleryIndex,
+        probes: Sequence[np.ndarray],
+        k: int
+) -> Tuple[float, float]:
+    """
+    近似检索相对于暴力检索的召回率
+    :param matrix: 特征矩阵
+    :param index: 被测试的索引
+    :param probes: 归一化的探针向量
+    :param k: 比较前 k 个结果
+    :return: recall@1, recall@k
+    """
+    hits_1 = hits_k = 0
+    for vector in probes:
+        expected, _ = EXACT_INDEX.search(matrix, vector, k)
+        actual, _ = index.search(matrix, vector, k)
+        hits_1 += int(actual.size > 0 and expected.size > 0 and actual[0] == expected[0])
+        hits_k += len(set(expected.tolist()) & set(actual.tolist()))
+    count = max(1, len(probes))
+    return hits_1 / count, hits_k / max(1, count * min(k, len(matrix)))
@@ -2,12 +2,16 @@ import logging
 import os
 from abc import ABCMeta
 from abc import abstractmethod
-from typing import Dict, Generator
+from typing import Dict, Generator, Union
 import yaml
 import cv2 as cv
+import threading
 import time
 
 import numpy as np
+
+from module import metrics
+
 _logger = logging.getLogger(__name__)
 
 def get_regular_file(path: str) -> Generator[str, None, None]:
@@ -34,13 +38,27 @@ def get_regular_file(path: str) -> Generator[str, None, None]:
                 yield os.path.join(root, file)
         return
     raise ValueError("既不是文件也不是目录 \"%s\"" % path)
+def decode_image(data: bytes) -> np.ndarray:
+    """
+    在内存中解码图片，不经过文件
+    :param data: 图片文件的内容
+    :return: 成功返回图片，失败返回空矩阵
+    """
+    image = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_COLOR)
+    return image if image is not None else np.array([])
+MAX_IMAGE_FILE_SIZE = 64 * 1024 * 1024  # 更大的文件不当作图片读取
+
+
 def read_image(filename) -> np.ndarray:
     """
     通过 OpenCV 读取图片，与 OpenCV 不同的时支持中文路径
     :param filename: 图片文件名
     :return: 成功返回图片，失败返回空矩阵
     """
-    if not os.path.exists(filename) or 5 * 1024 * 1024 < os.path.getsize(filename):
+    if not os.path.exists(filename):
+        return np.array([])
+    if MAX_IMAGE_FILE_SIZE < os.path.getsize(filename):
+        _logger.warning("图片文件过大 \"%s\"" % filename)
         return np.array([])
     image = cv.imdecode(np.fromfile(filename, dtype=np.uint8), cv.IMREAD_COLOR)
     return image if image is not None else np.array([])
@@ -72,7 +90,11 @@ class LocalImage(ImageSource):
     以最快 张/INTERVAL ms 提供一张图片
     """
     INTERVAL = 40.0 / 1000  # 40 ms
-    def __init__(self, path: str):
+    def __init__(self, path: str, interval: float = INTERVAL):
+        """
+        :param path: 图片、包含图片的目录或者视频的路径
+        :param interval: 两次读取的最小间隔(秒)，为 0 时不限速(用于回放测试)
+        """
         if not os.path.exists(path):
             raise ValueError("路径不存在 \"%s\"" % path)
         if os.path.islink(path):
@@ -87,7 +109,8 @@ class LocalImage(ImageSource):
             else:
                 self._image = LocalImage._image_gen_from_video(path)
 
-        self._last_read_time = time.time() - LocalImage.INTERVAL - 1
+        self._interval = interval
+        self._last_read_time = time.time() - interval - 1
 
     @staticmethod
     def _image_gen_from_video(path: str) -> Generator[np.ndarray, bool, None]:
@@ -140,11 +163,12 @@ class LocalImage(ImageSource):
 
     def read(self) -> np.ndarray:
         image = next(self._image)
+        if self._interval <= 0:
+            return image
         cur_time = time.time()
         passed_time = cur_time - self._last_read_time
-        # print(passed_time, LocalImage.INTERVAL, passed_time < LocalImage.INTERVAL)
-        if passed_time < LocalImage.INTERVAL:
-            time.sleep(LocalImage.INTERVAL - passed_time)
+        if passed_time < self._interval:
+            time.sleep(self._interval - passed_time)
             cur_time = time.time()
         self._last_read_time = cur_time
         return image
@@ -160,9 +184,12 @@ class LocalCamera(ImageSource):
     """
     打开摄像头
     """
-    def __init__(self):
+    def __init__(self, source: Union[int, str] = 0):
+        """
+        :param source: 本地摄像头的编号或者视频流的地址
+        """
         _logger.info("正在打开网络摄像头...")
-        self._cap = cv.VideoCapture(0)
+        self._cap = cv.VideoCapture(source)
         if self._cap.isOpened():
             _logger.info("网络摄像头在线")
         else:
@@ -181,3 +208,102 @@ class LocalCamera(ImageSource):
     def set_camera(self, url):
         self._cap = cv.VideoCapture(url)
 
+
+class ThreadedCamera(ImageSource):
+    """
+    在后台线程中持续解码摄像头或者视频流，只保留最新的一帧
+    检测变慢时旧的帧会被直接丢弃，不会在摄像头的缓冲区中堆积；视频流断开后自动重连
+    """
+    RECONNECT_INTERVAL = 2.0  # 重连的间隔(秒)
+    READ_TIMEOUT = 1.0  # 等待新帧的最长时间(秒)
+
+    def __init__(self, source: Union[int, str] = 0, late_threshold: float = 0.2):
+        """
+        :param source: 本地摄像头的编号或者视频流的地址
+        :param late_threshold: 读取时帧的存在时间超过该值(秒)则记为迟到的帧
+        """
+        _logger.info("正在打开摄像头 %s..." % (source,))
+        self._source = source
+        self._late_threshold = late_threshold
+        self._cap = cv.VideoCapture(source)
+        assert self._cap.isOpened(), "没有发现摄像头"
+        self._condition = threading.Condition()
+        self._image = None
+        self._image_time = 0.0
+        self._sequence = 0  # 解码得到的帧的序号
+        self._read_sequence = 0  # 最后一次读取的帧的序号
+        self.decoded_frames = 0
+        self.dropped_frames = 0
+        self.late_frames = 0
+        self.reconnects = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="capture-%s" % (source,), daemon=True)
+        self._thread.start()
+
+    def _reconnect(self) -> None:
+        _logger.warning("摄像头 %s 断开，%.1f 秒后重连" % (self._source, ThreadedCamera.RECONNECT_INTERVAL))
+        self._cap.release()
+        time.sleep(ThreadedCamera.RECONNECT_INTERVAL)
+        self._cap = cv.VideoCapture(self._source)
+        self.reconnects += 1
+        if self._cap.isOpened():
+            _logger.info("摄像头 %s 重连成功" % (self._source,))
+
+    def _run(self) -> None:
+        while self._running:
+            succeed, image = self._cap.read()
+            if not succeed:
+                if self._running:
+                    self._reconnect()
+                continue
+            with self._condition:
+                if self._sequence != self._read_sequence:
+                    # 上一帧还没有被读取就被覆盖了
+                    self.dropped_frames += 1
+                    metrics.DROPPED_FRAMES.inc(source="capture")
+                self._image, self._image_time = image, time.time()
+                self._sequence += 1
+                self.decoded_frames += 1
+                self._condition.notify_all()
+
+    def read(self) -> np.ndarray:
+        """
+        读取最新的一帧，如果最新的一帧已经读取过，等待下一帧
+        :return: 图片，超时返回 None
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._sequence != self._read_sequence, ThreadedCamera.READ_TIMEOUT):
+                _logger.warning("读取摄像头 %s 超时" % (self._source,))
+                return None
+            self._read_sequence = self._sequence
+            image, image_time = self._image, self._image_time
+        if self._late_threshold < time.time() - image_time:
+            self.late_frames += 1
+        return image
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: 解码、丢弃、迟到的帧数以及重连的次数
+        """
+        return {
+            "decoded": self.decoded_frames,
+            "dropped": self.dropped_frames,
+            "late": self.late_frames,
+            "reconnects": self.reconnects,
+        }
+
+    def release(self) -> None:
+        self._running = False
+        self._thread.join()
+        self._cap.release()
+
+
+def open_camera(source: str, threaded: bool = True) -> ImageSource:
+    """
+    打开摄像头
+    :param source: 数字表示本地摄像头的编号，否则为视频流地址
+    :param threaded: 是否在后台线程中解码，只保留最新的一帧
+    :return: 摄像头
+    """
+    source = int(source) if source.isdigit() else source
+    return ThreadedCamera(source) if threaded else LocalCamera(source)
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+
+class Match(NamedTuple):
+    name: str  # 识别出的人
+    score: float  # 相似度
+    feature: bytes  # 提取到的(融合后的)特征值，人脸库变化后可以直接重新检索
+    version: int  # 识别时人脸库的版本
+    time: float  # 识别的时间
+
+
+class MatchCache:
+    """
+    跟踪中的人脸的识别结果，键为 (摄像头, 人脸 ID)
+    VIDEO 模式下同一个人在离开画面之前人脸 ID 不变，命中时不需要再提取特征和检索人脸库
+    人脸离开画面(跟踪丢失)、超过 ttl 或者人脸库的版本变化后结果失效
+    """
+    def __init__(self, ttl: float = 30.0, max_size: int = 1024):
+        """
+        :param ttl: 结果的有效时间(秒)，0 表示不缓存
+        :param max_size: 最多缓存的人脸数，超过时淘汰最久没有使用的
+        """
+        self.ttl = ttl
+        self._max_size = max_size
+        self._matches: "OrderedDict[Tuple[str, int], Match]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, camera: str, face_id: int, now: float = None) -> Optional[Match]:
+        """
+        :param camera: 摄像头
+        :param face_id: 人脸 ID
+        :param now: 当前时间，默认为 time.time()
+        :return: 没有过期的识别结果(人脸库的版本需要调用方比较)，没有时返回 None
+        """
+        if self.ttl <= 0:
+            return None
+        now = time.time() if now is None else now
+        key = (camera, face_id)
+        with self._lock:
+            match = self._matches.get(key)
+            if match is None:
+                return None
+            if self.ttl <= now - match.time:
+                del self._matches[key]
+                return None
+            self._matches.move_to_end(key)
+            return match
+
+    def put(self, camera: str, face_id: int, match: Match) -> None:
+        if self.ttl <= 0:
+            return
+        key = (camera, face_id)
+        with self._lock:
+            self._matches[key] = match
+            self._matches.move_to_end(key)
+            while self._max_size < len(self._matches):
+                self._matches.popitem(last=False)
+
+    def invalidate(self, camera: str, face_id: int) -> None:
+        """
+        跟踪丢失后调用，之后同样的人脸 ID 可能是另一个人
+        :param camera: 摄像头
+        :param face_id: 人脸 ID
+        :return: None
+        """
+        with self._lock:
+            self._matches.pop((camera, face_id), None)
+
+    def clear(self, camera: str = None) -> None:
+        """
+        :param camera: 只清除该摄像头的结果，None 表示全部清除。重新创建 VIDEO 引擎后人脸 ID 会重新编号
+        :return: None
+        """
+        with self._lock:
+            if camera is None:
+                self._matches.clear()
+            else:
+                for key in [key for key in self._matches if key[0] == camera]:
+                    del self._matches[key]
+
+    def __len__(self) -> int:
+        return len(self._matches)
@@ -0,0 +1,250 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+_logger = logging.getLogger(__name__)
+
+_enabled = False
+
+
+def enable() -> None:
+    """
+    开启统计。没有开启时所有的统计操作都直接返回
+    :return: None
+    """
+    global _enabled
+    _enabled = True
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+
+
+class _Metric:
+    TYPE = ""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.TYPE)]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """
+    只增不减的计数
+    """
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if not _enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return ["%s%s %s" % (self.name, _format_labels(key), value) for key, value in values]
+
+
+class Gauge(_Metric):
+    """
+    读取时才计算的当前值，比如队列长度
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        with self._lock:
+            self._functions[tuple(sorted(labels.items()))] = function
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            functions = list(self._functions.items())
+        samples = []
+        for key, function in functions:
+            try:
+                samples.append("%s%s %s" % (self.name, _format_labels(key), float(function())))
+            except Exception as e:
+                _logger.debug("读取 %s 失败: %s" % (self.name, e))
+        return samples
+
+
+class Histogram(_Metric):
+    """
+    固定分桶的直方图
+    """
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self._buckets = tuple(buckets)
+        self._values: Dict[Tuple, List] = {}  # labels -> [各个桶的计数, 总和, 总数]
+        self._recorder: Optional[Callable[[float, Tuple], None]] = None
+
+    def set_recorder(self, recorder: Optional[Callable[[float, Tuple], None]]) -> None:
+        """
+        额外保存每一个原始值，比如回放测试中计算精确的分位数
+        :param recorder: 接收 (值, 标签) 的函数，None 表示不保存
+        :return: None
+        """
+        self._recorder = recorder
+
+    def observe(self, value: float, **labels) -> None:
+        if not _enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        if self._recorder is not None:
+            self._recorder(value, key)
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, (list(data[0]), data[1], data[2])) for key, data in self._values.items()]
+        samples = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(list(self._buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                labels = key + (("le", bound),)
+                samples.append("%s_bucket%s %d" % (self.name, _format_labels(labels), cumulative))
+            samples.append("%s_sum%s %s" % (self.name, _format_labels(key), total))
+            samples.append("%s_count%s %d" % (self.name, _format_labels(key), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        :return: Prometheus 文本格式的所有统计信息
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram("recognition_stage_seconds", "Latency of each recognition pipeline stage")
+DROPPED_FRAMES = Counter("recognition_dropped_frames_total", "Frames dropped before being processed or sent")
+QUEUE_DEPTH = Gauge("recognition_queue_depth", "Tasks waiting in a queue")
+MATCH_CACHE = Counter("recognition_match_cache_total", "Lookups of cached matches of tracked faces")
+RECENT_PROBES = Counter("recognition_recent_probes_total", "Probes checked against recently recognized faces")
+WEBSOCKET_CLIENTS = Gauge("recognition_websocket_clients", "Connected dashboard clients")
+
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class _StageTimer:
+    __slots__ = ("_stage", "_begin_time")
+
+    def __init__(self, stage: str):
+        self._stage = stage
+
+    def __enter__(self):
+        self._begin_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self._begin_time, stage=self._stage)
+        return False
+
+
+def stage(name: str):
+    """
+    统计一个处理阶段的耗时，用法: with stage("detect_faces"): ...
+    没有开启统计时返回共享的空操作对象
+    :param name: 阶段的名字
+    :return: 上下文管理器
+    """
+    if not _enabled:
+        return _NOOP_TIMER
+    return _StageTimer(name)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> Optional[HTTPServer]:
+    """
+    开启统计并在后台线程中提供 /metrics
+    :param port: 端口，为 0 时不开启
+    :param host: 监听的地址
+    :return: HTTP 服务，没有开启时返回 None
+    """
+    if port <= 0:
+        return None
+    enable()
+    server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    _logger.info("统计信息: http://%s:%d/metrics" % (host, port))
+    return server
@@ -0,0 +1,25 @@
+import cv2 as cv
+import numpy as np
+
+from module.face_process import FaceInfo
+from module.text_renderer import put_text
+
+
+def draw_face_info(image: np.ndarray, face_info: FaceInfo) -> None:
+    """
+    将人脸的信息绘制到屏幕上
+    :param image: 视频帧
+    :param face_info: 人脸信息
+    :return: None
+    """
+    # 绘制人脸位置
+    rect = face_info.rect
+    color = (255, 0, 0) if face_info.name else (0, 0, 255)
+    cv.rectangle(image, rect.top_left, rect.bottom_right, color, 2)
+    # 绘制人的其它信息
+    x, y = rect.top_middle
+    put_text(image, "%s" % face_info, bottom_middle=(x, y - 2))
+    # 绘制人脸 ID
+    info = "%d" % face_info.arc_face_info.face_id
+    x, y = rect.top_left
+    put_text(image, info, left_top=(x + 2, y + 2))
@@ -0,0 +1,302 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Generator, Mapping, Optional, Tuple
+
+import numpy as np
+
+from arcface import ArcFace, image_regularization
+from arcface import FaceInfo as ArcFaceInfo
+from module import metrics
+from module.face_process import FaceProcess, FaceInfo
+from module.image_source import ImageSource, open_camera
+from module.quality import QualityGate
+from module.scheduler import ExtractionScheduler, quality_score
+
+_logger = logging.getLogger(__name__)
+
+
+def frame_rate_statistics_generator() -> Generator[float, bool, None]:
+    """
+    统计视频帧率
+    :return: 每 100 帧给出一次帧率，其余时候为 0
+    """
+    count = 0
+    begin_time = time.time()
+    break_ = False
+    while not break_:
+        if count != 100:
+            fps = 0.0
+        else:
+            end_time = time.time()
+            fps = count / (end_time - begin_time)
+            count = 0
+            begin_time = time.time()
+        count += 1
+        break_ = yield fps
+
+
+class CameraPipeline:
+    """
+    单个摄像头的处理流程: 读取视频帧、VIDEO 模式检测和跟踪人脸，
+    再把需要识别的人脸提交给共享的 FaceProcess
+    """
+    RETRY_INTERVAL = 0.1  # 读取视频帧失败后重试的间隔(秒)
+
+    def __init__(
+            self,
+            name: str,
+            image_source: ImageSource,
+            face_process: FaceProcess,
+            on_frame: Callable[["CameraPipeline", np.ndarray, Dict[int, FaceInfo]], bool],
+            scheduler: ExtractionScheduler = None,
+            quality_gate: QualityGate = None,
+            detect_size: int = 0,
+            engine_factory: Callable[[], ArcFace] = None,
+            stop_event: threading.Event = None
+    ):
+        """
+        :param name: 摄像头的名字
+        :param image_source: 视频帧的来源
+        :param face_process: 共享的特征提取和识别
+        :param on_frame: 每一帧处理完后的回调，返回 True 时停止
+        :param scheduler: 选择需要提交的人脸，多路摄像头时共享同一个以共用每秒的预算
+        :param quality_gate: 提交前的质量检查，None 表示不检查
+        :param detect_size: 检测和跟踪前把视频帧缩小到的长边，人脸位置再映射回原图，0 表示不缩小
+        :param engine_factory: 创建 VIDEO 模式引擎的函数，默认使用 SDK 的默认参数
+        :param stop_event: 设置后停止，每一轮开始时检查，不依赖于是否读取到视频帧
+        """
+        self.name = name
+        self.fps = 0.0
+        self._image_source = image_source
+        self._face_process = face_process
+        self._on_frame = on_frame
+        self._scheduler = scheduler if scheduler is not None else ExtractionScheduler()
+        self._quality_gate = quality_gate
+        self._detect_size = detect_size
+        self._engine_factory = engine_factory or (lambda: ArcFace(ArcFace.VIDEO_MODE))
+        self._faces_info: Dict[int, FaceInfo] = {}
+        self._stop_event = stop_event if stop_event is not None else threading.Event()
+
+    @property
+    def source_stats(self) -> Dict[str, int]:
+        """
+        :return: 视频源的统计信息(解码、丢弃、迟到的帧数等)，不支持时为空
+        """
+        stats = getattr(self._image_source, "stats", None)
+        return stats() if stats is not None else {}
+
+    @property
+    def busy_faces(self) -> int:
+        """
+        :return: 正在等待或者正在获取信息的人脸数
+        """
+        return sum(1 for face_info in list(self._faces_info.values()) if not all(face_info.stop_flags))
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _detect(self, arcface: ArcFace, image: np.ndarray) -> Tuple[np.ndarray, Dict[int, ArcFaceInfo]]:
+        """
+        在缩小的视频帧上检测和跟踪人脸
+        :param arcface: 检测人脸的 VIDEO 模式引擎
+        :param image: 视频帧
+        :return: 检测用的图片(不需要缩小时就是 image), Dict[人脸 ID, 人脸在检测用的图片中的位置]
+        """
+        detect_image = image_regularization(image, self._detect_size) if self._detect_size else image
+        return detect_image, {face_pos.face_id: face_pos for face_pos in arcface.detect_faces(detect_image)}
+
+    def _update_tracks(
+            self,
+            arcface: ArcFace,
+            image: np.ndarray,
+            faces_pos: Dict[int, ArcFaceInfo],
+            detect_image: np.ndarray,
+            detected: Dict[int, ArcFaceInfo]
+    ) -> None:
+        """
+        更新跟踪的人脸。调度器选出、通过质量检查的人脸放入该人脸的截图缓存，
+        缓存稳定下来或者人脸离开画面时，才用最好的截图提交给 FaceProcess
+        :param arcface: 检测人脸的 VIDEO 模式引擎
+        :param image: 视频帧
+        :param faces_pos: Dict[人脸 ID, 人脸在原图中的位置]
+        :param detect_image: 检测用的图片
+        :param detected: Dict[人脸 ID, 人脸在检测用的图片中的位置]
+        :return: None
+        """
+        faces_info = self._faces_info
+        now = time.time()
+        # 删除过期 id, 添加新的 id
+        cur_faces_id = faces_pos.keys()
+        last_faces_id = faces_info.keys()
+        for face_id in last_faces_id - cur_faces_id:
+            face_info = faces_info.pop(face_id)
+            # 之后同样的人脸 ID 可能是另一个人
+            self._face_process.forget(self.name, face_id)
+            if face_info.has_shots and face_info.stop_flags[0] and not face_info.name:
+                # 人脸离开了画面，用缓存的最好的截图识别一次
+                face_info.lost = True
+                self._scheduler.submit([face_info], self._submit, now, force=True)
+            else:
+                face_info.cancel()  # 如果有操作在进行，这将取消操作
+        for face_id in cur_faces_id:
+            if face_id in faces_info:
+                # 人脸已经存在，只需更新位置就好了
+                faces_info[face_id].arc_face_info = faces_pos[face_id]
+            else:
+                faces_info[face_id] = FaceInfo(faces_pos[face_id], self.name)
+                self._face_process.recall(faces_info[face_id])
+
+        # 按质量和退避选择这一帧采集截图的人脸
+        def accept(face_info: FaceInfo) -> bool:
+            face_id = face_info.arc_face_info.face_id
+            # VIDEO 引擎只见过检测用的图片，3D 角度也在该图片上检测
+            return self._quality_gate.check(arcface, image, face_info, (detect_image, detected[face_id]))
+        selected = self._scheduler.select(faces_info.values(), now, accept if self._quality_gate is not None else None)
+        for face_info in selected:
+            face_info.offer_shot(image, quality_score(face_info), now)
+        # 只有实际提交的人脸消耗每秒的预算
+        ready = [face_info for face_info in faces_info.values()
+                 if face_info.shots_ready(now) and face_info.need_update(now)]
+        self._scheduler.submit(ready, self._submit, now)
+
+    def _submit(self, face_info: FaceInfo) -> bool:
+        return self._face_process.async_update_face_info(None, face_info)
+
+    def run(self) -> None:
+        with self._engine_factory() as arcface:
+            # 新的引擎重新分配人脸 ID
+            self._face_process.forget(self.name)
+            faces_info = self._faces_info
+            frame_rate_statistics = frame_rate_statistics_generator()
+            while not self._stop_event.is_set():
+                # 获取视频帧
+                with metrics.stage("capture"):
+                    image = self._image_source.read()
+                if image is None:
+                    # 摄像头断开时 read 可能立即返回，稍等再重试，避免空转
+                    self._stop_event.wait(CameraPipeline.RETRY_INTERVAL)
+                    continue
+                # 检测人脸
+                with metrics.stage("detect_faces"):
+                    detect_image, detected = self._detect(arcface, image)
+                if detect_image is image:
+                    faces_pos = detected
+                else:
+                    # 映射回原图，特征提取和截图使用原图
+                    sx = image.shape[1] / detect_image.shape[1]
+                    sy = image.shape[0] / detect_image.shape[0]
+                    faces_pos = {face_id: face_pos.scale(sx, sy) for face_id, face_pos in detected.items()}
+                with metrics.stage("tracking"):
+                    self._update_tracks(arcface, image, faces_pos, detect_image, detected)
+
+                if self._on_frame(self, image, faces_info):
+                    break
+                # 统计帧率
+                fps = next(frame_rate_statistics)
+                if fps:
+                    self.fps = fps
+                    _logger.info("%s FPS: %.2f" % (self.name, fps))
+
+
+class MultiCameraService:
+    """
+    多路摄像头: 每路摄像头一个线程，运行自己的检测和跟踪，
+    共用同一个 FaceProcess 的引擎池和人脸库
+    """
+    REPORT_INTERVAL = 10.0  # 输出统计信息的间隔(秒)
+
+    def __init__(
+            self,
+            sources: Mapping[str, str],
+            face_process: FaceProcess,
+            on_frame: Callable[[CameraPipeline, np.ndarray, Dict[int, FaceInfo]], bool],
+            threaded_capture: bool = True,
+            scheduler: ExtractionScheduler = None,
+            quality_gate: QualityGate = None,
+            detect_size: int = 0,
+            engine_factory: Callable[[], ArcFace] = None,
+            stop_event: threading.Event = None
+    ):
+        """
+        :param sources: Dict[摄像头名字, 摄像头编号或者视频流地址]
+        :param face_process: 共享的特征提取和识别
+        :param on_frame: 每一帧处理完后的回调，返回 True 时停止对应的摄像头
+        :param threaded_capture: 是否在后台线程中解码，只处理最新的一帧
+        :param scheduler: 所有摄像头共享的人脸调度器
+        :param quality_gate: 提交前的质量检查，None 表示不检查
+        :param detect_size: 见 CameraPipeline
+        :param engine_factory: 见 CameraPipeline
+        :param stop_event: 设置后停止所有摄像头，默认只由 stop 设置
+        """
+        self._sources = dict(sources)
+        self._threaded_capture = threaded_capture
+        self._scheduler = scheduler if scheduler is not None else ExtractionScheduler()
+        self._quality_gate = quality_gate
+        self._detect_size = detect_size
+        self._engine_factory = engine_factory
+        self._face_process = face_process
+        self._on_frame = on_frame
+        self._pipelines: Dict[str, CameraPipeline] = {}
+        self._threads = []
+        self._stopped = stop_event if stop_event is not None else threading.Event()
+
+    def _run_camera(self, name: str, source: str) -> None:
+        try:
+            with open_camera(source, self._threaded_capture) as camera:
+                pipeline = CameraPipeline(
+                    name, camera, self._face_process, self._on_frame, self._scheduler, self._quality_gate,
+                    self._detect_size, self._engine_factory, self._stopped)
+                self._pipelines[name] = pipeline
+                pipeline.run()
+        except Exception:
+            _logger.exception("摄像头 %s 异常退出" % name)
+        finally:
+            self._pipelines.pop(name, None)
+
+    def start(self) -> None:
+        for name, source in self._sources.items():
+            thread = threading.Thread(target=self._run_camera, args=(name, source), name="camera-%s" % name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: 每路摄像头的帧率、等待识别的人脸数、视频源的统计信息，以及共享队列的长度
+        """
+        pending = self._face_process.pending
+        return {
+            name: {"fps": pipeline.fps, "busy_faces": pipeline.busy_faces, "queue": pending, **pipeline.source_stats}
+            for name, pipeline in list(self._pipelines.items())
+        }
+
+    def stop(self) -> None:
+        # 所有摄像头共用同一个停止标志
+        self._stopped.set()
+
+    def join(self, report: Optional[Callable[[str], None]] = _logger.info) -> None:
+        """
+        等待所有摄像头结束，期间定时输出统计信息
+        :param report: 输出统计信息的方式，None 表示不输出
+        :return: None
+        """
+        next_report_time = time.time() + MultiCameraService.REPORT_INTERVAL
+        while any(thread.is_alive() for thread in self._threads):
+            if self._stopped.wait(1.0):
+                break
+            if report is not None and next_report_time <= time.time():
+                next_report_time = time.time() + MultiCameraService.REPORT_INTERVAL
+                for name, stats in self.stats().items():
+                    report("%s: %.2f fps, 等待识别 %d, 队列 %d, 丢弃 %d 帧, 迟到 %d 帧" % (
+                        name, stats["fps"], stats["busy_faces"], stats["queue"],
+                        stats.get("dropped", 0), stats.get("late", 0)))
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        self.join(None)
@@ -0,0 +1,113 @@
+import logging
+from typing import Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from arcface import ArcFace, Rect
+from arcface import FaceInfo as ArcFaceInfo
+from module import metrics
+from module.face_process import FaceInfo
+from module.scheduler import quality_score
+
+_logger = logging.getLogger(__name__)
+
+SHARPNESS_SIZE = 64  # 计算清晰度前把人脸缩放到的边长，使不同大小的人脸可以比较
+
+
+def sharpness(image: np.ndarray, rect: Rect) -> float:
+    """
+    人脸区域的清晰度: 缩放到固定大小后拉普拉斯响应的方差，运动模糊和失焦时很小
+    :param image: 包含人脸的图片
+    :param rect: 人脸的位置
+    :return: 清晰度
+    """
+    height, width = image.shape[:2]
+    (x1, y1), (x2, y2) = rect.top_left, rect.bottom_right
+    x1, y1, x2, y2 = max(0, x1), max(0, y1), min(width, x2), min(height, y2)
+    if x2 <= x1 or y2 <= y1:
+        return 0.0
+    face = cv.resize(image[y1:y2, x1:x2], (SHARPNESS_SIZE, SHARPNESS_SIZE), interpolation=cv.INTER_AREA)
+    gray = cv.cvtColor(face, cv.COLOR_BGR2GRAY) if face.ndim == 3 else face
+    _, std = cv.meanStdDev(cv.Laplacian(gray, cv.CV_32F))
+    return float(std[0, 0]) ** 2
+
+
+class QualityGate:
+    """
+    提取特征前的质量检查: 用 VIDEO 模式的引擎检测 3D 角度，再计算清晰度
+    侧脸、模糊的人脸不提交；同一个人脸只提交不差于之前最好的一帧的帧
+    """
+    def __init__(
+            self,
+            max_yaw: float = 30.0,
+            max_pitch: float = 25.0,
+            min_sharpness: float = 30.0,
+            relative: float = 0.8,
+            decay: float = 0.9
+    ):
+        """
+        :param max_yaw: 最大的偏航角(度)
+        :param max_pitch: 最大的俯仰角(度)
+        :param min_sharpness: 最低的清晰度
+        :param relative: 质量分至少达到该人脸之前最好的质量分的比例
+        :param decay: 每拒绝一帧，之前最好的质量分乘以该值，避免一直等不到同样好的帧
+        """
+        self._max_yaw = max_yaw
+        self._max_pitch = max_pitch
+        self._min_sharpness = min_sharpness
+        self._relative = relative
+        self._decay = decay
+
+    def measure(
+            self,
+            arcface: ArcFace,
+            image: np.ndarray,
+            face_info: FaceInfo,
+            detected: Optional[Tuple[np.ndarray, ArcFaceInfo]] = None
+    ) -> None:
+        """
+        检测人脸的 3D 角度和清晰度，保存到 face_info 中
+        :param arcface: 检测人脸的 VIDEO 模式引擎
+        :param image: 视频帧
+        :param face_info: 人脸信息
+        :param detected: 在缩小的图片上检测时，(检测用的图片, 人脸在其中的位置)，3D 角度在该图片上检测
+        :return: None
+        """
+        detect_image, detect_face = detected if detected is not None else (image, face_info.arc_face_info)
+        with metrics.stage("quality"):
+            face_info.angle = None
+            try:
+                if arcface.process_face(detect_image, detect_face, ArcFace.ANGLE):
+                    face_info.angle = arcface.get_angle()
+            except Exception as e:
+                _logger.debug("人脸 %d: %s" % (face_info.arc_face_info.face_id, e))
+            face_info.sharpness = sharpness(image, face_info.rect)
+
+    def check(
+            self,
+            arcface: ArcFace,
+            image: np.ndarray,
+            face_info: FaceInfo,
+            detected: Optional[Tuple[np.ndarray, ArcFaceInfo]] = None
+    ) -> bool:
+        """
+        检查这一帧的人脸是否值得提取特征
+        :param arcface: 检测人脸的 VIDEO 模式引擎
+        :param image: 视频帧
+        :param face_info: 人脸信息
+        :param detected: 见 measure
+        :return: 值得提取返回 True
+        """
+        self.measure(arcface, image, face_info, detected)
+        angle = face_info.angle
+        passed = face_info.sharpness >= self._min_sharpness and (angle is None or (
+            abs(angle.yaw) <= self._max_yaw and abs(angle.pitch) <= self._max_pitch))
+        if passed:
+            score = quality_score(face_info)
+            passed = score >= face_info.best_quality * self._relative
+            face_info.best_quality = max(face_info.best_quality, score)
+        if not passed:
+            face_info.best_quality *= self._decay
+            metrics.DROPPED_FRAMES.inc(source="quality_gate")
+        return passed
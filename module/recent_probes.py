@@ -0,0 +1,84 @@
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class RecentProbes:
+    """
+    最近识别成功的探针特征，所有摄像头共用
+    同一个人从大堂走到电梯时是另一个摄像头的新人脸，提取特征后先与最近见过的几百个特征比较，
+    命中时只需要与人脸库中这个人的特征核对一次，不需要检索整个人脸库
+    每个人只保留最新的一个特征；超过 window 秒没有再见到的人失效，满了以后淘汰最久没有见到的人
+    """
+    THRESHOLD = 0.7  # 与最近的探针的相似度至少为该值才认为是同一个人
+
+    def __init__(self, size: int = 256, window: float = 120.0):
+        """
+        :param size: 最多保存的人数，0 表示不使用
+        :param window: 有效时间(秒)
+        """
+        self.size = size
+        self.window = window
+        self._matrix: Optional[np.ndarray] = None  # 第一次添加时按特征维数分配
+        self._names: List[str] = [""] * size
+        self._cameras: List[str] = [""] * size
+        self._last_seen = np.full(size, -np.inf)
+        self._lock = threading.Lock()
+
+    def match(self, vector: np.ndarray, now: float = None) -> Optional[Tuple[str, float, str]]:
+        """
+        一次矩阵乘法与所有有效的探针比较
+        :param vector: 归一化的探针向量
+        :param now: 当前时间，默认为 time.time()
+        :return: (姓名, 相似度, 上一次见到的摄像头)，没有足够相似的返回 None
+        """
+        if self.size <= 0 or self._matrix is None:
+            return None
+        now = time.time() if now is None else now
+        with self._lock:
+            scores = self._matrix @ vector
+            scores[now - self._last_seen > self.window] = -np.inf
+            slot = int(np.argmax(scores))
+            if scores[slot] < RecentProbes.THRESHOLD:
+                return None
+            self._last_seen[slot] = now
+            return self._names[slot], float(scores[slot]), self._cameras[slot]
+
+    def add(self, vector: np.ndarray, name: str, camera: str = "", now: float = None) -> None:
+        """
+        记录一次识别成功的探针，替换这个人之前的特征
+        :param vector: 归一化的探针向量
+        :param name: 识别出的人
+        :param camera: 摄像头
+        :param now: 当前时间，默认为 time.time()
+        :return: None
+        """
+        if self.size <= 0:
+            return
+        now = time.time() if now is None else now
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != vector.size:
+                self._matrix = np.zeros((self.size, vector.size), dtype=np.float32)
+                self._last_seen[:] = -np.inf
+            try:
+                slot = self._names.index(name)
+            except ValueError:
+                # 过期的位置的时间最早，也会被优先使用
+                slot = int(np.argmin(self._last_seen))
+            self._matrix[slot] = vector
+            self._names[slot] = name
+            self._cameras[slot] = camera
+            self._last_seen[slot] = now
+
+    def remove(self, name: str) -> None:
+        """
+        :param name: 不再有效的人，比如已经退房
+        :return: None
+        """
+        with self._lock:
+            if name in self._names:
+                slot = self._names.index(name)
+                self._names[slot] = ""
+                self._last_seen[slot] = -np.inf
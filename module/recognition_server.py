@@ -0,0 +1,380 @@
+"""
+基于 asyncio 的 WebSocket 服务，向看板推送视频帧和识别事件
+所有连接在同一个事件循环中处理，不需要每个客户端一个线程；JPEG 编码在专用的线程中进行
+"""
+import asyncio
+import itertools
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional
+
+import cv2 as cv
+import numpy as np
+
+from module import metrics
+from module.event_dispatcher import RecognitionEvent
+from module import frame_stream as ws
+
+_logger = logging.getLogger(__name__)
+
+
+class _ClientClosed(Exception):
+    pass
+
+
+class _Client:
+    """
+    单个客户端的发送队列
+    视频帧的队列有界，客户端太慢时丢弃最旧的帧；文本消息(识别事件)优先发送
+    """
+    STATISTICS_WINDOW = 2.0  # 统计帧率的时间窗口(秒)
+    MESSAGE_QUEUE_SIZE = 64  # 等待发送的文本消息数上限
+
+    def __init__(self, id_: int, address: str, writer: asyncio.StreamWriter, queue_size: int):
+        self.id = id_
+        self.address = address
+        self._writer = writer
+        self._frames: Deque[bytes] = deque(maxlen=queue_size)
+        self._messages: Deque[bytes] = deque(maxlen=_Client.MESSAGE_QUEUE_SIZE)
+        self._ready = asyncio.Event()
+        self._closing = False
+        self._sender: Optional[asyncio.Task] = None
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+        self._window = deque()  # (发送时间, 字节数)
+
+    def put_frame(self, frame: bytes) -> None:
+        if len(self._frames) == self._frames.maxlen:
+            self.dropped_frames += 1
+            metrics.DROPPED_FRAMES.inc(source="websocket")
+        self._frames.append(frame)
+        self._ready.set()
+
+    def put_message(self, message: bytes) -> None:
+        self._messages.append(message)
+        self._ready.set()
+
+    def write(self, data: bytes) -> None:
+        """
+        直接写入控制帧。每一帧都是一次完整的 write，不会与发送队列中的帧交错
+        """
+        if not self._writer.is_closing():
+            self._writer.write(data)
+
+    def start(self) -> None:
+        self._sender = asyncio.ensure_future(self._run())
+
+    async def close(self, frame: bytes, timeout: float) -> None:
+        """
+        丢弃还没有发送的视频帧，发送完文本消息和关闭帧后停止发送
+        :param frame: 关闭帧
+        :param timeout: 最多等待的时间(秒)，超时后直接断开连接
+        :return: None
+        """
+        self._frames.clear()
+        self._messages.append(frame)
+        self._closing = True
+        self._ready.set()
+        _, pending = await asyncio.wait([self._sender], timeout=timeout)
+        if pending:
+            # 客户端不再读取数据，直接断开
+            self._writer.transport.abort()
+
+    def cancel(self) -> None:
+        self._sender.cancel()
+
+    async def _run(self) -> None:
+        """
+        发送队列中的数据，直到关闭、连接断开或者任务被取消
+        """
+        while not self._closing:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._messages or self._frames:
+                data = self._messages.popleft() if self._messages else self._frames.popleft()
+                try:
+                    with metrics.stage("websocket_send"):
+                        self._writer.write(data)
+                        await self._writer.drain()
+                except ConnectionError as e:
+                    # 关闭连接后接收方读到连接断开，由连接的处理协程清理
+                    _logger.info("客户端 %d 发送失败: %s" % (self.id, e))
+                    self._writer.close()
+                    return
+                self._record(len(data))
+
+    def _record(self, size: int) -> None:
+        now = time.time()
+        self.sent_frames += 1
+        self.sent_bytes += size
+        self._window.append((now, size))
+        while self._window and self._window[0][0] < now - _Client.STATISTICS_WINDOW:
+            self._window.popleft()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: 客户端的发送统计，包括帧率和每秒字节数
+        """
+        window = list(self._window)
+        seconds = _Client.STATISTICS_WINDOW
+        return {
+            "id": self.id,
+            "fps": len(window) / seconds,
+            "bytes_per_second": sum(size for _, size in window) / seconds,
+            "sent_frames": self.sent_frames,
+            "sent_bytes": self.sent_bytes,
+            "dropped_frames": self.dropped_frames,
+        }
+
+
+class RecognitionServer:
+    """
+    识别服务的 WebSocket 端点
+    publish / publish_event / stop 可以在任意线程中调用，其余方法在事件循环中调用:
+        await server.start()
+        ...  # 在其他线程中 publish
+        await server.wait_closed()  # 直到 stop 被调用，然后关闭所有连接
+    每一帧只做一次 JPEG 编码和一次封帧，再分发到每个客户端的发送队列
+    """
+    HANDSHAKE_TIMEOUT = 5.0  # 握手超时(秒)
+    MAX_MESSAGE_SIZE = 4096  # 客户端消息的长度上限
+    CLOSE_TIMEOUT = 1.0  # 关闭时等待发送关闭帧的时间(秒)
+
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 8124,
+            quality: int = 80,
+            queue_size: int = 2,
+            on_message: Callable[[int, str], None] = None
+    ):
+        """
+        :param host: 监听的地址
+        :param port: 监听的端口，0 表示由系统分配
+        :param quality: JPEG 质量
+        :param queue_size: 每个客户端等待发送的视频帧数上限
+        :param on_message: 收到客户端文本消息时在事件循环中调用，参数为 (客户端 ID, 消息)，不能阻塞
+        """
+        self.host = host
+        self.port = port
+        self._params = [int(cv.IMWRITE_JPEG_QUALITY), quality]
+        self._queue_size = queue_size
+        self._on_message = on_message
+        self._clients: Dict[int, _Client] = {}
+        self._client_ids = itertools.count(1)
+        self._tasks: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._encoder: Optional[ThreadPoolExecutor] = None
+        self._frame: Optional[np.ndarray] = None
+        self._sequence = 0
+        self._frame_ready: Optional[asyncio.Event] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._running = False
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    @property
+    def clients(self) -> int:
+        return len(self._clients)
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._frame_ready = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._encoder = ThreadPoolExecutor(1, thread_name_prefix="jpeg-encode")
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._tasks.append(asyncio.ensure_future(self._encode_loop()))
+        self._running = True
+        metrics.WEBSOCKET_CLIENTS.set_function(lambda: len(self._clients))
+        _logger.info("WebSocket 服务: ws://%s:%d" % (self.host, self.port))
+
+    def stop(self) -> None:
+        """
+        请求停止服务，可以在任意线程中调用
+        :return: None
+        """
+        self._running = False
+        self._call_soon(self._stopping.set if self._stopping is not None else None)
+
+    async def wait_closed(self) -> None:
+        """
+        等待 stop 被调用，然后发送关闭帧、断开所有连接并释放编码线程
+        :return: None
+        """
+        if self._running:
+            await self._stopping.wait()
+        self._server.close()
+        clients = list(self._clients.values())
+        close_frame = ws.close_frame(ws.CLOSE_GOING_AWAY)
+        await asyncio.gather(*(client.close(close_frame, RecognitionServer.CLOSE_TIMEOUT) for client in clients))
+        for task in self._tasks:
+            task.cancel()
+        # 连接的处理协程在取消后关闭各自的连接
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._server.wait_closed()
+        self._encoder.shutdown()
+        _logger.info("WebSocket 服务已停止，断开 %d 个客户端" % len(clients))
+
+    def publish(self, image: np.ndarray) -> None:
+        """
+        发布新的一帧，发布后不能再修改图片。编码跟不上时只编码最新的一帧
+        :param image: 视频帧
+        :return: None
+        """
+        self._call_soon(self._set_frame, image)
+
+    def publish_event(self, event: RecognitionEvent) -> None:
+        """
+        把识别事件以 JSON 文本消息推送给所有客户端，可以作为 EventDispatcher 的 listener
+        :param event: 识别事件
+        :return: None
+        """
+        message = ws.text_frame(json.dumps({"type": "recognition", **event.to_dict()}, ensure_ascii=False))
+        self._call_soon(self._broadcast, message)
+
+    def _call_soon(self, callback: Optional[Callable], *args) -> None:
+        if callback is None or self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # 事件循环已经关闭
+            pass
+
+    def _set_frame(self, image: np.ndarray) -> None:
+        self._frame = image
+        self._sequence += 1
+        self._frame_ready.set()
+
+    def _broadcast(self, message: bytes) -> None:
+        for client in self._clients.values():
+            client.put_message(message)
+
+    def _encode(self, image: np.ndarray) -> Optional[bytes]:
+        with metrics.stage("jpeg_encode"):
+            succeed, data = cv.imencode(".jpg", image, self._params)
+        return ws.binary_frame(data.tobytes()) if succeed else None
+
+    async def _encode_loop(self) -> None:
+        sequence = 0
+        while True:
+            await self._frame_ready.wait()
+            self._frame_ready.clear()
+            if sequence and self._sequence - sequence > 1:
+                # 编码跟不上发布的速度，中间的帧被跳过了
+                metrics.DROPPED_FRAMES.inc(self._sequence - sequence - 1, source="encode")
+            image, sequence = self._frame, self._sequence
+            if not self._clients:
+                continue
+            frame = await self._loop.run_in_executor(self._encoder, self._encode, image)
+            if frame is None:
+                _logger.warning("JPEG 编码失败")
+                continue
+            for client in self._clients.values():
+                client.put_frame(frame)
+
+    async def _handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), RecognitionServer.HANDSHAKE_TIMEOUT)
+        lines = request.decode("latin-1").split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get("sec-websocket-key")
+        if not lines[0].startswith("GET ") or headers.get("upgrade", "").lower() != "websocket" or not key:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            return False
+        writer.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Accept: %s\r\n\r\n" % ws.accept_key(key)
+        ).encode("latin-1"))
+        return True
+
+    async def _read_message(self, reader: asyncio.StreamReader, client: _Client) -> Optional[str]:
+        """
+        读取客户端的一条文本消息，期间处理 ping 和关闭帧
+        :return: 文本消息，二进制消息返回 None
+        """
+        opcode, payload = None, b""
+        while True:
+            fin, frame_opcode, masked, length = ws.parse_header(await reader.readexactly(2))
+            if length == 126:
+                length = int.from_bytes(await reader.readexactly(2), "big")
+            elif length == 127:
+                length = int.from_bytes(await reader.readexactly(8), "big")
+            if not masked or len(payload) + length > RecognitionServer.MAX_MESSAGE_SIZE:
+                client.write(ws.close_frame(ws.CLOSE_PROTOCOL_ERROR if not masked else ws.CLOSE_TOO_BIG))
+                raise _ClientClosed()
+            mask = await reader.readexactly(4)
+            data = ws.unmask(await reader.readexactly(length), mask)
+            if frame_opcode == ws.OPCODE_CLOSE:
+                client.write(ws.close_frame(ws.close_code(data) or ws.CLOSE_NORMAL))
+                raise _ClientClosed()
+            if frame_opcode == ws.OPCODE_PING:
+                client.write(ws.encode_frame(ws.OPCODE_PONG, data))
+                continue
+            if frame_opcode == ws.OPCODE_PONG:
+                continue
+            if frame_opcode != ws.OPCODE_CONTINUATION:
+                opcode, payload = frame_opcode, b""
+            payload += data
+            if fin:
+                return payload.decode("utf-8", "replace") if opcode == ws.OPCODE_TEXT else None
+
+    async def _receive(self, reader: asyncio.StreamReader, client: _Client) -> None:
+        while True:
+            message = await self._read_message(reader, client)
+            if message is None:
+                continue
+            _logger.debug("客户端 %d: %s" % (client.id, message[:200]))
+            if self._on_message is not None:
+                try:
+                    self._on_message(client.id, message)
+                except Exception:
+                    _logger.exception("处理客户端 %d 的消息失败" % client.id)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._tasks.append(task)
+        address = "%s:%s" % writer.get_extra_info("peername")[:2]
+        client = None
+        try:
+            if not self._running or not await self._handshake(reader, writer):
+                return
+            client = _Client(next(self._client_ids), address, writer, self._queue_size)
+            _logger.info("客户端 %d 连接: %s" % (client.id, address))
+            self._clients[client.id] = client
+            client.start()
+            await self._receive(reader, client)
+        except (_ClientClosed, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError) as e:
+            _logger.debug("连接 %s 关闭: %r" % (address, e))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if client is not None:
+                self._clients.pop(client.id, None)
+                client.cancel()
+                _logger.info("客户端 %d 断开: %s" % (client.id, client.stats()))
+            await self._close_writer(writer)
+            self._tasks.remove(task)
+
+    @staticmethod
+    async def _close_writer(writer: asyncio.StreamWriter) -> None:
+        try:
+            if not writer.is_closing():
+                await asyncio.wait_for(writer.drain(), RecognitionServer.CLOSE_TIMEOUT)
+            writer.close()
+            await asyncio.wait_for(writer.wait_closed(), RecognitionServer.CLOSE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.CancelledError):
+            writer.transport.abort()
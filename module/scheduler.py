@@ -0,0 +1,132 @@
+import threading
+import time
+from typing import Callable, Iterable, List
+
+from module.face_process import FaceInfo
+
+
+def quality_score(face_info: FaceInfo) -> float:
+    """
+    人脸的质量分，越大越值得提取特征
+    由人脸大小、偏航角和俯仰角、清晰度组成，还没有的项不参与计算
+    :param face_info: 人脸信息
+    :return: [0.0, 1.0]
+    """
+    width, height = face_info.rect.size
+    score = min(1.0, min(width, height) / FaceInfo.GOOD_FACE_SIZE)
+    angle = face_info.angle
+    if angle is not None:
+        score *= max(0.0, 1.0 - (abs(angle.yaw) + abs(angle.pitch)) / 90.0)
+    if face_info.sharpness is not None:
+        score *= min(1.0, face_info.sharpness / FaceInfo.GOOD_SHARPNESS)
+    return score
+
+
+class ExtractionScheduler:
+    """
+    决定跟踪中的人脸什么时候采集截图、什么时候提交去提取特征
+    按质量分从高到低选择，尝试次数多的人脸优先级降低；
+    所有摄像头共用每秒的提取预算(令牌桶)，只有实际提交给引擎池的人脸消耗令牌，人脸多时不会把引擎池塞满
+    """
+    def __init__(self, rate: float = 20.0, burst: float = None, max_per_frame: int = 2):
+        """
+        :param rate: 每秒最多提交的人脸数，0 表示不限制
+        :param burst: 令牌桶的容量，默认为 rate
+        :param max_per_frame: 每一帧最多采集截图的人脸数
+        """
+        self._rate = rate
+        self._burst = burst if burst is not None else max(1.0, rate)
+        self._max_per_frame = max_per_frame
+        self._tokens = self._burst
+        self._last_time = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def priority(face_info: FaceInfo) -> float:
+        return quality_score(face_info) / (1 + face_info.attempts)
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._burst, self._tokens + (now - self._last_time) * self._rate)
+        self._last_time = now
+
+    def _available(self, now: float) -> bool:
+        """
+        :return: 是否还有令牌，不消耗
+        """
+        if self._rate <= 0:
+            return True
+        with self._lock:
+            self._refill(now)
+            return 1 <= self._tokens
+
+    def _acquire(self, now: float, force: bool = False) -> bool:
+        """
+        :param force: 没有令牌时也提交，欠下的令牌从之后的预算中扣除
+        :return: 是否得到了令牌
+        """
+        if self._rate <= 0:
+            return True
+        with self._lock:
+            self._refill(now)
+            if self._tokens < 1 and not force:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _release(self) -> None:
+        if self._rate <= 0:
+            return
+        with self._lock:
+            self._tokens = min(self._burst, self._tokens + 1)
+
+    def select(
+            self,
+            faces_info: Iterable[FaceInfo],
+            now: float = None,
+            accept: Callable[[FaceInfo], bool] = None
+    ) -> List[FaceInfo]:
+        """
+        选出这一帧需要采集截图的人脸，不消耗预算；预算用完时不采集，质量检查的调用也随之减少
+        :param faces_info: 跟踪中的所有人脸
+        :param now: 当前时间，默认为 time.time()
+        :param accept: 按优先级依次检查候选的人脸(比如质量检查)，返回 False 的不采集
+        :return: 按优先级排好的人脸，最多 max_per_frame 个
+        """
+        now = time.time() if now is None else now
+        if not self._available(now):
+            return []
+        candidates = [face_info for face_info in faces_info if face_info.need_update(now)]
+        candidates.sort(key=ExtractionScheduler.priority, reverse=True)
+        selected = []
+        for face_info in candidates:
+            if len(selected) == self._max_per_frame:
+                break
+            if accept is None or accept(face_info):
+                selected.append(face_info)
+        return selected
+
+    def submit(
+            self,
+            faces_info: Iterable[FaceInfo],
+            submit: Callable[[FaceInfo], bool],
+            now: float = None,
+            force: bool = False
+    ) -> int:
+        """
+        按优先级提交人脸去提取特征，每个实际提交的人脸消耗一个令牌，令牌用完后剩下的等之后的帧
+        :param faces_info: 可以提交的人脸
+        :param submit: 提交一个人脸，返回是否实际提交了(比如队列已满时为 False，不消耗令牌)
+        :param now: 当前时间，默认为 time.time()
+        :param force: 没有令牌时也提交(比如离开画面的人脸只有这一次机会)，之后的预算相应减少
+        :return: 提交的人脸数
+        """
+        now = time.time() if now is None else now
+        submitted = 0
+        for face_info in sorted(faces_info, key=ExtractionScheduler.priority, reverse=True):
+            if not self._acquire(now, force):
+                break
+            if submit(face_info):
+                submitted += 1
+            else:
+                self._release()
+        return submitted
@@ -1,52 +1,96 @@
 import platform
-from typing import Callable, Tuple
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple, Tuple
 
 import cv2 as cv
 import freetype as ft
 import numpy as np
 
+class _Glyph(NamedTuple):
+    bitmap: np.ndarray  # 字形的灰度图
+    top: int  # 字形顶部到基线的距离
+    advance: int  # 水平步进
+
+
 class TextRenderer:
     """
     将文本渲染成图片
+    字形按 (字符, 字号) 缓存，渲染好的整段文本按 LRU 缓存
+    多个摄像头的线程共用一个实例，字体和缓存都由锁保护
     """
+    LABEL_CACHE_SIZE = 512  # 缓存的渲染结果数
+
     def __init__(self, font_file, char_size: int = 48 * 64):
         self._face = ft.Face(font_file)
+        self._glyphs: Dict[Tuple[str, int], _Glyph] = {}
+        self._kernings: Dict[Tuple[str, str, int], int] = {}
+        self._labels: "OrderedDict[Tuple[str, int], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
         self.set_char_size(char_size)
 
     def set_char_size(self, size) -> None:
-        self._face.set_char_size(size)
+        with self._lock:
+            self._face.set_char_size(size)
+            self._char_size = size
+
+    def _glyph(self, c: str) -> _Glyph:
+        key = c, self._char_size
+        glyph = self._glyphs.get(key)
+        if glyph is None:
+            self._face.load_char(c)
+            slot: ft.GlyphSlot = self._face.glyph
+            bitmap = slot.bitmap
+            image = np.array(bitmap.buffer, dtype=np.ubyte).reshape(bitmap.rows, bitmap.width)
+            glyph = _Glyph(image, slot.bitmap_top, slot.advance.x >> 6)
+            self._glyphs[key] = glyph
+        return glyph
+
+    def _kerning(self, previous, c: str) -> int:
+        key = previous, c, self._char_size
+        kerning = self._kernings.get(key)
+        if kerning is None:
+            kerning = self._face.get_kerning(previous, c).x >> 6
+            self._kernings[key] = kerning
+        return kerning
 
     def render_text(self, text: str) -> np.ndarray:
         """
         :param text: 需要渲染的文字
-        :return: 渲染后得到图片
+        :return: 渲染后得到图片，结果会被缓存，不能修改
         """
-        slot: ft.GlyphSlot = self._face.glyph
-        width, height, baseline = 0, 0, 0
-        previous = 0
-        for i, c in enumerate(text):
-            self._face.load_char(c)
-            bitmap = slot.bitmap
-            height = max(height, bitmap.rows)
-            baseline = max(baseline, max(0, -(slot.bitmap_top - bitmap.rows)))
-            kerning = self._face.get_kerning(previous, c)
-            width += (slot.advance.x >> 6) + (kerning.x >> 6)
-            previous = c
+        with self._lock:
+            key = text, self._char_size
+            image = self._labels.get(key)
+            if image is not None:
+                self._labels.move_to_end(key)
+                return image
+            image = self._render_text(text)
+            image.flags.writeable = False
+            self._labels[key] = image
+            if TextRenderer.LABEL_CACHE_SIZE < len(self._labels):
+                self._labels.popitem(last=False)
+            return image
+
+    def _render_text(self, text: str) -> np.ndarray:
+        glyphs = [self._glyph(c) for c in text]
+        kernings = [self._kerning(previous, c) for previous, c in zip([0] + list(text[:-1]), text)]
+        height, baseline = 0, 0
+        width = 0
+        for glyph, kerning in zip(glyphs, kernings):
+            rows = glyph.bitmap.shape[0]
+            height = max(height, rows)
+            baseline = max(baseline, max(0, -(glyph.top - rows)))
+            width += glyph.advance + kerning
         height += baseline
         image = np.zeros((height, width), dtype=np.ubyte)
-        x, y = 0, 0
-        previous = 0
-        for c in text:
-            self._face.load_char(c)
-            bitmap = slot.bitmap
-            top = slot.bitmap_top
-            w, h = bitmap.width, bitmap.rows
-            y = height - baseline - top
-            kerning = self._face.get_kerning(previous, c)
-            x += (kerning.x >> 6)
-            image[y:y + h, x:x + w] += np.array(bitmap.buffer, dtype='ubyte').reshape(h, w)
-            x += (slot.advance.x >> 6)
-            previous = c
+        x = 0
+        for glyph, kerning in zip(glyphs, kernings):
+            h, w = glyph.bitmap.shape
+            y = height - baseline - glyph.top
+            x += kerning
+            image[y:y + h, x:x + w] += glyph.bitmap
+            x += glyph.advance
         return image
 
 
@@ -72,9 +116,17 @@ def _get_put_text():#可以暂时忽略
     elif platform.system() == "Mac":
         font_path = r""
 
-    assert font_path, "没有字体文件"
     font_size = 10
-    text_renderer = TextRenderer(font_path, 3 * font_size * 4 * font_size)
+    text_renderers = []
+    lock = threading.Lock()
+
+    def _text_renderer() -> TextRenderer:
+        # 第一次绘制时才加载字体，没有字体文件时也能导入模块
+        with lock:
+            if not text_renderers:
+                assert font_path, "没有字体文件"
+                text_renderers.append(TextRenderer(font_path, 3 * font_size * 4 * font_size))
+            return text_renderers[0]
 
     def _put_text(
             image: np.ndarray,
@@ -90,6 +142,7 @@ def _get_put_text():#可以暂时忽略
         :return: None
         """
         # 渲染文本
+        text_renderer = _text_renderer()
         try:
             text_image = text_renderer.render_text(text)
         except ValueError:
@@ -112,9 +165,8 @@ def _get_put_text():#可以暂时忽略
         tx1, ty1, tx2, ty2 = nx1 - x1, ny1 - y1, w - (x2 - nx2), h - (y2 - ny2)
 
         # 绘制到目标上
-        text_image = text_image[ty1:ty2, tx1:tx2]
-        mask = text_image != 0
-        image[ny1:ny2, nx1:nx2][mask] = np.stack([text_image, text_image, text_image], axis=-1)[mask]
+        text_image = text_image[ty1:ty2, tx1:tx2, np.newaxis]
+        np.copyto(image[ny1:ny2, nx1:nx2], text_image, where=text_image != 0)
         # image[ny1:ny2, nx1:nx2] += 10 * np.stack([text_image, text_image, text_image], axis=-1)
 
     return _put_text
@@ -1,71 +1,42 @@
 import argparse
+import asyncio
 import logging
+import signal
 import threading
-import time
-from typing import Dict, Generator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
 import cv2 as cv
 import numpy as np
-import yaml
 from arcface import ArcFace, timer
-from arcface import FaceInfo as ArcFaceInfo
+from module.config import get_profile
+from module.event_dispatcher import EventDispatcher
 from module.face_process import FaceProcess, FaceInfo
-from module.text_renderer import put_text
-from websocket_server import WebsocketServer
-from module.image_source import ImageSource, LocalCamera
-import base64
+from module.image_source import ImageSource, open_camera
+from module.recognition_server import RecognitionServer
+from module.overlay import draw_face_info
+from module.pipeline import CameraPipeline, MultiCameraService, frame_rate_statistics_generator
+from module.quality import QualityGate
+from module.scheduler import ExtractionScheduler
+from module import metrics
 
 def runwebsocketserver():
     _logger = logging.getLogger(__name__)
-    camera = None
-    frame = None
-    def _frame_rate_statistics_generator() -> Generator[float, bool, None]:
-        """
-        统计视频帧率
-        :return:
-        """
-        count = 0
-        begin_time = time.time()
-        break_ = False
-        while not break_:
-            if count != 100:
-                fps = 0.0
-            else:
-                end_time = time.time()
-                fps = count / (end_time - begin_time)
-                count = 0
-                begin_time = time.time()
-            count += 1
-            break_ = yield fps
+    selected_camera = ["default"]  # 推送给客户端的摄像头
+    # 所有摄像头每一轮开始时检查，摄像头断开、读取不到视频帧时也能停止
+    stop_event = threading.Event()
 
-    def _draw_face_info(image: np.ndarray, face_info: FaceInfo) -> None:
-        """
-        将人脸的信息绘制到屏幕上
-        :param face_info: 人脸信息
-        :return: None
-        """
-        # 绘制人脸位置
-        rect = face_info.rect
-        color = (255, 0, 0) if face_info.name else (0, 0, 255)
-        cv.rectangle(image, rect.top_left, rect.bottom_right, color, 2)
-        # 绘制人的其它信息
-        x, y = rect.top_middle
-        put_text(image, "%s" % face_info, bottom_middle=(x, y - 2))
-        # 绘制人脸 ID
-        info = "%d" % face_info.arc_face_info.face_id
-        x, y = rect.top_left
-        put_text(image, info, left_top=(x + 2, y + 2))
+    def _stop() -> None:
+        stop_event.set()
+        server.stop()
+
+    def _stopped() -> bool:
+        return not get_profile().server_on or stop_event.is_set()
 
     def _show_image(image: np.ndarray) -> int:
-        global frame
-        frame = image
+        server.publish(image)
         #cv.imshow("ArcFace Demo", image)
         #cv.waitKey(1)
-        with open("profile.yml", "r", encoding="utf-8") as file:
-            profile: Dict[str, str] = yaml.load(file, yaml.Loader)
-            server_on = profile["server-on"].encode()
-        if server_on == 0:
-            return True
-        return False
+        return _stopped()
 
     @timer(output=_logger.info)
     def _run_1_n(image_source: ImageSource, face_process: FaceProcess) -> None:
@@ -75,14 +46,23 @@ def runwebsocketserver():
         :face_process: 用来对人脸信息进行提取
         :return: None
         """
-        with ArcFace(ArcFace.VIDEO_MODE) as arcface:
+        with _video_engine() as arcface:
+            face_process.forget("")
             cur_face_info = None  # 当前的人脸
-            frame_rate_statistics = _frame_rate_statistics_generator()
-            while True:
+            last_faces_id = set()
+            frame_rate_statistics = frame_rate_statistics_generator()
+            while not stop_event.is_set():
                 # 获取视频帧
                 image = image_source.read()
+                if image is None:
+                    stop_event.wait(CameraPipeline.RETRY_INTERVAL)
+                    continue
                 # 检测人脸
                 faces_pos = arcface.detect_faces(image)
+                cur_faces_id = set(pos.face_id for pos in faces_pos)
+                for face_id in last_faces_id - cur_faces_id:
+                    face_process.forget("", face_id)
+                last_faces_id = cur_faces_id
                 if len(faces_pos) == 0:
                     # 图片中没有人脸
                     cur_face_info = None
@@ -107,12 +87,14 @@ def runwebsocketserver():
                     else:
                         # 上一轮的人脸不在了，选择当前所有人脸的最大人脸
                         cur_face_info = FaceInfo(faces_pos[center_face_index])
+                        # 切换回之前识别过的人脸时直接使用缓存的结果
+                        face_process.recall(cur_face_info)
                 if cur_face_info is not None:
                     # 异步更新人脸的信息
                     if cur_face_info.need_update():
                         face_process.async_update_face_info(image, cur_face_info)
                     # 绘制人脸信息
-                    _draw_face_info(image, cur_face_info)
+                    draw_face_info(image, cur_face_info)
                     # 绘制中心点
                     # put_text(image, "x", bottom_middle=(center_x, center_y))
                 # 显示到界面上
@@ -123,103 +105,66 @@ def runwebsocketserver():
                 if fps:
                     _logger.info("FPS: %.2f" % fps)
 
+    def _on_frame(pipeline: CameraPipeline, image: np.ndarray, faces_info: Dict[int, FaceInfo]) -> bool:
+        # 绘制人脸信息
+        with metrics.stage("draw"):
+            for face_info in faces_info.values():
+                draw_face_info(image, face_info)
+        if pipeline.name != selected_camera[0]:
+            # 只推送客户端选择的摄像头
+            return _stopped()
+        return _show_image(image)
+
+    def _video_engine() -> ArcFace:
+        detection = get_profile().detection
+        return ArcFace(ArcFace.VIDEO_MODE, ArcFace.ORIENTS.get(detection.orient, ArcFace.OP_0_ONLY),
+                       detection.scale, detection.max_faces)
+
+    def _quality_gate() -> QualityGate:
+        quality = get_profile().quality
+        return QualityGate(quality.max_yaw, quality.max_pitch, quality.min_sharpness)
+
     @timer(output=_logger.info)
     def _run_m_n(image_source: ImageSource, face_process: FaceProcess) -> None:
-        with ArcFace(ArcFace.VIDEO_MODE) as arcface:
-            faces_info: Dict[int, FaceInfo] = {}
-            frame_rate_statistics = _frame_rate_statistics_generator()
-            while True:
-                # 获取视频帧
-                image = image_source.read()
-                # 检测人脸
-                faces_pos: Dict[int, ArcFaceInfo] = {}
-                for face_pos in arcface.detect_faces(image):
-                    faces_pos[face_pos.face_id] = face_pos
-                # 删除过期 id, 添加新的 id
-                cur_faces_id = faces_pos.keys()
-                last_faces_id = faces_info.keys()
-                for face_id in last_faces_id - cur_faces_id:
-                    faces_info[face_id].cancel()  # 如果有操作在进行，这将取消操作
-                    faces_info.pop(face_id)
-                for face_id in cur_faces_id:
-                    if face_id in faces_info:
-                        # 人脸已经存在，只需更新位置就好了
-                        faces_info[face_id].arc_face_info = faces_pos[face_id]
-                    else:
-                        faces_info[face_id] = FaceInfo(faces_pos[face_id])
-
-                # 更新人脸的信息
-                # for face_info in faces_info:
-                #     face_process.async_update_face_info(image, face_info)
-                opt_face_info = None
-                for face_info in filter(lambda x: x.need_update(), faces_info.values()):
-                    if opt_face_info is None or opt_face_info.rect.size < face_info.rect.size:
-                        opt_face_info = face_info
-
-                if opt_face_info is not None:
-                    face_process.async_update_face_info(image, opt_face_info)
-                # 绘制人脸信息
-                for face_info in faces_info.values():
-                    _draw_face_info(image, face_info)
-
-                if _show_image(image):
-                    break
-                # 统计帧率
-                fps = next(frame_rate_statistics)
-                if fps:
-                    _logger.info("FPS: %.2f" % fps)
-
-    def new_client(client, server):
-        print("New client connected and was given id %d" % client['id'])
-        # 发送给所有的连接
-        server.send_message_to_all("Hey all, a new client has joined us")
-
-    def client_left(client, server):
-        id = 1
-        #print("Client(%d) disconnected" % client['id'])
+        profile = get_profile()
+        scheduler = ExtractionScheduler(profile.extract_rate)
+        CameraPipeline(selected_camera[0], image_source, face_process, _on_frame, scheduler, _quality_gate(),
+                       profile.detection.size, _video_engine, stop_event).run()
 
-    def message_received(client, server, message):
+    @timer(output=_logger.info)
+    def _run_multi_camera(face_process: FaceProcess) -> None:
+        """
+        同时处理配置文件中的所有摄像头
+        :face_process: 所有摄像头共享的特征提取和识别
+        :return: None
+        """
+        profile = get_profile()
+        cameras = profile.cameras
+        selected_camera[0] = next(iter(cameras), selected_camera[0])
+        scheduler = ExtractionScheduler(profile.extract_rate)
+        service = MultiCameraService(
+            cameras, face_process, _on_frame, profile.threaded_capture, scheduler, _quality_gate(),
+            profile.detection.size, _video_engine, stop_event)
+        service.start()
+        service.join()
+
+    def message_received(client_id: int, message: str) -> None:
         if len(message) > 200:
             message = message[:200] + '..'
-        print("Client(%d) said: %s" % (client['id'], message))
-        #with open("profile.yml", "r", encoding="utf-8") as file:
-        #    profile: Dict[str, str] = yaml.load(file, yaml.Loader)
-        #    rtsp = profile["camera"][message].encode().decode("gbk", "strict")
-        #global camera
-        #camera.set_camera(rtsp)
-        # 发送给所有的连接
-
-    def from_vedio():
-        thread2 = threading.Thread(target=face_recognition, args=(1,))
-        thread2.start()
-        thread1 = threading.Thread(target=vedio_send, args=(1,))
-        thread1.start()
-        print('webserver start')
-
-    def vedio_send(n):
-        global frame
-        while True:
-            with open("profile.yml", "r", encoding="utf-8") as file:
-                profile: Dict[str, str] = yaml.load(file, yaml.Loader)
-                server_on = profile["server-on"].encode()
-            if server_on == 0:
-                break
-            if len(server.clients) > 0:
-                image = cv.imencode('.jpg', frame)[1]
-                base64_data = base64.b64encode(image)
-                s = base64_data.decode()
-                # print('data:image/jpeg;base64,%s'%s)
-                server.send_message_to_all('data:image/jpeg;base64,%s' % s)
-            time.sleep(0.01)
+        _logger.info("Client(%d) said: %s" % (client_id, message))
+        # 多路摄像头时切换推送的摄像头
+        profile = get_profile()
+        if profile.multi_camera and message in profile.cameras:
+            selected_camera[0] = message
 
     def face_recognition(n):
-        global camera
-        camera = LocalCamera()
-        with open("profile.yml", "r", encoding="utf-8") as file:
-            profile: Dict[str, str] = yaml.load(file, yaml.Loader)
-            ArcFace.APP_ID = profile["app-id"].encode()
-            ArcFace.SDK_KEY = profile["sdk-key"].encode()
-        face_process = FaceProcess()
+        profile = get_profile()
+        ArcFace.APP_ID = profile.app_id
+        ArcFace.SDK_KEY = profile.sdk_key
+        # 识别事件同时推送给看板
+        face_process = FaceProcess(dispatcher=EventDispatcher(profile.event_url, listeners=[server.publish_event]))
+        metrics.start_http_server(profile.metrics_port)
+        metrics.QUEUE_DEPTH.set_function(lambda: face_process.pending, queue="extract")
 
         class AutoCloseOpenCVWindows:
             def __enter__(self):
@@ -230,25 +175,48 @@ def runwebsocketserver():
 
         """
             加载人脸部分
-            逻辑->30s刷新一次feature
+            逻辑->增量同步人脸库
         """
-        update_feature = threading.Thread(target=face_process.load_features)
-        update_feature.start()
+        update_feature = threading.Thread(target=face_process.load_features, args=(stop_event,), name="feature-sync")
         with face_process, AutoCloseOpenCVWindows():
-            run = _run_m_n #_run_1_n if args.single
-            with camera:
-                run(camera, face_process)
-
-    server = WebsocketServer(port=8124, host='127.0.0.1')
-    from_vedio()
-    # 有设备连接上了
-    server.set_fn_new_client(new_client)
-    # 断开连接
-    server.set_fn_client_left(client_left)
-    # 接收到信息
-    server.set_fn_message_received(message_received)
-    # 开始监听
-    server.run_forever()
+            update_feature.start()
+            try:
+                if profile.multi_camera:
+                    _run_multi_camera(face_process)
+                else:
+                    camera = open_camera(profile.camera_default, profile.threaded_capture)
+                    run = _run_m_n #_run_1_n if args.single
+                    with camera:
+                        run(camera, face_process)
+            finally:
+                # 识别结束时人脸库的同步也停止，不留下阻止进程退出的线程；同步会用到引擎池，先于引擎池停止
+                stop_event.set()
+                update_feature.join()
+
+    async def serve() -> None:
+        loop = asyncio.get_running_loop()
+        await server.start()
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.add_signal_handler(sig, _stop)
+                except NotImplementedError:
+                    # Windows 的事件循环不支持信号处理
+                    pass
+        # 读取摄像头和调用 SDK 都会阻塞，在专用的线程中运行，不占用事件循环
+        with ThreadPoolExecutor(1, thread_name_prefix="recognition") as executor:
+            recognition = loop.run_in_executor(executor, face_recognition, 1)
+            # 识别结束(比如视频播放完)时也停止服务
+            recognition.add_done_callback(lambda _: _stop())
+            await server.wait_closed()
+            # 服务停止时 stop_event 已经设置，所有摄像头在下一轮停止
+            stop_event.set()
+            await recognition
+        print('webserver stopped')
+
+    server = RecognitionServer(port=8124, host='127.0.0.1', on_message=message_received)
+    print('webserver start')
+    asyncio.run(serve())
 
 if __name__ == "__main__":
 
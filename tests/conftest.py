@@ -0,0 +1,6 @@
+"""
+测试用 benchmark.fake_sdk 代替 ArcSoft SDK，必须在导入 arcface 之前安装
+"""
+from benchmark import fake_sdk
+
+fake_sdk.install(fake_sdk.FakeArcSoftSDK())
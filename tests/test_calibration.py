@@ -0,0 +1,55 @@
+import sys
+
+import numpy as np
+import pytest
+
+from arcface import ArcFace
+from benchmark import fake_sdk
+from module.face_process import FaceProcess
+
+_SCALE, _BIAS = 0.8, 0.15  # 替身 SDK 的相似度与余弦相似度之间的关系
+
+
+@pytest.fixture
+def sdk(monkeypatch):
+    monkeypatch.setattr(ArcFace, "APP_ID", b"test")
+    monkeypatch.setattr(ArcFace, "SDK_KEY", b"test")
+    sdk = fake_sdk.install(fake_sdk.FakeArcSoftSDK())
+
+    # 与真实的 SDK 一样，相似度不是余弦相似度
+    def compare_feature(engine, feature1, feature2, confidence) -> int:
+        score = float(np.dot(sdk._read_feature(feature1), sdk._read_feature(feature2)))
+        confidence.value = max(0.0, min(1.0, _SCALE * score + _BIAS))
+        return fake_sdk.OK
+
+    monkeypatch.setattr(sys.modules["arcface._arcsoft_face_func"], "compare_feature", compare_feature)
+    return sdk
+
+
+def _probe(vector: np.ndarray, cosine: float, seed: int) -> bytes:
+    """
+    :return: 与 vector 的余弦相似度为 cosine 的特征值
+    """
+    # 替身用身份编号作为特征值的随机种子，噪声换一组种子
+    noise = np.random.RandomState(1000 + seed).standard_normal(vector.size)
+    noise -= (noise @ vector) * vector
+    noise /= np.linalg.norm(noise)
+    probe = cosine * vector + np.sqrt(1 - cosine ** 2) * noise
+    return fake_sdk.FEATURE_HEADER + probe.astype(np.float32).tobytes()
+
+
+def test_gallery_search_agrees_with_sdk_compare_at_threshold(sdk):
+    with FaceProcess(1, queue_size=0, match_cache_ttl=0) as face_process, ArcFace(ArcFace.IMAGE_MODE) as arcface:
+        face_process._set_gallery(sdk.gallery_features(100))
+        gallery = face_process._gallery
+        threshold = FaceProcess.MATCH_THRESHOLD
+        # 在 SDK 尺度的阈值附近取探针
+        for i, sdk_score in enumerate(np.linspace(threshold - 0.05, threshold + 0.05, 21)):
+            name = "person-%d" % (i % sdk.identities)
+            probe = _probe(sdk.vector(i % sdk.identities), (sdk_score - _BIAS) / _SCALE, i)
+            (found, score), = gallery.search(probe)
+            expected = arcface.compare_feature(probe, gallery.feature(name))
+            assert found == name
+            assert score == pytest.approx(expected, abs=1e-3)
+            if abs(expected - threshold) > 1e-3:
+                assert (threshold < score) == (threshold < expected)
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from arcface import Rect, capture_face_image
+
+
+@pytest.mark.parametrize("width", [37, 38, 39, 40, 641])
+@pytest.mark.parametrize("padding", [0.0, 0.5])
+def test_crop_contains_the_face(width, padding):
+    height = 20
+    image = np.random.RandomState(width).randint(0, 256, (height, width, 3), dtype=np.uint8)
+    for w in (1, 5, 11, min(width, 37)):
+        for x in range(0, width - w + 1):
+            crop, rect = capture_face_image(image, Rect(x, 2, w, 10), padding)
+            assert crop.shape[1] % 4 == 0
+            assert crop.flags.c_contiguous
+            (cx, cy), (cw, ch) = rect.top_left, rect.size
+            assert (cw, ch) == (w, 10)
+            assert cx >= 0 and cx + cw <= crop.shape[1]
+            np.testing.assert_array_equal(crop[cy:cy + ch, cx:cx + cw], image[2:12, x:x + w])
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from arcface import ArcFace
+from benchmark import fake_sdk
+from module.engine_pool import EnginePool
+
+
+@pytest.fixture(autouse=True)
+def activation(monkeypatch):
+    monkeypatch.setattr(ArcFace, "APP_ID", b"test")
+    monkeypatch.setattr(ArcFace, "SDK_KEY", b"test")
+
+
+def test_each_engine_is_used_by_one_thread():
+    threads = {}
+    running = set()
+    errors = []
+    lock = threading.Lock()
+
+    def task(engine: ArcFace) -> None:
+        with lock:
+            threads.setdefault(id(engine), set()).add(threading.get_ident())
+            if id(engine) in running:
+                errors.append("引擎被并行调用")
+            running.add(id(engine))
+        time.sleep(0.001)
+        with lock:
+            running.discard(id(engine))
+
+    with EnginePool(3) as pool:
+        futures = [pool.submit(task) for _ in range(60)]
+        for future in futures:
+            future.result()
+    assert errors == []
+    assert len(threads) == 3
+    assert all(len(idents) == 1 for idents in threads.values())
+    assert len(set.union(*threads.values())) == 3
+
+
+def test_try_submit_returns_none_when_queue_is_full():
+    started, blocked = threading.Event(), threading.Event()
+
+    def block(engine: ArcFace) -> None:
+        started.set()
+        blocked.wait()
+
+    with EnginePool(1, max_pending=1) as pool:
+        running = pool.submit(block)
+        assert started.wait(5)
+        waiting = pool.try_submit(lambda engine: "waiting")
+        assert waiting is not None
+        assert pool.pending == 1
+        assert pool.try_submit(lambda engine: "dropped") is None
+        blocked.set()
+        assert running.result(5) is None
+        assert waiting.result(5) == "waiting"
+
+
+def test_result_and_exception_reach_the_future():
+    def fail(engine: ArcFace) -> None:
+        raise ValueError("失败")
+
+    with EnginePool(2) as pool:
+        assert pool.submit(lambda engine, x, y=0: x + y, 1, y=2).result(5) == 3
+        assert isinstance(pool.submit(lambda engine: engine).result(5), ArcFace)
+        with pytest.raises(ValueError, match="失败"):
+            pool.submit(fail).result(5)
+        # 出错后工作线程继续执行之后的任务
+        assert pool.submit(lambda engine: "ok").result(5) == "ok"
+
+
+def test_release_joins_workers_and_frees_engines():
+    sdk = fake_sdk.install(fake_sdk.FakeArcSoftSDK())
+    before = set(sdk._engines)
+    pool = EnginePool(2)
+    assert len(set(sdk._engines) - before) == 2
+    workers = list(pool._threads)
+    futures = [pool.submit(lambda engine: time.sleep(0.01) or "done") for _ in range(6)]
+    pool.release()
+    # 已提交的任务在释放前执行完
+    assert [future.result(0) for future in futures] == ["done"] * 6
+    assert not any(worker.is_alive() for worker in workers)
+    assert set(sdk._engines) == before
+    assert pool.size == 0
@@ -0,0 +1,70 @@
+import threading
+
+from module.event_dispatcher import EventDispatcher, RecognitionEvent
+
+
+class _BlockingDispatcher(EventDispatcher):
+    """
+    不发送请求，记录每一批事件；release 之前发送会阻塞，模拟接收端很慢
+    """
+    def __init__(self, **kwargs):
+        super().__init__("http://127.0.0.1:9/events", flush_interval=0.05, **kwargs)
+        self.batches = []
+        self.release = threading.Event()
+        self.posting = threading.Event()
+
+    def _post(self, events):
+        self.posting.set()
+        self.release.wait()
+        self.batches.append(events)
+        self.sent += len(events)
+
+
+def _event(face_id: int, name: str = "guest") -> RecognitionEvent:
+    return RecognitionEvent(name, face_id, 0.9, "camera", 0.0)
+
+
+def test_repeats_do_not_fill_the_queue():
+    dispatcher = _BlockingDispatcher(queue_size=2)
+    dispatcher.dispatch(_event(1))
+    assert dispatcher.posting.wait(5)
+    for _ in range(100):
+        dispatcher.dispatch(_event(1))
+    dispatcher.dispatch(_event(2))
+    dispatcher.dispatch(_event(2, "other"))
+    assert dispatcher.dropped == 0
+    dispatcher.release.set()
+    dispatcher.close()
+    assert [[(e.face_id, e.id) for e in batch] for batch in dispatcher.batches] == \
+        [[(1, "guest")], [(2, "guest"), (2, "other")]]
+
+
+def test_listeners_see_every_event():
+    seen = []
+    dispatcher = _BlockingDispatcher(listeners=[seen.append])
+    dispatcher.release.set()
+    for _ in range(3):
+        dispatcher.dispatch(_event(1))
+    dispatcher.close()
+    assert len(seen) == 3
+    assert dispatcher.sent == 1
+
+
+def test_close_does_not_block_on_a_full_queue():
+    dispatcher = _BlockingDispatcher(queue_size=2)
+    dispatcher.dispatch(_event(0))
+    assert dispatcher.posting.wait(5)
+    for face_id in range(1, 4):
+        dispatcher.dispatch(_event(face_id))
+    assert dispatcher.dropped == 1
+
+    closing = threading.Thread(target=dispatcher.close)
+    closing.start()
+    # close 不会卡在 put(None)，只等待工作线程
+    closing.join(0.2)
+    assert dispatcher._stop.is_set() and dispatcher._events.full()
+    dispatcher.release.set()
+    closing.join(5)
+    assert not closing.is_alive()
+    assert dispatcher.sent == 3
+    assert dispatcher._thread is None
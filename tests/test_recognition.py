@@ -0,0 +1,65 @@
+import os
+import signal
+import threading
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+import recognition
+from module import config
+
+_PROFILE = """
+app-id: "test"
+sdk-key: "test"
+camera-default: '%s'
+threaded-capture: "0"
+multi-camera: "0"
+server-on: "1"
+event-url: "http://127.0.0.1:9/checkedfaces/"
+gallery-source: "%s"
+feature-store: '%s'
+metrics-port: 0
+database:
+  host: "127.0.0.1"
+  user: "root"
+  password: "root"
+  base: "face"
+"""
+
+
+def _write_video(path: str, frames: int = 20) -> None:
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*"MJPG"), 25, (320, 240))
+    image = np.random.RandomState(0).randint(0, 256, (240, 320, 3), dtype=np.uint8)
+    for _ in range(frames):
+        writer.write(image)
+    writer.release()
+
+
+def _live_threads():
+    return {thread for thread in threading.enumerate()
+            if thread is not threading.main_thread() and not thread.daemon and thread.is_alive()}
+
+
+@pytest.mark.parametrize("gallery_source", ["database", "store"])
+def test_runwebsocketserver_stops_on_sigint(tmp_path, monkeypatch, gallery_source):
+    video = str(tmp_path / "camera.avi")
+    _write_video(video)
+    profile = tmp_path / "profile.yml"
+    store = str(tmp_path / "feature_store")
+    profile.write_text(_PROFILE % (video, gallery_source, store), encoding="utf-8")
+    monkeypatch.setattr(config, "_watcher", config.ProfileWatcher(str(profile)))
+    # 只测试停止的流程，不绘制(需要字体文件)，也不关闭窗口(headless 的 OpenCV 不支持)
+    monkeypatch.setattr(recognition, "draw_face_info", lambda image, face_info: None)
+    monkeypatch.setattr(cv, "destroyAllWindows", lambda: None)
+    before = _live_threads()
+
+    # 视频播放完后摄像头一直读取不到视频帧，人脸库同步一直连接不上数据库，收到信号后都要停止
+    timer = threading.Timer(2.0, os.kill, (os.getpid(), signal.SIGINT))
+    timer.start()
+    try:
+        recognition.runwebsocketserver()
+    finally:
+        timer.cancel()
+    timer.join()
+    assert _live_threads() - before == set()
@@ -0,0 +1,19 @@
+import cv2 as cv
+import numpy as np
+
+from benchmark import fake_sdk, replay
+
+
+def test_replay_runs_extraction_and_liveness(tmp_path):
+    path = str(tmp_path / "frame.png")
+    cv.imwrite(path, np.random.RandomState(0).randint(0, 256, (240, 320, 3), dtype=np.uint8))
+    sdk = fake_sdk.install(fake_sdk.FakeArcSoftSDK())
+    sdk.calls.clear()
+    result = replay.run(path, frames=300, gallery_size=sdk.identities, encode=False)
+    calls = result["sdk_calls"]
+    assert result["frames"] == 300
+    assert calls["detect_faces"] == 300
+    # 默认的参数下第一批人脸在离开前截图已经稳定，每个人脸都提取特征、做活体检测并识别出来
+    assert sdk.faces <= calls["extract_feature"]
+    assert sdk.faces <= calls.get("process", 0)
+    assert sdk.faces <= result["recognitions"]
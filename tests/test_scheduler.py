@@ -0,0 +1,94 @@
+from arcface import FaceInfo as ArcFaceInfo, Rect
+from module.face_process import FaceInfo
+from module.scheduler import ExtractionScheduler, quality_score
+
+
+def make_face(size: int = 160, face_id: int = 0, attempts: int = 0) -> FaceInfo:
+    face_info = FaceInfo(ArcFaceInfo(Rect(0, 0, size, size), 1, face_id))
+    face_info.attempts = attempts
+    return face_info
+
+
+def face_ids(faces_info):
+    return [face_info.arc_face_info.face_id for face_info in faces_info]
+
+
+def test_select_orders_by_quality():
+    scheduler = ExtractionScheduler(rate=0, max_per_frame=3)
+    faces_info = [make_face(80, 0), make_face(160, 1), make_face(120, 2)]
+    assert face_ids(scheduler.select(faces_info, now=0.0)) == [1, 2, 0]
+
+
+def test_select_limits_faces_per_frame():
+    scheduler = ExtractionScheduler(rate=0, max_per_frame=2)
+    faces_info = [make_face(60 + i * 10, i) for i in range(5)]
+    assert face_ids(scheduler.select(faces_info, now=0.0)) == [4, 3]
+
+
+def test_select_skips_rejected_faces():
+    scheduler = ExtractionScheduler(rate=0, max_per_frame=2)
+    faces_info = [make_face(160, 0), make_face(120, 1), make_face(80, 2)]
+    selected = scheduler.select(faces_info, now=0.0, accept=lambda face_info: face_info.arc_face_info.face_id != 0)
+    assert face_ids(selected) == [1, 2]
+
+
+def test_select_lowers_priority_of_attempted_faces():
+    scheduler = ExtractionScheduler(rate=0, max_per_frame=2)
+    faces_info = [make_face(160, 0, attempts=3), make_face(120, 1)]
+    assert quality_score(faces_info[0]) > quality_score(faces_info[1])
+    assert face_ids(scheduler.select(faces_info, now=0.0)) == [1, 0]
+
+
+def test_select_skips_faces_in_backoff():
+    scheduler = ExtractionScheduler(rate=0, max_per_frame=2)
+    face_info = make_face()
+    face_info.record_failure(now=0.0)
+    assert scheduler.select([face_info], now=FaceInfo.BACKOFF_BASE / 2) == []
+    assert scheduler.select([face_info], now=FaceInfo.BACKOFF_BASE) == [face_info]
+    face_info.record_failure(now=FaceInfo.BACKOFF_BASE)
+    assert scheduler.select([face_info], now=FaceInfo.BACKOFF_BASE * 2) == []
+    assert scheduler.select([face_info], now=FaceInfo.BACKOFF_BASE * 3) == [face_info]
+
+
+def test_select_skips_faces_out_of_attempts():
+    scheduler = ExtractionScheduler(rate=0)
+    assert scheduler.select([make_face(attempts=FaceInfo.MAX_ATTEMPTS)], now=0.0) == []
+
+
+def test_select_does_not_spend_budget():
+    scheduler = ExtractionScheduler(rate=1, burst=1)
+    faces_info = [make_face(face_id=0)]
+    for _ in range(10):
+        assert scheduler.select(faces_info, now=scheduler._last_time) == faces_info
+
+
+def test_submit_spends_one_token_per_submitted_face():
+    scheduler = ExtractionScheduler(rate=1, burst=2)
+    now = scheduler._last_time
+    submitted = []
+    faces_info = [make_face(80, 0), make_face(160, 1), make_face(120, 2)]
+    assert scheduler.submit(faces_info, lambda face_info: submitted.append(face_info) or True, now) == 2
+    assert face_ids(submitted) == [1, 2]
+    # 预算用完后不采集截图
+    assert scheduler.select(faces_info, now) == []
+    # 一秒后恢复一个令牌
+    assert scheduler.submit(faces_info, lambda face_info: True, now + 1.0) == 1
+
+
+def test_submit_refunds_refused_faces():
+    scheduler = ExtractionScheduler(rate=1, burst=1)
+    now = scheduler._last_time
+    faces_info = [make_face()]
+    assert scheduler.submit(faces_info, lambda face_info: False, now) == 0
+    assert scheduler.submit(faces_info, lambda face_info: True, now) == 1
+    assert scheduler.submit(faces_info, lambda face_info: True, now) == 0
+
+
+def test_submit_force_borrows_from_later_budget():
+    scheduler = ExtractionScheduler(rate=1, burst=1)
+    now = scheduler._last_time
+    faces_info = [make_face()]
+    assert scheduler.submit(faces_info, lambda face_info: True, now) == 1
+    assert scheduler.submit(faces_info, lambda face_info: True, now, force=True) == 1
+    assert scheduler.submit(faces_info, lambda face_info: True, now + 1.0) == 0
+    assert scheduler.submit(faces_info, lambda face_info: True, now + 2.0) == 1
@@ -0,0 +1,61 @@
+import os
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from module.text_renderer import TextRenderer
+
+_FONT_FILES = (
+    r"C:\Windows\Fonts\msyh.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/System/Library/Fonts/Supplemental/Arial.ttf",
+)
+
+
+def _font_file() -> str:
+    for font_file in (os.environ.get("FONT_FILE", ""),) + _FONT_FILES:
+        if font_file and os.path.isfile(font_file):
+            return font_file
+    pytest.skip("没有字体文件，可以用环境变量 FONT_FILE 指定")
+
+
+def test_concurrent_render_matches_single_thread(monkeypatch):
+    font_file = _font_file()
+    # 缓存很小时各线程不断淘汰彼此的结果，线程频繁切换时更容易交错
+    monkeypatch.setattr(TextRenderer, "LABEL_CACHE_SIZE", 8)
+    chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+    texts = ["%s,%.2f" % ((chars[i % len(chars):] + chars)[:1 + i % 7], i / 100) for i in range(200)]
+    reference = TextRenderer(font_file, 1200)
+    expected = {text: reference.render_text(text).copy() for text in texts}
+
+    mismatches = []
+    errors = []
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for _ in range(3):
+            # 每一轮用新的实例，字形缓存从空开始
+            shared = TextRenderer(font_file, 1200)
+            barrier = threading.Barrier(8)
+
+            def render(offset: int) -> None:
+                try:
+                    barrier.wait()
+                    for text in texts[offset:] + texts[:offset]:
+                        if not np.array_equal(shared.render_text(text), expected[text]):
+                            mismatches.append(text)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=render, args=(i * len(texts) // 8,)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
+    assert mismatches == []